@@ -0,0 +1,258 @@
+"""Timing benchmarks for the hot paths of PyACTUp's Memory.
+
+Each benchmark is run against memories built for every combination of the selected
+numbers of chunks, references per chunk, slots per chunk and noise settings, and its
+timings are written as JSON. Building the memories is not timed, nor is advancing their
+time before each call, which is done so that no base activations are reused. A previous
+JSON file can be given to --compare, in which case any benchmark that has become slower
+by more than --tolerance is reported, and the exit status is non-zero. Unless
+--no-footprint is given the memory used per chunk by each memory built is also measured
+and compared in the same way, as the pseudo-benchmark bytes_per_chunk.
+
+    python benchmarks/bench_memory.py --output bench.json
+    python benchmarks/bench_memory.py --chunks 100000 1000000 --benchmark retrieve_exact blend
+    python benchmarks/bench_memory.py --compare bench.json
+
+Nothing but NumPy and the standard library is needed, and nothing is fetched.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import numpy as np
+import pyactup_v2 as pyactup
+
+CATEGORIES = 10
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    """Registers a benchmark. It is called with the Memory and the parameters and should
+    return a callable, the execution of which is what is timed."""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def build(chunks, references, slots, noise, columnar=False, optimized_learning=False):
+    # Chunk i has slot s0 = i, unique to it, s1 = i modulo CATEGORIES, and further slots
+    # with values cycling at different rates. Each is learned references times, in turn.
+    m = pyactup.Memory(noise=noise, temperature=1, columnar=columnar,
+                       optimized_learning=optimized_learning)
+    for r in range(references):
+        for i in range(chunks):
+            m.learn(**chunk_attributes(i, slots))
+        m.advance()
+    return m
+
+
+def chunk_attributes(i, slots):
+    result = {"s0": i, "s1": i % CATEGORIES}
+    for s in range(2, slots):
+        result[f"s{s}"] = i % (CATEGORIES + s)
+    return result
+
+
+@benchmark
+def learn(m, params):
+    slots = params["slots"]
+    n = params["chunks"]
+    def run():
+        for i in range(100):
+            m.learn(**chunk_attributes(i * 7919 % n, slots))
+    return run
+
+
+@benchmark
+def retrieve_exact(m, params):
+    def run():
+        for k in range(CATEGORIES):
+            m.retrieve(s1=k)
+    return run
+
+
+@benchmark
+def retrieve_rare(m, params):
+    n = params["chunks"]
+    def run():
+        for k in range(100):
+            m.retrieve(s0=k * 7919 % n, s1=k * 7919 % n % CATEGORIES)
+    return run
+
+
+@benchmark
+def retrieve_partial(m, params):
+    m.mismatch = 1
+    def run():
+        # similarity functions are shared by all memories, so this one is removed again
+        pyactup.set_similarity_function(lambda x, y: 1 - abs(x - y) / CATEGORIES, "s1")
+        try:
+            for k in range(CATEGORIES):
+                m.retrieve(partial=True, s1=k)
+        finally:
+            pyactup.Memory._similarity_functions.pop("s1", None)
+            pyactup.Memory._clamped_similarity.cache_clear()
+    return run
+
+
+@benchmark
+def blend(m, params):
+    def run():
+        for k in range(CATEGORIES):
+            m.blend("s0", s1=k)
+    return run
+
+
+@benchmark
+def spread(m, params):
+    # uncached, so that every call computes the spreading activations from the fan index
+    m.spreading_cache_size = 0
+    def run():
+        for k in range(CATEGORIES):
+            m.spread(auto_clear=True, s1=k, s2=k)
+    return run
+
+
+@benchmark
+def spread_cached(m, params):
+    # after the first call every set of sources is found in the spreading cache
+    def run():
+        for k in range(CATEGORIES):
+            m.spread(auto_clear=True, s1=k, s2=k)
+    return run
+
+
+@benchmark
+def activation_history(m, params):
+    def run():
+        for k in range(CATEGORIES):
+            m.activation_history = []
+            m.blend("s0", s1=k)
+        m.activation_history = None
+    return run
+
+
+@benchmark
+def activation_trace(m, params):
+    m.activation_history = pyactup.ActivationTrace()
+    def run():
+        for k in range(CATEGORIES):
+            m.blend("s0", s1=k)
+    return run
+
+
+def footprint(chunks, references, slots, noise, columnar=False):
+    # The memory allocated while building a memory, and still held by it, per chunk.
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        m = build(chunks, references, slots, noise, columnar)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return dict(bytes_per_chunk=used / len(m), metric="bytes_per_chunk")
+
+
+def measure(m, run, repeat, number):
+    # The time is advanced before each call, outside the timing, so that base activations
+    # memoized by one call are never reused by the next, and their computation is timed.
+    times = []
+    for i in range(repeat):
+        elapsed = 0
+        for j in range(number):
+            m.advance()
+            start = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - start
+        times.append(elapsed / number)
+    return dict(min=min(times), median=statistics.median(times),
+                mean=statistics.mean(times), repeat=repeat, number=number)
+
+
+def key(result):
+    return (result["benchmark"], tuple(sorted(result["params"].items())))
+
+
+def compare(results, path, tolerance):
+    with open(path) as f:
+        previous = {key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get(key(r))
+        if old is None:
+            continue
+        metric = r.get("metric", "min")
+        ratio = r[metric] / old[metric]
+        flag = "REGRESSION" if ratio > tolerance else ""
+        print(f"{r['benchmark']:20} {format_params(r['params']):60} {ratio:7.2f}x {flag}")
+        if ratio > tolerance:
+            regressions.append(r)
+    return regressions
+
+
+def format_params(params):
+    return " ".join(f"{k}={v}" for k, v in params.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--benchmark", nargs="*", choices=sorted(BENCHMARKS),
+                        default=sorted(BENCHMARKS))
+    parser.add_argument("--chunks", type=int, nargs="*", default=[100, 1000, 10000])
+    parser.add_argument("--references", type=int, nargs="*", default=[1, 10])
+    parser.add_argument("--slots", type=int, nargs="*", default=[2, 6])
+    parser.add_argument("--noise", type=float, nargs="*", default=[0.25])
+    parser.add_argument("--columnar", type=int, nargs="*", default=[0], choices=[0, 1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=1)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a previous JSON results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="the slowdown ratio above which a regression is reported")
+    parser.add_argument("--no-footprint", action="store_true",
+                        help="do not measure the memory used per chunk")
+    args = parser.parse_args()
+    results = []
+    for chunks, references, slots, noise, columnar in itertools.product(
+            args.chunks, args.references, args.slots, args.noise, args.columnar):
+        params = dict(chunks=chunks, references=references, slots=slots, noise=noise,
+                      columnar=bool(columnar))
+        if not args.no_footprint:
+            result = dict(benchmark="bytes_per_chunk", params=params,
+                          **footprint(chunks, references, slots, noise, bool(columnar)))
+            results.append(result)
+            print(f"{'bytes_per_chunk':20} {format_params(params):60} "
+                  f"{result['bytes_per_chunk']:10.0f} B", flush=True)
+        for name in args.benchmark:
+            # a fresh memory for each, as some benchmarks change it
+            m = build(chunks, references, slots, noise, bool(columnar))
+            run = BENCHMARKS[name](m, params)
+            result = dict(benchmark=name, params=params,
+                          **measure(m, run, args.repeat, args.number))
+            results.append(result)
+            print(f"{name:20} {format_params(params):60} {result['min'] * 1000:10.3f} ms",
+                  flush=True)
+    output = dict(meta=dict(pyactup=pyactup.__version__,
+                            python=platform.python_version(),
+                            numpy=np.__version__,
+                            platform=platform.platform(),
+                            time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+                  results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
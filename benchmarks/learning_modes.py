@@ -0,0 +1,90 @@
+"""Compares the accuracy and speed of PyACTUp's base-level learning modes.
+
+Builds the same memory, whose chunks have long reference histories, with exact learning,
+optimized learning and the hybrid form of optimized learning retaining various numbers of
+recent references, and reports the time taken to compute the base activations of all
+the chunks, and the mean and maximum absolute differences from the exact values. The
+base activations are computed by a retrieval matching every chunk, with an
+ActivationTrace attached, which both prevents chunks being skipped and records them.
+
+    python benchmarks/learning_modes.py --chunks 1000 --references 200
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pyactup_v2 as pyactup
+
+
+def build(mode, columnar, chunks, references, seed):
+    # mode is a boolean, the optimized_learning parameter, or the recent_references
+    # parameter of the hybrid form
+    rng = random.Random(seed)
+    if isinstance(mode, bool):
+        learning = dict(optimized_learning=mode)
+    else:
+        learning = dict(recent_references=mode)
+    m = pyactup.Memory(noise=0, temperature=1, columnar=columnar, **learning)
+    for t in range(chunks * references):
+        m.learn(item=rng.randrange(chunks))
+        m.advance()
+    return m
+
+
+def base_activations(m, repeat):
+    # The time is advanced before each repetition, so that nothing memoized is reused;
+    # every mode is advanced alike, so the final values are compared at the same time.
+    trace = pyactup.ActivationTrace(size=len(m), fields=["base_activation"])
+    m.activation_history = trace
+    best = float("inf")
+    for i in range(repeat):
+        m.advance()
+        start = time.perf_counter()
+        m.retrieve()
+        best = min(best, time.perf_counter() - start)
+    m.activation_history = None
+    return trace["base_activation"], best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--references", type=int, default=200,
+                        help="mean number of references per chunk")
+    parser.add_argument("--recent", type=int, nargs="*", default=[1, 3, 10])
+    parser.add_argument("--columnar", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    exact = None
+    results = []
+    for mode in [False, True] + args.recent:
+        m = build(mode, args.columnar, args.chunks, args.references, args.seed)
+        values, seconds = base_activations(m, args.repeat)
+        if exact is None:
+            exact = values
+        errors = abs(values - exact)
+        results.append(dict(optimized_learning=mode is True,
+                            recent_references=None if isinstance(mode, bool) else mode,
+                            columnar=args.columnar,
+                            chunks=args.chunks,
+                            references=args.references,
+                            seconds=seconds,
+                            mean_error=float(errors.mean()),
+                            max_error=float(errors.max())))
+        print(f"{str(mode):>6}  {seconds * 1000:10.3f} ms  "
+              f"mean error {errors.mean():.5f}  max error {errors.max():.5f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -42,19 +42,46 @@ __version__ = '1.2.0'
 Moreover, it allows user to create its own customized spreading activation function by calling 
 set_sji_function()'''
 
+import atexit
 import collections
 import collections.abc as abc
+import contextlib
+import csv
+import functools
+import gc
+import heapq
+import inspect
+import itertools
+import json
 import math
+import multiprocessing
 import numbers
+import os
+import pickle
+import queue
 import random
 import sys
+import threading
+import weakref
 import numpy as np
 
 from collections import OrderedDict
 from warnings import warn
 
-__all__ = ("Memory", "set_similarity_function", "use_actr_similarity", 
-           "set_sji_function", "use_actr_sji", "set_matching_source_to_chunk_function", "use_actr_matching_source_to_chunk")
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+__all__ = ("Memory", "set_similarity_function", "set_similarity_matrix", "use_actr_similarity", 
+           "set_sji_function", "use_actr_sji", "set_matching_source_to_chunk_function", "use_actr_matching_source_to_chunk",
+           "run_agents", "ActivationTrace", "HistoryExporter", "SpreadingContext")
 
 DEFAULT_NOISE = 0.25
 DEFAULT_DECAY = 0.5
@@ -64,6 +91,78 @@ MINIMUM_TEMPERATURE = 0.01
 
 TRANSCENDENTAL_CACHE_SIZE = 1000
 
+SIMILARITY_CACHE_SIZE = 10000
+
+PRUNING_SLACK = 1e-9
+
+COMPACTION_LOW_WATER = 0.9
+
+SPREADING_CACHE_SIZE = 128
+
+SpreadingCacheInfo = collections.namedtuple("SpreadingCacheInfo",
+                                            ["hits", "misses", "maxsize", "currsize"])
+
+SNAPSHOT_FORMAT = "pyactup-snapshot"
+SNAPSHOT_VERSION = 1
+
+RUNNER_BATCH_SIZE = 64
+RUNNER_POLL_INTERVAL = 0.5
+
+class _NoLock:
+    # Stands in for the lock of a Memory that is not concurrent; contextlib.nullcontext
+    # would do, but requires Python 3.7.
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_LOCK = _NoLock()
+
+def _reads(method):
+    # Makes a Memory method hold the Memory's lock for reading, if it is concurrent.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return wrapper
+
+def _writes(method):
+    # Makes a Memory method hold the Memory's lock for writing, if it is concurrent.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._lock
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return wrapper
+
+def _chunk_writes(method):
+    # Like _writes, for a Chunk method modifying state of the Memory containing it.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._memory._lock
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return wrapper
+
 """for spreading activation param"""
 DEFAULT_SOURCE_ACTIVATION = 1.0 # W
 DEFAULT_MAX_ASSOCIATIVE_STRENGTH = 1.6 # associative strength
@@ -77,13 +176,53 @@ class Memory(dict):
     usual :func:`len` function.
 
     A Memory has several parameters controlling its behavior: :attr:`noise`, :attr:`decay`,
-    :attr:`temperature`, :attr:`threshold`, :attr:`mismatch` and :attr:`optimized_learning`.
+    :attr:`temperature`, :attr:`threshold`, :attr:`mismatch`, :attr:`optimized_learning`
+    and :attr:`recent_references`.
     All can be queried, and most set, as properties on the Memory object. When creating
     a Memory object their initial values can be supplied as parameters.
 
     A Memory object can be serialized with
     `pickle <https://docs.python.org/3.6/library/pickle.html>`_, allowing Memory objects
-    to be saved to and restored from persistent storage.
+    to be saved to and restored from persistent storage. For large memories
+    :meth:`snapshot` and :meth:`restore` are usually much faster.
+
+    If *recent_references* is a positive integer, *k*, a hybrid of the two is used:
+    the times of the *k* most recent references to each chunk are retained exactly, and
+    the contribution of all the earlier ones is approximated analytically, as described
+    by Petrov (2006), "Computationally efficient approximation of the base-level learning
+    equation in ACT-R". This bounds both the storage per chunk and the cost of computing
+    its activation, while typically remaining very close to the exact value.
+
+    If *columnar* is true the Memory keeps the reference times of all its chunks in
+    contiguous NumPy arrays, rather than in a Python list per chunk, and computes the base
+    activations of all the chunks considered by :meth:`retrieve` or :meth:`blend` in a
+    single vectorized pass. This is usually much faster for memories with many chunks,
+    or with chunks that have been learned many times, and otherwise behaves identically,
+    up to floating point rounding.
+
+    Each Memory draws its activation noise, and any random importances, from its own
+    :class:`numpy.random.Generator`, its :attr:`rng`, created from *seed*, which may be
+    anything accepted by :func:`numpy.random.default_rng`. Two Memory objects created
+    with the same seed and used in the same way therefore behave identically, and
+    Memory objects used concurrently do not disturb one another's random streams.
+
+    A Memory can also be given a retention policy, by way of its :attr:`max_chunks`,
+    :attr:`activation_floor`, :attr:`compaction_interval` and :attr:`on_evict`
+    parameters, under which chunks that have become too weak to matter are evicted by
+    :meth:`compact`, so that a Memory used for a very long time does not grow without
+    bound.
+
+    If *concurrent* is true the Memory may be shared by several threads, any number of
+    which may retrieve from it, or blend, at once, while others learn, advance its time
+    or otherwise modify it. Reads proceed in parallel with one another, each seeing the
+    Memory as it is at a single time, while a modification waits for the reads in
+    progress to finish, and holds up new ones until it is done. The work of the reads is
+    largely done in NumPy, which releases the global interpreter lock, and on a
+    free-threaded build of Python they run entirely in parallel. Each thread has its own
+    active :meth:`context`, and records are added to the :attr:`activation_history` one
+    operation at a time. Several modifications can be made together, unseen by the
+    reads until all are complete, within :meth:`writing`. A concurrent Memory costs a
+    little more to use from a single thread.
 
     If, when creating a ``Memory`` object, any of *noise*, *decay* or *mismatch* are
     negative, or if *temperature* is less than 0.01, a :exc:`ValueError` is raised.
@@ -97,10 +236,29 @@ class Memory(dict):
                  mismatch=None,
                  optimized_learning=False,
                  source_activation=DEFAULT_SOURCE_ACTIVATION,  # w
-                 max_associative_strength=DEFAULT_MAX_ASSOCIATIVE_STRENGTH):
+                 max_associative_strength=DEFAULT_MAX_ASSOCIATIVE_STRENGTH,
+                 columnar=False,
+                 seed=None,
+                 max_chunks=None,
+                 activation_floor=None,
+                 compaction_interval=None,
+                 on_evict=None,
+                 concurrent=False,
+                 recent_references=None):
+        self._init_concurrency(concurrent)
         self._temperature_param = 1 # will be reset below, but is needed for noise assignment
+        self._rng = np.random.default_rng(seed)
         self.noise = noise
         self._decay = None
+        self._optimized_learning = False
+        self._recent_references = None
+        self._engine = None
+        self._base_cache = _BaseActivationCache()
+        self._version = 0
+        self._spreading_cache = collections.OrderedDict()
+        self._spreading_cache_size = SPREADING_CACHE_SIZE
+        self._spreading_hits = 0
+        self._spreading_misses = 0
         self.decay = decay
         self.temperature = temperature
         self.threshold = threshold
@@ -108,7 +266,42 @@ class Memory(dict):
         self.source_activation = source_activation  # source of spreading activation param W
         self.max_associative_strength = max_associative_strength  #for spreading activation param S
         self._activation_history = None
-        self.reset(bool(optimized_learning))
+        self._columnar = bool(columnar)
+        self.max_chunks = max_chunks
+        self.activation_floor = activation_floor
+        self.compaction_interval = compaction_interval
+        self.on_evict = on_evict
+        self.reset(optimized_learning, recent_references)
+
+    def _init_concurrency(self, concurrent):
+        self._concurrent = bool(concurrent)
+        if concurrent:
+            self._lock = _ReadWriteLock()
+            self._mutex = threading.Lock()
+            self._local = threading.local()
+            self._contexts = None
+        else:
+            self._lock = None
+            self._mutex = _NO_LOCK
+            self._local = None
+            self._contexts = []
+
+    def __getstate__(self):
+        # locks and thread local state cannot be pickled, and are recreated when unpickled
+        state = self.__dict__.copy()
+        if self._concurrent:
+            for name in ("_lock", "_mutex", "_local"):
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._concurrent:
+            self._init_concurrency(True)
+        # The chunks, restored before this is called, keep their serials, which key the
+        # indices; in a new process chunks learned later must not be given them again.
+        Chunk._name_counter = max([Chunk._name_counter]
+                                  + [c._serial + 1 for c in self.values()])
 
     def __repr__(self):
         return f"<Memory {dict(self.values())}>"
@@ -116,20 +309,53 @@ class Memory(dict):
     def __str__(self):
         return f"<Memory {id(self)}>"
 
-    def reset(self, optimized_learning=None):
+    @_writes
+    def reset(self, optimized_learning=None, recent_references=None):
         """Deletes all the Memory's chunks and resets its time to zero.
         If *optimized_learning* is not None it sets the Memory's :attr:`optimized_learning`
-        parameter; otherwise it leaves it unchanged. This Memory's :attr:`noise`,
-        :attr:`decay`, :attr:`temperature`, :attr:`threshold` and :attr:`mismatch`
-        parameters are left unchanged.
+        parameter, and if *recent_references* is not None its :attr:`recent_references`
+        parameter; otherwise they are left unchanged. The latter may be a positive
+        integer, or ``False`` or zero to stop using the hybrid form of optimized learning;
+        any other value raises a :exc:`ValueError`. Enabling either form of optimized
+        learning disables the other, and enabling both at once raises a
+        :exc:`ValueError`. This Memory's :attr:`noise`, :attr:`decay`,
+        :attr:`temperature`, :attr:`threshold` and :attr:`mismatch` parameters are left
+        unchanged.
         """
-        if optimized_learning and self._decay >= 1:
+        if recent_references is not None:
+            if (isinstance(recent_references, bool) and recent_references
+                    or not isinstance(recent_references, numbers.Integral)
+                    or recent_references < 0):
+                raise ValueError(f"The recent_references parameter, {recent_references}, must be a positive integer, or False")
+            if recent_references and optimized_learning:
+                raise ValueError("Optimized learning and its hybrid form, recent_references, cannot both be enabled")
+        if (optimized_learning or recent_references) and self._decay >= 1:
             raise RuntimeError(f"Optimized learning cannot be enabled if the decay, {self._decay}, is not less than 1")
         self.clear()
+        self._base_cache.clear()
+        self._spreading_cache.clear()
+        self._version += 1
+        self._spreading = {}
+        self._schemas = {}
+        self._index = {}
+        self._slot_index = {}
+        self._fan_index = {}
         self._time = 0
+        self._last_compaction = 0
         if optimized_learning is not None:
             self._optimized_learning = bool(optimized_learning)
+            if optimized_learning:
+                self._recent_references = None
+        if recent_references is not None:
+            self._recent_references = int(recent_references) or None
+            if recent_references:
+                self._optimized_learning = False
+        if self._columnar:
+            self._engine = _ColumnarEngine(self._optimized_learning, self._recent_references)
+        else:
+            self._engine = None
 
+    @_writes
     def advance(self, amount=1):
         """Adds the given *amount* to this Memory's time, and returns the new, current time.
         Raises a :exc:`ValueError` if *amount* is negative, or not a real number.
@@ -137,8 +363,21 @@ class Memory(dict):
         if amount < 0:
             raise ValueError(f"Time cannot be advanced backward ({amount})")
         self._time += amount
+        self._compact_as_needed()
         return self._time
 
+    def _compact_as_needed(self):
+        # Applies the retention policy once time has moved on. When compacting only
+        # because max_chunks has been exceeded, chunks are evicted down to a fraction of
+        # it, so that the cost of a compaction is not paid again at every advance. The
+        # fraction is rounded up, so a small max_chunks is not undercut; the tolerance
+        # keeps, say, 70 * 0.9 from rounding up to 64.
+        if self._compaction_interval is not None:
+            if self._time - self._last_compaction >= self._compaction_interval:
+                self.compact()
+        elif self._max_chunks is not None and len(self) > self._max_chunks:
+            self._compact(math.ceil(self._max_chunks * COMPACTION_LOW_WATER - 1e-9))
+
     @property
     def time(self):
         """This Memory's current time.
@@ -160,6 +399,7 @@ class Memory(dict):
         return self._noise
 
     @noise.setter
+    @_writes
     def noise(self, value):
         if value < 0:
             raise ValueError(f"The noise, {value}, must not be negative")
@@ -179,22 +419,31 @@ class Memory(dict):
         The :attr:`decay` is typically between about 0.1 and 2.0.
         The default value is 0.5. If zero memory does not decay.
         Attempting to set it to a negative number raises a :exc:`ValueError`.
-        It must be less one 1 if this memory's :attr:`optimized_learning` parameter is set.
+        It must be less one 1 if this memory's :attr:`optimized_learning` or
+        :attr:`recent_references` parameter is set.
         """
         return self._decay
 
     @decay.setter
+    @_writes
     def decay(self, value):
         if value < 0:
             raise ValueError(f"The decay, {value}, must not be negative")
         if value < 1:
             self._ln_1_mius_d = math.log(1 - value)
-        elif self._optimized_learning:
+        elif self._optimized_learning or self._recent_references:
             self._ln_1_mius_d = "illegal value" # ensure error it attempt to use this
-            raise ValueError(f"The decay, {value}, must be less than one if optimized_learning is True")
+            raise ValueError(f"The decay, {value}, must be less than one if optimized_learning or recent_references is set")
         self._expt_cache = [None]*TRANSCENDENTAL_CACHE_SIZE
         self._ln_cache = [None]*TRANSCENDENTAL_CACHE_SIZE
         self._decay = value
+        self._clear_base_activations()
+
+    def _clear_base_activations(self):
+        # Forgets all memoized base activations, which depend upon the decay.
+        self._base_cache.clear()
+        if self._engine is not None:
+            self._engine.clear_base_activations()
 
     @property
     def temperature(self):
@@ -209,6 +458,7 @@ class Memory(dict):
     _SQRT_2 = math.sqrt(2)
 
     @temperature.setter
+    @_writes
     def temperature(self, value):
         if value is None or value is False:
             value = None
@@ -245,6 +495,7 @@ class Memory(dict):
             return self._threshold
 
     @threshold.setter
+    @_writes
     def threshold(self, value):
         if value is None or value is False:
             self._threshold = -sys.float_info.max
@@ -265,6 +516,7 @@ class Memory(dict):
         return self._mismatch
 
     @mismatch.setter
+    @_writes
     def mismatch(self, value):
         if value is None or value is False:
             self._mismatch = None
@@ -281,15 +533,22 @@ class Memory(dict):
         also collected for blending operations.
         The details collected are presented as dictionaries.
         The ``references`` entries in these dictionaries are sequences of times the
-        corresponding chunks were learned, if :attr:`optimizied_learning` is off, and
-        otherwise are counts of the number of times they have been learned.
+        corresponding chunks were learned, if :attr:`optimizied_learning` is off, are
+        pairs of the count of the number of times they have been learned and a sequence of
+        the most recent times, if it is an integer, and otherwise are counts of the number
+        of times they have been learned.
 
         If PyACTUp is being using in a loop, the details collected will likely become
         voluminous. It is usually best to clear them frequently, such as on each
-        iteration.
+        iteration. Alternatively an :class:`ActivationTrace` can be used, which records
+        the numeric quantities only, into a bounded buffer of NumPy arrays, at a much
+        lower cost, or a :class:`HistoryExporter`, which writes the details to a file
+        as they are collected.
 
-        Attempting to set :attr:`activation_history` to anything but ``None`` or a
-        :class:`MutableSequence` raises a :exc:`ValueError`.
+        The entries for an operation are appended once it is complete. Attempting to
+        set :attr:`activation_history` to anything but ``None``, a
+        :class:`MutableSequence`, an :class:`ActivationTrace` or a
+        :class:`HistoryExporter` raises a :exc:`ValueError`.
 
         >>> m = Memory()
         >>> m.learn(color="red", size=3)
@@ -324,14 +583,15 @@ class Memory(dict):
         return self._activation_history
 
     @activation_history.setter
+    @_writes
     def activation_history(self, value):
         if value is None or value is False:
             self._activation_history = None
-        elif isinstance(value, abc.MutableSequence):
+        elif isinstance(value, (abc.MutableSequence, ActivationTrace, HistoryExporter)):
             self._activation_history = value
         else:
             raise ValueError(
-                f"A value assigned to activation_history must be a MutableSequence ({value}).")
+                f"A value assigned to activation_history must be a MutableSequence, an ActivationTrace or a HistoryExporter ({value}).")
 
     @property
     def optimized_learning(self):
@@ -341,19 +601,232 @@ class Memory(dict):
         """
         return self._optimized_learning
 
+    @property
+    def recent_references(self):
+        """The number of most recent references to each chunk retained by the hybrid form of optimized learning.
+        ``None`` if it is not in use. Cannot be set directly, but can be changed when
+        calling :meth:`reset`.
+        """
+        return self._recent_references
+
+    @property
+    def max_chunks(self):
+        """The maximum number of chunks this Memory retains when it is compacted.
+        If ``None``, the default, there is no maximum. When the Memory is compacted, by
+        :meth:`compact`, if it has more chunks than this the weakest of them, those with the
+        lowest base activation plus importance, are evicted until it does not. Unless a
+        :attr:`compaction_interval` is set the Memory is compacted whenever time is
+        advanced while it has more than this many chunks, and then, so that this is not
+        done again at every advance, down to 90% of this many, rounded up; so a Memory
+        with a :attr:`max_chunks` of less than ten is compacted down to just this many.
+        Attempting to set it to anything but ``None`` or a non-negative integer raises a
+        :exc:`ValueError`.
+        """
+        return self._max_chunks
+
+    @max_chunks.setter
+    @_writes
+    def max_chunks(self, value):
+        if value is not None and (not isinstance(value, numbers.Integral) or value < 0):
+            raise ValueError(f"The max_chunks, {value}, must be None or a non-negative integer")
+        self._max_chunks = value
+
+    @property
+    def activation_floor(self):
+        """The activation below which chunks are evicted when this Memory is compacted.
+        If ``None``, the default, chunks are not evicted for being weak. Otherwise
+        :meth:`compact` evicts all the chunks whose base activation plus importance is
+        less than it. As noise, spreading activation and partial matching can each only
+        raise a chunk's activation by so much, setting this well below the
+        :attr:`threshold` evicts only chunks that can no longer plausibly be retrieved.
+        """
+        return self._activation_floor
+
+    @activation_floor.setter
+    @_writes
+    def activation_floor(self, value):
+        self._activation_floor = None if value is None else float(value)
+
+    @property
+    def compaction_interval(self):
+        """The amount of time between automatic compactions of this Memory.
+        If not ``None`` :meth:`compact` is called by :meth:`advance` whenever at least this
+        much time has passed since the Memory was last compacted. If ``None``, the
+        default, it is only called automatically when :attr:`max_chunks` is exceeded.
+        Attempting to set it to anything but ``None`` or a positive real number raises a
+        :exc:`ValueError`.
+        """
+        return self._compaction_interval
+
+    @compaction_interval.setter
+    @_writes
+    def compaction_interval(self, value):
+        if value is not None and not (isinstance(value, numbers.Real) and value > 0):
+            raise ValueError(f"The compaction_interval, {value}, must be None or a positive number")
+        self._compaction_interval = value
+
+    @property
+    def on_evict(self):
+        """A callable called with a list of the chunks evicted whenever this Memory is compacted, or ``None``.
+        It can be used, for example, to archive them elsewhere. The chunks are no longer in
+        the Memory when it is called, but their attributes can still be read.
+        """
+        return self._on_evict
+
+    @on_evict.setter
+    @_writes
+    def on_evict(self, value):
+        if value is not None and not callable(value):
+            raise ValueError(f"The on_evict value, {value}, must be None or callable")
+        self._on_evict = value
+
+    @_writes
+    def compact(self):
+        """Evicts the chunks this Memory's retention policy no longer retains, returning a list of them.
+        Those whose base activation plus importance is below :attr:`activation_floor` are
+        evicted, and then, if more than :attr:`max_chunks` remain, the weakest of them, ties
+        going to the least recently created, until no more do. Chunks created at the
+        current time have no base activation yet, and are never evicted. If any are
+        evicted, and :attr:`on_evict` is set, it is called with the list of them. It is
+        usually called automatically by :meth:`advance` and :meth:`learn_many`, but may
+        also be called directly.
+
+        >>> m = Memory(noise=0, temperature=1, max_chunks=2)
+        >>> for size in range(4):
+        ...     m.learn(size=size)
+        ...     m.advance()
+        True
+        1
+        True
+        2
+        True
+        3
+        True
+        4
+        >>> len(m)
+        2
+        """
+        return self._compact(self._max_chunks)
+
+    def _compact(self, limit):
+        # Evicts as compact() does, but keeping at most limit chunks.
+        self._last_compaction = self._time
+        floor = self._activation_floor
+        if floor is None and (limit is None or len(self) <= limit):
+            return []
+        chunks = [c for c in self.values() if c._creation < self._time]
+        if not chunks:
+            return []
+        if self._engine is not None:
+            importance = self._engine.importance[self._engine.rows(chunks)]
+        else:
+            importance = np.fromiter((c._importance for c in chunks), float, len(chunks))
+        strength = self._base_activations(chunks) + importance
+        evict = np.zeros(len(chunks), bool)
+        if floor is not None:
+            evict |= strength < floor
+        if limit is not None:
+            excess = len(self) - int(evict.sum()) - limit
+            if excess > 0:
+                weakest = np.argsort(strength, kind="stable")
+                evict[weakest[~evict[weakest]][:excess]] = True
+        evicted = [chunks[i] for i in np.flatnonzero(evict)]
+        for chunk in evicted:
+            self._remove_chunk(chunk)
+        if self._engine is not None:
+            self._engine.reclaim()
+        if evicted and self._on_evict is not None:
+            self._on_evict(evicted)
+        return evicted
+
+    @property
+    def rng(self):
+        """The :class:`numpy.random.Generator` from which this Memory draws its activation noise and random importances.
+        It is created from the *seed* passed when creating the Memory.
+        """
+        return self._rng
+
+    @property
+    def concurrent(self):
+        """Whether or not this Memory may be shared by several threads.
+        It is set when the Memory is created, and cannot be changed.
+        """
+        return self._concurrent
+
+    @contextlib.contextmanager
+    def writing(self):
+        """Returns a context manager within which the calling thread alone uses this Memory, if it is :attr:`concurrent`.
+        Reads by other threads wait until it is left, so that a sequence of modifications,
+        typically learning some chunks and then advancing the time, is seen by them as a
+        whole, as reads of a Memory containing chunks created at the current time fail.
+        If the Memory is not concurrent it does nothing.
+
+        >>> m = Memory(concurrent=True)
+        >>> with m.writing():
+        ...     m.learn(color="red")
+        ...     m.advance()
+        True
+        1
+        """
+        lock = self._lock
+        if lock is None:
+            yield self
+            return
+        lock.acquire_write()
+        try:
+            yield self
+        finally:
+            lock.release_write()
+
+    @property
+    def columnar(self):
+        """A boolean indicating whether or not this Memory stores its chunks' references in NumPy arrays.
+        Cannot be changed once the Memory has been created.
+        """
+        return self._columnar
+
     _use_actr_similarity = False
     _minimum_similarity = 0
     _maximum_similarity = 1
     _similarity_functions = {}
 
+    _similarity_matrices = {}
+
     def _similarity(self, x, y, attribute):
         if x == y:
             return 0
-        fn = self._similarity_functions.get(attribute)
-        if fn:
-            result = fn(x, y)
+        try:
+            hash((x, y))
+        except TypeError:
+            # unhashable values cannot be memoized
+            result = Memory._clamped_similarity.__wrapped__(attribute, x, y)
         else:
-            result = None
+            result = Memory._clamped_similarity(attribute, x, y)
+        if result is not None:
+            if not Memory._use_actr_similarity:
+                result -= 1
+            return result
+        else:
+            return -1
+
+    @staticmethod
+    @functools.lru_cache(maxsize=SIMILARITY_CACHE_SIZE, typed=True)
+    def _clamped_similarity(attribute, x, y):
+        # The similarity of x and y as given by the matrix or function assigned to
+        # attribute, clamped to the allowed range, or None if there is none. Memoized, so
+        # the cache must be cleared whenever the matrices, functions or range change.
+        entry = Memory._similarity_matrices.get(attribute)
+        if entry is not None:
+            index, matrix = entry
+            try:
+                i = index.get(x)
+                j = index.get(y)
+            except TypeError:
+                i = j = None
+            result = float(matrix[i, j]) if i is not None and j is not None else None
+        else:
+            fn = Memory._similarity_functions.get(attribute)
+            result = fn(x, y) if fn else None
         if result is not None:
             if result < Memory._minimum_similarity:
                 warn(f"similarity value is less than the minimum allowed, {Memory._minimum_similarity}, so that minimum value is being used instead")
@@ -361,18 +834,47 @@ class Memory(dict):
             elif result > Memory._maximum_similarity:
                 warn(f"similarity value is greater than the maximum allowed, {Memory._maximum_similarity}, so that maximum value is being used instead")
                 result = Memory._maximum_similarity
-            if not Memory._use_actr_similarity:
-                result -= 1
-            return result
-        else:
-            return -1
+        return result
+
+    def _similarities(self, x, ys, attribute):
+        # A NumPy array of the values _similarity(x, y, attribute) would return for each of
+        # the sequence ys. When a matrix has been assigned to attribute and x is in its
+        # domain these are looked up together, and only the ys outside the domain, if any,
+        # are computed one at a time.
+        entry = Memory._similarity_matrices.get(attribute)
+        if entry is not None:
+            index, matrix = entry
+            try:
+                i = index.get(x)
+                columns = np.fromiter((index.get(y, -1) for y in ys), np.intp, len(ys))
+            except TypeError:
+                i = None
+            if i is not None:
+                # warned about once for the whole row, as _clamped_similarity would for
+                # each pair, leaving out x itself, which is never looked up
+                looked_up = matrix[i, columns[(columns >= 0) & (columns != i)]]
+                if looked_up.size:
+                    if looked_up.min() < Memory._minimum_similarity:
+                        warn(f"similarity value is less than the minimum allowed, {Memory._minimum_similarity}, so that minimum value is being used instead")
+                    if looked_up.max() > Memory._maximum_similarity:
+                        warn(f"similarity value is greater than the maximum allowed, {Memory._maximum_similarity}, so that maximum value is being used instead")
+                row = np.clip(matrix[i], Memory._minimum_similarity, Memory._maximum_similarity)
+                if not Memory._use_actr_similarity:
+                    row -= 1
+                row[i] = 0
+                result = row[columns]
+                for k in np.flatnonzero(columns < 0).tolist():
+                    result[k] = self._similarity(x, ys[k], attribute)
+                return result
+        return np.fromiter((self._similarity(x, y, attribute) for y in ys), float, len(ys))
 
     @property
     def source_activation(self):
         """The W, default to be 1"""
-        return self._W
+        return self._source_activation
 
     @source_activation.setter
+    @_writes
     def source_activation(self, value):
         if value is None or value is False:
             self._source_activation = None
@@ -387,6 +889,7 @@ class Memory(dict):
         return self._max_associative_strength
 
     @max_associative_strength.setter
+    @_writes
     def max_associative_strength(self, value):
         if value is None or value is False:
             self._max_associative_strength = None
@@ -396,6 +899,7 @@ class Memory(dict):
             self._max_associative_strength = float(value)
 
     """Modified: add a parameter importance"""
+    @_writes
     def learn(self, importance=0, **kwargs):
         """Adds, or reinforces, a chunk in this Memory with the attributes specified by *kwargs*.
         The attributes, or slots, of a chunk are described using Python keyword arguments.
@@ -427,19 +931,123 @@ class Memory(dict):
         if not kwargs:
             raise ValueError(f"No attributes to learn")
         created = False
-        signature = tuple(sorted(kwargs.items()))
+        schema, values, signature = self._signature(kwargs)
         chunk = self.get(signature)
-        if not chunk:
-            chunk = Chunk(self, kwargs)
+        if chunk is None:
+            chunk = Chunk(self, schema, values)
             self[signature] = chunk
+            self._index_chunk(chunk)
+            if self._engine is not None:
+                self._engine.add_chunk(chunk)
             created = True
             chunk.importance = importance  # set importance
-        if self._optimized_learning:
-            chunk._references += 1
+        chunk._add_reference(self._time)
+        return created
+
+    @_writes
+    def learn_many(self, records, times=None, importance=0):
+        """Learns many chunks at once, as though by calling :meth:`learn` for each of *records*, returning the number of new chunks created.
+        Each of the *records* is a mapping of attribute names to values, as would be passed
+        as the keyword arguments of :meth:`learn`; alternatively *records* may be a NumPy
+        structured or record array, whose field names are the attribute names.
+
+        If *times* is supplied it is a sequence of the times at which each of the
+        *records* is to be learned, and otherwise they are all learned at the current
+        time. A chunk first learned by this call is considered to have been created at the
+        earliest time at which it is learned. If any of the *times* is later than this
+        Memory's current time its time is set to the latest of them, and its retention
+        policy applied as by :meth:`advance`. As with
+        :meth:`learn`, time must be advanced before retrieving chunks learned at the
+        current time.
+
+        The *importance* is used for new chunks, as by :meth:`learn`, and may be a
+        single value, or a sequence of values for each of the *records*, of which the
+        value for the first record creating a chunk is used.
+
+        The records are grouped by the chunks they describe in a single pass, each chunk
+        is created at most once, and all its references are added together, which is much
+        faster than calling :meth:`learn` repeatedly, and calling :meth:`advance` between.
+        Raises a :exc:`ValueError` if *times* or a sequence of *importance* values is not
+        of the same length as *records*, or if any of the *records* is empty.
+
+        >>> m = Memory()
+        >>> m.learn_many([dict(color="red", size=4), dict(color="blue", size=4),
+        ...               dict(color="red", size=4)],
+        ...              times=[0, 1, 3])
+        2
+        >>> m.time
+        3
+        >>> m.advance()
+        4
+        >>> m.retrieve(color="red")
+        <Chunk 0000 {'color': 'red', 'size': 4}>
+        """
+        names = getattr(getattr(records, "dtype", None), "names", None)
+        if names:
+            schema = self._schemas.get(names)
+            if schema is None:
+                schema = self._schemas[names] = _Schema(names)
+            rows = ((schema, values, (schema.key, schema.ordered(values)))
+                    for values in records.tolist())
+            n = len(records)
+        else:
+            records = list(records)
+            for r in records:
+                if not r:
+                    raise ValueError(f"No attributes to learn")
+            rows = map(self._signature, records)
+            n = len(records)
+        if times is None:
+            times = itertools.repeat(self._time, n)
         else:
-            chunk._references.append(self._time)
+            times = times.tolist() if isinstance(times, np.ndarray) else list(times)
+            if len(times) != n:
+                raise ValueError(f"There are {len(times)} times for {n} records")
+        if isinstance(importance, (abc.Sequence, np.ndarray)):
+            if len(importance) != n:
+                raise ValueError(f"There are {len(importance)} importance values for {n} records")
+        else:
+            importance = itertools.repeat(importance, n)
+        # As in restore(), the many objects created can provoke fruitless collections.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            now = self._time
+            created = self._learn_groups(rows, times, importance)
+        finally:
+            if enabled:
+                gc.enable()
+        if self._time != now:
+            self._compact_as_needed()
+        return created
+
+    def _learn_groups(self, rows, times, importance):
+        groups = {}
+        for (schema, values, signature), when, weight in zip(rows, times, importance):
+            group = groups.get(signature)
+            if group is None:
+                groups[signature] = (schema, values, weight, [when])
+            else:
+                group[3].append(when)
+        created = 0
+        latest = self._time
+        for signature, (schema, values, weight, references) in groups.items():
+            chunk = self.get(signature)
+            if chunk is None:
+                chunk = Chunk(self, schema, values)
+                chunk._creation = min(references)
+                self[signature] = chunk
+                self._index_chunk(chunk)
+                if self._engine is not None:
+                    self._engine.add_chunk(chunk)
+                chunk.importance = weight
+                created += 1
+            chunk._add_references(references)
+            latest = max(latest, max(references))
+        self._time = latest
         return created
 
+    @_writes
     def forget(self, when, **kwargs):
         """Undoes the operation of a previous call to :meth:`learn`.
 
@@ -454,21 +1062,111 @@ class Memory(dict):
         """
         if not kwargs:
             raise ValueError(f"No attributes to forget")
-        signature = tuple(sorted(kwargs.items()))
+        signature = self._signature(kwargs)[2]
         chunk = self.get(signature)
-        if not chunk:
+        if chunk is None:
+            return False
+        if not chunk._remove_reference(when):
             return False
-        if self._optimized_learning:
-            chunk._references -= 1
-        else:
-            try:
-                chunk._references.remove(when)
-            except ValueError:
-                return False
         if not chunk._references:
-            del self[signature]
+            self._remove_chunk(chunk, signature)
         return True
+
+    def _remove_chunk(self, chunk, signature=None):
+        if signature is None:
+            signature = (chunk._schema.key, chunk._schema.ordered(chunk._values))
+        del self[signature]
+        self._unindex_chunk(chunk)
+        self._base_cache.invalidate(chunk._serial)
+        self._spreading.pop(chunk._serial, None)
+        if self._engine is not None:
+            self._engine.remove_chunk(chunk)
+
+    def _signature(self, kwargs):
+        # Returns the schema of the attributes in kwargs, the tuple of their values, and
+        # the key under which the chunk having them is stored in this Memory, which does
+        # not depend upon the order in which they are given. Schemas are interned, so all
+        # the chunks with the same attribute names in the same order share one.
+        names = tuple(kwargs)
+        schema = self._schemas.get(names)
+        if schema is None:
+            schema = self._schemas[names] = _Schema(names)
+        values = tuple(kwargs.values())
+        return schema, values, (schema.key, schema.ordered(values))
+
+    # The inverted indices map (slot, value) pairs, bare slot names, and bare values
+    # regardless of the slot they occupy, to the chunks containing them. Each posting is a
+    # dict keyed by the chunk's serial number, so iterating over one visits its chunks in
+    # the order they were created, which is also the order in which they appear in the
+    # Memory itself. The length of a posting in the _fan_index is the number of chunks
+    # a value appears in, so fan(j) is just one more than that.
+
+    # Indexing or unindexing a chunk also bumps the Memory's version, which identifies the
+    # set of chunks it contains, and so the fans on which spreading activation depends.
+
+    def _index_chunk(self, chunk):
+        self._version += 1
+        serial = chunk._serial
+        for slot, value in chunk._items():
+            self._index.setdefault((slot, value), {})[serial] = chunk
+            self._slot_index.setdefault(slot, {})[serial] = chunk
+            self._fan_index.setdefault(value, {})[serial] = chunk
+
+    def _unindex_chunk(self, chunk):
+        self._version += 1
+        serial = chunk._serial
+        for slot, value in chunk._items():
+            for index, key in ((self._index, (slot, value)),
+                               (self._slot_index, slot),
+                               (self._fan_index, value)):
+                posting = index.get(key)
+                if posting is None:
+                    continue        # a value occurring in several slots is only indexed once
+                posting.pop(serial, None)
+                if not posting:
+                    del index[key]
+
+    def _candidates(self, conditions, partial=False):
+        # Returns a list of the chunks that contain all the slots named in conditions
+        # and, unless partial is true, whose values for them are equal to those in
+        # conditions, in the same order as the Memory's values(). Unhashable condition
+        # values, and those not equal to themselves, such as NaN, cannot be looked up in
+        # the index, so only their slot is used to narrow the candidates, and the values
+        # are then compared chunk by chunk.
+        if not conditions:
+            return list(self.values())
+        postings = []
+        unresolved = []
+        for slot, value in conditions.items():
+            posting = None
+            if not partial:
+                try:
+                    posting = self._index.get((slot, value))
+                except TypeError:
+                    unresolved.append((slot, value))
+                else:
+                    if value != value:
+                        unresolved.append((slot, value))
+                    elif posting is None:
+                        return []
+            if posting is None:
+                posting = self._slot_index.get(slot)
+                if posting is None:
+                    return []
+            postings.append(posting)
+        postings.sort(key=len)
+        smallest = postings[0]
+        others = postings[1:]
+        if not others:
+            result = list(smallest.values())
+        else:
+            result = [chunk for serial, chunk in smallest.items()
+                      if all(serial in p for p in others)]
+        if unresolved:
+            result = [c for c in result if all(c[s] == v for s, v in unresolved)]
+        return result
     
+    @_reads
     def retrieve(self, partial=False, **kwargs):
         """Returns the chunk matching the *kwargs* that has the highest activation greater than this Memory's :attr:`threshold`.
         If there is no such matching chunk returns ``None``.
@@ -480,6 +1178,18 @@ class Memory(dict):
         The returned chunk is a dictionary-like object, and its attributes can be
         extracted with Python's usual subscript notation.
 
+        Unless :attr:`activation_history` is being collected, the base activations of
+        chunks that cannot be retrieved are not computed. The noise of every matching
+        chunk is drawn first, and a chunk is skipped only if its base activation as last
+        computed, which its current base activation cannot exceed as it has not been
+        learned since, together with its noise, importance, spreading activation and
+        mismatch penalty, is below the :attr:`threshold` or the activation of a chunk
+        actually computed. This holds for the hybrid form of optimized learning, with
+        :attr:`recent_references`, too: Petrov's approximation of the earlier references
+        is the mean of age ** -decay over ages spanning a fixed width, which all grow, so
+        it cannot increase either. So the chunk returned, and the state of the Memory's
+        :attr:`rng`, are exactly as they would be were every activation computed.
+
         >>> m = Memory()
         >>> m.learn(widget="thromdibulator", color="red", size=2)
         True
@@ -502,84 +1212,439 @@ class Memory(dict):
         # Returns a single chunk matching the given slots and values, that has the
         # highest activation greater than the threshold parameter. If there are no
         # such chunks returns None.
-        best_chunk = None
-        best_activation = self._threshold
-        for chunk in self.values():
-            if not conditions.keys() <= chunk.keys():
-                continue
-            for key, value in conditions.items():
-                if chunk[key] != value:
-                    break
-            else:   # this matches the for, NOT the if
-                a = chunk._activation()
-                if a >= best_activation:
-                    best_chunk = chunk
-                    best_activation = a
-        return best_chunk
-
-    def _make_noise(self):
+        return self._retrieve(conditions, exact=True)
+
+    def _retrieve(self, conditions, exact):
+        # Retrieves the most active chunk matching conditions, as _activations would
+        # match them, pruning those that cannot be it, unless the activation_history
+        # needs them all.
+        if self._activation_history is not None:
+            group = self._activations(conditions, exact)
+            self._record_history([group])
+            return self._best(*group[:2])
+        partial = not exact and self._mismatch is not None
+        chunks = self._candidates(conditions, partial)
+        if not chunks:
+            return None
+        return self._best(chunks, self._pruned_activations(chunks,
+                                                           conditions if partial else None))
+
+    def _pruned_activations(self, chunks, conditions=None):
+        # Returns the activations of chunks, as _compute_activations would, except that
+        # those of chunks that cannot be the most active one at or above the threshold
+        # are -inf, and their base activations are not computed. All the other terms,
+        # including the noise, are computed first, so that the same noise is drawn, and
+        # the same chunk is retrieved, as without pruning. A chunk can then be skipped if
+        # an upper bound on its base activation plus those terms is below the threshold,
+        # or below the actual activation of another chunk.
+        n = len(chunks)
+        noise, spreading, importance = self._activation_terms(chunks)
+        mismatch = self._mismatches(chunks, conditions)
+        others = spreading + importance + noise
+        if mismatch is not None:
+            others += mismatch
+        upper = self._base_activation_bounds(chunks) + others
+        result = np.full(n, -np.inf)
+        todo = np.flatnonzero(upper >= self._threshold)
+        if not len(todo):
+            return result
+        def evaluate(indices):
+            base = self._base_activations([chunks[i] for i in indices])
+            # summed in the same order as in _compute_activations, to the same result
+            a = base + spreading[indices] + importance[indices] + noise[indices]
+            if mismatch is not None:
+                a = a + mismatch[indices]
+            result[indices] = a
+        # first those without a bound, which must be computed anyway, and the one with
+        # the highest bound, which is most likely to be the most active
+        first = np.isinf(upper[todo])
+        first[np.argmax(upper[todo])] = True
+        evaluate(todo[first])
+        best = max(self._threshold, result[todo[first]].max())
+        rest = todo[~first]
+        rest = rest[upper[rest] >= best]
+        if len(rest):
+            evaluate(rest)
+        return result
+
+    def _base_activation_bounds(self, chunks):
+        # Returns upper bounds on the current base activations of chunks: each is the
+        # most recently memoized base activation of the chunk at or before the current
+        # time, as none of them can have been referenced since, and base activation only
+        # decays, under hybrid optimized learning too, as the approximated references keep
+        # a fixed span of ages that only grow; slightly increased to allow for rounding;
+        # or infinity if none is known.
+        time = self._time
+        if self._engine is not None:
+            rows = self._engine.rows(chunks)
+            with np.errstate(invalid="ignore"):
+                known = self._engine.cached_time[rows] <= time
+            bounds = np.where(known, self._engine.cached_base[rows], np.inf)
+        else:
+            cache = self._base_cache
+            bounds = np.fromiter((cache.bound(c._serial, time) for c in chunks), float,
+                                 len(chunks))
+        return bounds + PRUNING_SLACK * (1 + np.abs(bounds))
+
+    def _best(self, chunks, activations):
+        if not chunks:
+            return None
+        # ties go to the chunk learned most recently, as they always have
+        i = len(chunks) - 1 - int(np.argmax(activations[::-1]))
+        if activations[i] >= self._threshold:
+            return chunks[i]
+        return None
+
+    def _make_noise(self, n):
+        # Returns the activation noise for n chunks, drawn in a single batch from the
+        # logistic distribution with scale noise.
         if not self._noise:
-            return 0
-        p = random.uniform(sys.float_info.epsilon, 1 - sys.float_info.epsilon)
-        return self._noise * math.log((1.0 - p) / p)
+            return np.zeros(n)
+        return self._rng.logistic(0.0, self._noise, n)
+
+    def _base_activations(self, chunks):
+        if self._engine is not None:
+            return self._engine.base_activations(self._engine.rows(chunks), self)
+        return np.fromiter((c._get_base_activation() for c in chunks), float, len(chunks))
+
+    def _compute_activations(self, chunks, conditions=None, base=None):
+        # Computes the activations of all the chunks, a sequence, in one batched pass,
+        # returning a NumPy array of them and a _HistoryBatch of the quantities from
+        # which they were computed, or None if activation_history is off. If conditions
+        # is not None the chunks' mismatch penalties relative to it are included. The
+        # chunks' base activations may be supplied if they have already been computed.
+        if base is None:
+            base = self._base_activations(chunks)
+        noise, spreading, importance = self._activation_terms(chunks)
+        result = base + spreading + importance + noise
+        mismatch = self._mismatches(chunks, conditions)
+        if mismatch is not None:
+            result = result + mismatch
+        if self._activation_history is None:
+            return result, None
+        return result, _HistoryBatch(chunks, self._time, base, noise, spreading, importance,
+                                     mismatch, result)
+
+    def _activation_terms(self, chunks):
+        # The noise, spreading activations and importances of chunks, as NumPy arrays.
+        n = len(chunks)
+        noise = self._make_noise(n)
+        values = self._active_spreading()
+        if values:
+            get = values.get
+            spreading = np.fromiter((get(c._serial, 0) for c in chunks), float, n)
+        else:
+            spreading = np.zeros(n)
+        if self._engine is not None:
+            importance = self._engine.importance[self._engine.rows(chunks)]
+        else:
+            importance = np.fromiter((c._importance for c in chunks), float, n)
+        return noise, spreading, importance
+
+    def _mismatches(self, chunks, conditions):
+        # The mismatch penalties of chunks relative to conditions, or None if it is None.
+        if conditions is None:
+            return None
+        similarity = np.zeros(len(chunks))
+        for s, v in conditions.items():
+            similarity += self._similarities(v, [c[s] for c in chunks], s)
+        return self._mismatch * similarity
+
+    def _record_history(self, groups):
+        # Records in activation_history the computations of an operation that has
+        # completed, groups being the (chunks, activations, batch) triples it used.
+        batches = [batch for chunks, activations, batch in groups if batch is not None]
+        if not batches:
+            return
+        history = self._activation_history
+        if isinstance(history, HistoryExporter):
+            # it numbers the operations itself, and may wait for room in its queue, which
+            # must not hold up other threads recording history
+            history._record(batches)
+            return
+        with self._mutex:
+            if isinstance(history, ActivationTrace):
+                history._record(batches)
+            else:
+                for batch in batches:
+                    history.extend(batch.records())
     
     # New function for spreading activation
+    @_writes
     def spread(self, auto_clear=False, **kwargs):
         """ This new method will reformat kwargs to sources, add spreading activation 
         to chunks. By default, the spreading activation value is None. 
         Everytime spread() is called, new value will be added to the chunk cumulatively. 
+        Only chunks containing at least one of the source values receive activation, and
+        these are found through an index maintained by learn() and forget(), so the cost
+        of spreading does not depend upon the number of chunks that do not match.
         If call clear_spread(), spreading activation will be set to None.
+        The spreading activations are held by the Memory, in a single mapping from chunks
+        to values, rather than by the chunks themselves, so clearing them takes constant
+        time; see also :meth:`context`.
         By defualt, PyACTUP uses fan function to calculate sji. The equation used is: 
             spreading activation = sum(wj * sji)
                 wj = W/n;
                 sji = S-ln(fan);
         Any defined sji functions (see :func:`set_sji_function`) are called as necessary
+
+        To spread activation from several buffers at once, each with its own W, see
+        :meth:`spread_buffers`, which can also spread from a slot named ``auto_clear``.
+
+        The spreading activations computed for a set of sources are remembered, in a
+        least recently used cache of :attr:`spreading_cache_size` entries, until a chunk is
+        added to or removed from the Memory, or a parameter or function they depend upon
+        changes, so spreading from a recurring context costs only the time to apply them
+        to the chunks affected. See :meth:`spreading_cache_info`.
         """
-        if not kwargs:
-            raise ValueError(f"No attributes to spread")
+        self._spread(self._spreading_buffers(kwargs, None, None), auto_clear)
+
+    @_writes
+    def spread_buffers(self, buffers, weights=None, auto_clear=False):
+        """Spreads activation from several buffers at once, each with its own W.
+        The *buffers* are a dictionary mapping buffer names to the chunks in them, or to
+        any other mappings of slot names to values, or to None for an empty buffer; and
+        *weights*, if supplied, a dictionary mapping some of those names to their W, the
+        others using :attr:`source_activation`. The W of each buffer is divided evenly
+        among its own slots, and the activation spread by all of them is computed
+        together, in a single pass over the chunks containing their values. Otherwise it
+        is as :meth:`spread`, including *auto_clear*, and the cache of spreading
+        activations. Raises a :exc:`ValueError` if a weight is given for a buffer not in
+        *buffers*, or is negative, or if all the buffers are empty.
+
+        >>> m = Memory()
+        >>> m.learn(color="red", size=2)
+        True
+        >>> m.advance()
+        1
+        >>> m.spread_buffers({"goal": {"color": "red"}, "imaginal": {"size": 2}},
+        ...                  weights={"goal": 2, "imaginal": 0.5})
+        """
+        self._spread(self._spreading_buffers(None, buffers, weights), auto_clear)
+
+    def _spread(self, buffers, auto_clear):
         # automatically clear spreading activation value
         if auto_clear:
             self.clear_spread()
-            
-        # iterate through all chunks
-        spreading_activation_vector = self._compute_spreading_activation_vec(kwargs)
-        if spreading_activation_vector is None or len(spreading_activation_vector)!=len(self.values()):
-            raise RuntimeError("Failed to spread.")
-        index_chunk = 0
-        for chunk in self.values():
-            chunk.spreading_activation=spreading_activation_vector[index_chunk]
-            index_chunk=index_chunk+1
-    
+        values = self._cached_spreading_activations(buffers)
+        if not self._spreading:
+            self._spreading = dict(values)
+            return
+        spreading = self._spreading
+        for serial, value in values.items():
+            current = spreading.get(serial)
+            spreading[serial] = current + value if current else value
+
+    def context(self, **kwargs):
+        """Returns a :class:`SpreadingContext` for the sources in *kwargs*, as for :meth:`spread`.
+        While the context is active, within a
+        ``with`` statement, retrievals and blends use the spreading activations it gives
+        in place of those set by :meth:`spread`; entering and leaving it takes constant
+        time. Any number of contexts may exist for one Memory, and they may be nested,
+        the innermost being in effect; in a :attr:`concurrent` Memory each thread has its
+        own. A context's spreading activations follow the
+        chunks the Memory currently contains, being recomputed as necessary if any have
+        been added or removed since they were last used.
+
+        >>> m = Memory(noise=0, temperature=1)
+        >>> m.learn(color="red", size=1)
+        True
+        >>> m.learn(color="blue", size=2)
+        True
+        >>> m.advance()
+        1
+        >>> red = m.context(color="red")
+        >>> with red:
+        ...     m.retrieve()["color"]
+        'red'
+        """
+        return SpreadingContext(self, self._spreading_buffers(kwargs, None, None))
+
+    def context_buffers(self, buffers, weights=None):
+        """Returns a :class:`SpreadingContext` for several buffers, each with its own W.
+        The *buffers* and *weights* are as for :meth:`spread_buffers`, and the context as
+        for :meth:`context`.
+        """
+        return SpreadingContext(self, self._spreading_buffers(None, buffers, weights))
+
+    def _spreading_buffers(self, kwargs, sources, weights):
+        # Returns a tuple of (name, conditions, W) triples, one for each non-empty buffer,
+        # including kwargs as the buffer named None, a W of None standing for the current
+        # source_activation.
+        result = []
+        if kwargs:
+            result.append((None, dict(kwargs), None))
+        weights = dict(weights or {})
+        for name in weights:
+            if not sources or name not in sources:
+                raise ValueError(f"There is no source named {name!r} to weight")
+            w = weights[name]
+            if not isinstance(w, numbers.Real) or w < 0:
+                raise ValueError(f"The W of source {name!r}, {w}, must be a non-negative real number")
+        for name, chunk in (sources or {}).items():
+            if chunk is None:
+                continue
+            if not isinstance(chunk, abc.Mapping):
+                raise ValueError(f"The source {name!r}, {chunk}, is not a chunk or other mapping")
+            if chunk:
+                w = weights.get(name)
+                result.append((name, dict(chunk.items()), None if w is None else float(w)))
+        if not result:
+            raise ValueError(f"No attributes to spread")
+        return tuple(result)
+
+    def _active_spreading(self):
+        # The mapping from chunk serial numbers to spreading activations in effect: that
+        # of the innermost active context, if any, and otherwise that set by spread().
+        contexts = self._context_stack()
+        if contexts:
+            return contexts[-1]._values()
+        return self._spreading
+
+    def _context_stack(self):
+        # The active contexts, innermost last, which are per thread in a concurrent Memory.
+        local = self._local
+        if local is None:
+            return self._contexts
+        try:
+            return local.contexts
+        except AttributeError:
+            local.contexts = []
+            return local.contexts
+
+    @property
+    def spreading_cache_size(self):
+        """The maximum number of sets of sources whose spreading activations are remembered by :meth:`spread`.
+        It defaults to 128. Setting it to zero turns off caching. Attempting to set it to
+        anything but a non-negative integer raises a :exc:`ValueError`.
+        """
+        return self._spreading_cache_size
+
+    @spreading_cache_size.setter
+    @_writes
+    def spreading_cache_size(self, value):
+        if not isinstance(value, numbers.Integral) or value < 0:
+            raise ValueError(f"The spreading_cache_size, {value}, must be a non-negative integer")
+        self._spreading_cache_size = value
+        while len(self._spreading_cache) > value:
+            self._spreading_cache.popitem(last=False)
+
+    def spreading_cache_info(self):
+        """Returns a named tuple of the *hits*, *misses*, *maxsize* and *currsize* of the cache of spreading activations used by :meth:`spread`.
+        Like :func:`functools.lru_cache`'s ``cache_info()``.
+        """
+        return SpreadingCacheInfo(self._spreading_hits, self._spreading_misses,
+                                  self._spreading_cache_size, len(self._spreading_cache))
+
+    def _cached_spreading_activations(self, buffers):
+        # Like _spreading_activations, but remembering the results, keyed by the sources
+        # and everything else they depend upon. A change to the chunks in the Memory
+        # changes its version, so entries made before become unreachable, and are
+        # eventually discarded as the least recently used. The dictionaries returned are
+        # shared, and must not be modified. In a concurrent Memory the cache is only
+        # touched while holding the mutex, but the values are computed outside it.
+        if not self._spreading_cache_size:
+            return self._spreading_activations(buffers)
+        try:
+            key = (tuple((frozenset(conditions.items()), w) for name, conditions, w in buffers),
+                   self._spreading_state())
+            hash(key)
+        except TypeError:
+            # unhashable source values cannot be cached
+            key = None
+        with self._mutex:
+            result = None if key is None else self._spreading_cache.get(key)
+            if result is not None:
+                self._spreading_hits += 1
+                self._spreading_cache.move_to_end(key)
+                return result
+            self._spreading_misses += 1
+        result = self._spreading_activations(buffers)
+        if key is not None:
+            with self._mutex:
+                self._spreading_cache[key] = result
+                if len(self._spreading_cache) > self._spreading_cache_size:
+                    self._spreading_cache.popitem(last=False)
+        return result
+
+    def _spreading_state(self):
+        # Everything other than the sources upon which spreading activations depend.
+        # The flags are read through the Memory, as _sji() and _matching_source_to_chunk()
+        # do, so that setting them on it alone also takes effect.
+        return (self._version, self._source_activation, self._max_associative_strength,
+                self._use_actr_sji, Memory._sji_function, Memory._sji_sparse,
+                self._use_actr_matching_source_to_chunk,
+                Memory._matching_source_to_chunk_function)
+
     """HELPER Functions"""
+    def _spreading_activations(self, buffers):
+        """Returns a dictionary mapping the serial numbers of those chunks receiving a
+        non-zero spreading activation from the sources in buffers, as returned by
+        _spreading_buffers, to its value.
+        By default only the chunks containing a source value are visited, looking them up
+        in the fan index, once for each distinct value, whatever buffers it is in; if a
+        customized matching or sji function has been set the match matrix over all chunks
+        is built and handed to it instead, for each buffer.
+        """
+        if not (self._use_actr_matching_source_to_chunk and self._use_actr_sji):
+            vector = 0
+            for name, conditions, w in buffers:
+                v = self._compute_spreading_activation_vec(conditions, w)
+                if v is None or len(v) != len(self):
+                    raise RuntimeError("Failed to spread.")
+                vector = vector + v
+            chunks = list(self.values())
+            return {chunks[i]._serial: vector[i] for i in np.flatnonzero(vector).tolist()}
+        # the wj of each distinct source value, summed over all the buffers containing it
+        strengths = {}
+        for name, conditions, w in buffers:
+            wj = (self._source_activation if w is None else w) / len(conditions)
+            for value in conditions.values():
+                try:
+                    strengths[value] = strengths.get(value, 0) + wj
+                except TypeError:
+                    pass        # an unhashable value cannot be the value of any slot
+        result = {}
+        get = result.get
+        for value, wj in strengths.items():
+            posting = self._fan_posting(value)
+            sji = self._max_associative_strength - math.log(len(posting) + 1)
+            for serial in posting:
+                result[serial] = get(serial, 0) + wj * sji
+        return {s: v for s, v in result.items() if v}
+
+    def _fan_posting(self, value):
+        try:
+            return self._fan_index.get(value, {})
+        except TypeError:
+            return {}           # an unhashable value cannot be the value of any slot
+
     def _actr_matching_source_to_chunk(self, conditions):
         """compare conditions(M) to chunks(N) in m.
         Spliting chunk into n sources, and compare sources to chunk
-        Return an NxM matrix
-        Each row represents a chunk
-        Each col represents a source
-        Each cell is T/F indicating whether source's value is matching
-        """
-        result=[]
-        # iterate through all slot-value pair in conditions
-        for cslot, cvalue in conditions.items():
-            temp=[]
-            # iterate through all slot-value pair in m
-            for chunk in self.values():
-                temp.append(cvalue in chunk.values()) #check if value occurs in chunk's values, regardless of slot names
-            result.append(temp)
-        """[[True  True]
-            [True  False]
-            [False True]]
-        """
-        return np.array(result)
-    
+        Return an MxN sparse match matrix in CSR form, as handed to an sji function
+        set with sparse=True (see :func:`set_sji_function`); others are handed it dense
+        Each row represents a source
+        Each col represents a chunk, in the order of m.values()
+        Each stored cell is True, indicating that source's value is matching
+        """
+        # The rows are filled from the fan index, which already records which chunks
+        # contain each value, regardless of slot names, in increasing column order.
+        columns = {c._serial: i for i, c in enumerate(self.values())}
+        indptr = [0]
+        indices = []
+        for cvalue in conditions.values():
+            indices.extend(columns[serial] for serial in self._fan_posting(cvalue))
+            indptr.append(len(indices))
+        return _match_matrix(indptr, indices, (len(conditions), len(columns)))
+
     def _actr_sji(self, match_matrix):
         """Use default fan() function to compute sji
         sji = S - log(fan)
         """
-        # use default function _fan()
-        fan=np.sum(match_matrix, axis=1)+1 # return a vector of fan number, size=num of 
-        
+        # fan is the number of chunks each source matches, plus one
+        fan = np.diff(match_matrix.indptr) + 1
+
         # compute sji = S - ln(fan)
         ## max_associative_strength: maximum associative strength
         sji = self.max_associative_strength-np.log(fan)
@@ -591,109 +1656,215 @@ class Memory(dict):
     def _matching_source_to_chunk(self, conditions):
         """decide whether to use default _matching_source2chunk functon or customized function"""
         if not self._use_actr_matching_source_to_chunk:
-            try:
-                result = self._matching_source_to_chunk_function(conditions)
-                return result
-            except:
-                warn(f"new _matching_source2chunk func has not been correctly defined. Using default")
-                pass
-        result=self._actr_matching_source2chunk(conditions)
+            function = Memory._matching_source_to_chunk_function
+            arguments = _customized_arguments(function, self, conditions)
+            if arguments is not None:
+                return function(*arguments)
+            warn(f"new _matching_source2chunk func has not been correctly defined. Using default")
+        result=self._actr_matching_source_to_chunk(conditions)
         return result
     
     _use_actr_sji = True
     #_minimum_sji = 0
     #_maximum_sji = 1
     _sji_function = None
+    _sji_sparse = False
 
     def _sji(self, match_matrix):
         """decide whether to use default sji or customized sji function"""
         if not self._use_actr_sji:
-            try:
-                result = self._sji_function(match_matrix)
-                return result
-            except:
-                warn(f"sji func has not been correctly defined. Using default sji fn")
-                pass
+            # customized functions are handed the dense matrix, as they always have been,
+            # unless they were set with sparse=True
+            function = Memory._sji_function
+            matrix = match_matrix if Memory._sji_sparse else match_matrix.toarray()
+            arguments = _customized_arguments(function, self, matrix)
+            if arguments is not None:
+                return function(*arguments)
+            warn(f"sji func has not been correctly defined. Using default sji fn")
         result=self._actr_sji(match_matrix)
         return result
         
-    def _compute_spreading_activation_vec(self, conditions):
+    def _compute_spreading_activation_vec(self, conditions, w=None):
         """Calculate the spreading activation for chunks in m
-        conditions ->(spreading to) m
+        conditions ->(spreading to) m, with a W of w, or of source_activation if it is None
         Return a vector of spreading activation"""
-        # get match_matrix
-        match_matrix=self._matching_source2chunk(conditions)
-        
+        # get match_matrix; customized functions may still return a dense one
+        match_matrix = _as_match_matrix(self._matching_source_to_chunk(conditions))
+
         # compute wj = W/n
-        wj=self.source_activation * np.ones(len(conditions.items()))/len(conditions.items())
-        
-        # cumpute sji = S - ln(fan)
-        sji =self._sji(match_matrix)
-        
-        # compute sji for each chunk
-        result=np.sum(wj*sji*match_matrix.T, axis=1)
-        return result
+        wj = (self.source_activation if w is None else w) / len(conditions)
+
+        # cumpute sji = S - ln(fan), one per source
+        sji = np.asarray(self._sji(match_matrix), dtype=float).reshape(-1)
+
+        # each stored cell contributes its row's wj * sji to its column's chunk, so the
+        # cost is proportional to the number of matches rather than to the matrix's size
+        weights = np.repeat(wj * sji, np.diff(match_matrix.indptr))
+        return np.bincount(np.asarray(match_matrix.indices, dtype=np.intp),
+                           weights=weights, minlength=match_matrix.shape[1])
     """HELPER Functions Finished"""
     
+    @_writes
     def clear_spread(self):
         """undo spreading by assigning None to chunk.spreading_activation"""
-        index_chunk = 0
-        for chunk in self.values():
-            chunk.spreading_activation=None
-            index_chunk=index_chunk+1 
+        self._spreading = {}
             
 
-    class _Activations(abc.Iterable):
-
-        def __init__(self, memory, conditions):
-            self._memory = memory
-            self._conditions = conditions
-
-        def __iter__(self):
-            self._chunks = self._memory.values().__iter__()
-            return self
-
-        def __next__(self):
-            while True:
-                chunk = self._chunks.__next__()             # pass on up the Stop Iteration
-                if self._conditions.keys() <= chunk.keys(): # subset
-                    if self._memory._mismatch is not None:
-                        activation = chunk._activation(True)
-                        mismatch = self._memory._mismatch * sum(self._memory._similarity(c, chunk[s], s)
-                                                                for s, c in self._conditions.items())
-                        total = activation + mismatch
-                        if self._memory._activation_history is not None:
-                            history = self._memory._activation_history[-1]
-                            history["mismatch"] = mismatch
-                            history["activation"] = total
-                        return (chunk, total)
-                    else:
-                        if not all(chunk[a] == v for a, v in self._conditions.items()):
-                            continue
-                        activation = chunk._activation(True)
-                        if self._memory._activation_history is not None:
-                            self._memory._activation_history[-1]["activation"] = activation
-                        return (chunk, activation)
-
-    def _activations(self, conditions):
-        return self._Activations(self, conditions)
+    def _activations(self, conditions, exact=False):
+        # Returns the chunks matching conditions, the NumPy array of their activations,
+        # and the _HistoryBatch to be recorded for them, if any. Unless exact is true, if
+        # the mismatch parameter is set the chunks need only contain the slots in
+        # conditions, and the mismatch penalties are included in their activations.
+        return self._activations_many([conditions], exact)[0]
+
+    def _activations_many(self, probes, exact=False):
+        # Like _activations, returning a list of such triples, one for each of the
+        # probes, but computing the base activation of each chunk only once, however
+        # many of the probes it matches.
+        partial = not exact and self._mismatch is not None
+        matches = [self._candidates(probe, partial) for probe in probes]
+        if len(matches) == 1:
+            union = matches[0]
+        else:
+            union = list({c._serial: c for chunks in matches for c in chunks}.values())
+        base = self._base_activations(union)
+        if len(matches) > 1:
+            position = {c._serial: i for i, c in enumerate(union)}
+        result = []
+        for probe, chunks in zip(probes, matches):
+            if len(matches) > 1:
+                b = base[np.fromiter((position[c._serial] for c in chunks), np.intp, len(chunks))]
+            else:
+                b = base
+            result.append((chunks, *self._compute_activations(chunks,
+                                                              probe if partial else None,
+                                                              b)))
+        return result
 
     def _partial_match(self, conditions):
-        best_chunk = None
-        best_activation = self._threshold
-        for chunk, activation in self._activations(conditions):
-            if activation >= self._threshold:
-            #if activation >= best_activation:
-                best_chunk = chunk
-                best_activation = activation
-            #print('best_activation', best_activation)
-        return best_chunk
+        return self._retrieve(conditions, exact=False)
+
+    @_reads
+    def retrieve_top_k(self, k, partial=False, **kwargs):
+        """Returns a list of at most *k* of the chunks matching *kwargs* with the highest activations not less than this Memory's :attr:`threshold`, most active first.
+        Chunks are matched as by :meth:`retrieve`, including partially if *partial* is true,
+        and all their activations are computed once, with the same noise, so the first
+        chunk returned is the one :meth:`retrieve` would have returned, had it been
+        called instead. Of chunks with equal activations the most recently created comes
+        first. Raises a :exc:`ValueError` if *k* is negative.
+
+        >>> m = Memory(noise=0, temperature=1)
+        >>> m.learn(color="red", size=2)
+        True
+        >>> m.advance()
+        1
+        >>> m.learn(color="red", size=3)
+        True
+        >>> m.learn(color="red", size=3)
+        False
+        >>> m.advance()
+        2
+        >>> m.retrieve_top_k(5, color="red")
+        [<Chunk 0001 {'color': 'red', 'size': 3}>, <Chunk 0000 {'color': 'red', 'size': 2}>]
+        """
+        if k < 0:
+            raise ValueError(f"The number of chunks to retrieve, {k}, must not be negative")
+        group = self._activations(kwargs, exact=not partial)
+        self._record_history([group])
+        chunks, activations = group[:2]
+        above = np.flatnonzero(activations >= self._threshold)
+        if len(above) > 4 * k:
+            # only those at least as active as the kth most active can be among the k
+            kth = np.partition(activations[above], len(above) - k)[len(above) - k] if k else np.inf
+            above = above[activations[above] >= kth]
+        best = heapq.nlargest(k, zip(activations[above].tolist(), above.tolist()))
+        return [chunks[i] for a, i in best]
+
+    @_reads
+    def retrieval_probabilities(self, **kwargs):
+        """Returns the chunks matching *kwargs*, in a list, and a NumPy array of the probabilities of their retrieval.
+        The probabilities are those used in blending, by :meth:`blend`, and so are computed
+        from the chunks' activations using the Boltzmann (softmax) distribution with
+        this Memory's :attr:`temperature`, without regard to its :attr:`threshold`. The
+        chunks matched are those :meth:`blend` would consider, so partially matching
+        ones are included if :attr:`mismatch` is not ``None``. If no chunks match the list
+        and array are empty.
+
+        >>> m = Memory(noise=0, temperature=1)
+        >>> m.learn(color="red", size=2)
+        True
+        >>> m.advance()
+        1
+        >>> m.learn(color="red", size=3)
+        True
+        >>> m.advance()
+        2
+        >>> m.retrieval_probabilities(color="red")
+        ([<Chunk 0000 {'color': 'red', 'size': 2}>, <Chunk 0001 {'color': 'red', 'size': 3}>], array([0.41421356, 0.58578644]))
+        """
+        group = self._activations(kwargs)
+        chunks, activations, batch = group
+        if not chunks:
+            self._record_history([group])
+            return chunks, np.empty(0)
+        weights = np.exp((activations - activations.max()) / self._temperature)
+        probabilities = weights / weights.sum()
+        if batch is not None:
+            batch.blended = np.arange(len(chunks))
+            batch.probability = probabilities
+        self._record_history([group])
+        return chunks, probabilities
+
+    @_reads
+    def retrieve_many(self, probes, partial=False):
+        """Returns a list of the results of calling :meth:`retrieve` with each of *probes*.
+        Each of the *probes* is a mapping of attribute names to values, as would be passed as
+        the keyword arguments of :meth:`retrieve`, and *partial* applies to all of them.
+        All the probes are evaluated at the Memory's current time, and the base activation
+        of each chunk is computed only once, however many of the probes it matches. If
+        :attr:`activation_history` is not ``None`` entries are appended for each probe in
+        turn, each with an additional ``probe`` item, the index of the probe it pertains to.
 
+        >>> m = Memory()
+        >>> m.learn(color="red", size=2)
+        True
+        >>> m.learn(color="blue", size=30)
+        True
+        >>> m.advance()
+        1
+        >>> m.retrieve_many([dict(color="red"), dict(color="green"), dict(size=30)])
+        [<Chunk 0000 {'color': 'red', 'size': 2}>, None, <Chunk 0001 {'color': 'blue', 'size': 30}>]
+        """
+        probes = [dict(p) for p in probes]
+        groups = self._activations_many(probes, exact=not partial)
+        self._tag_probes(groups)
+        self._record_history(groups)
+        return [self._best(chunks, activations) for chunks, activations, _ in groups]
+
+    def _tag_probes(self, groups):
+        for i, (chunks, activations, batch) in enumerate(groups):
+            if batch is not None:
+                batch.probe = i
+
+    @_reads
     def blend(self, outcome_attribute, **kwargs):
         """Returns a blended value for the given attribute of those chunks matching *kwargs*, and which contains *outcome_attribute*.
         Returns ``None`` if there are no matching chunks that contains
-        *outcome_attribute*. If any matching chunk has a value of *outcome_attribute*
-        value that is not a real number a :exc:`TypeError` is raised.
+        *outcome_attribute*.
+
+        The values of *outcome_attribute* are usually real numbers, but may instead all
+        be sequences of real numbers of the same length, typically tuples, as the values
+        of a chunk's attributes must be hashable. Such vectors are blended element by
+        element, and the result is a NumPy array. If any matching chunk has a value of
+        *outcome_attribute* that is neither a real number nor such a sequence, or they are
+        not all of one kind and length, a :exc:`TypeError` is raised.
+
+        *outcome_attribute* may also be a list or tuple of attribute names, in which case
+        a dict is returned mapping each to its blended value. The blending weights are
+        then computed only once, for those matching chunks that contain all the
+        attributes, and all the attributes are blended over just those chunks, so this is
+        much cheaper than calling :meth:`blend` for each. The entries recorded in
+        :attr:`activation_history` give the retrieval probabilities of those chunks.
 
         >>> m = Memory()
         >>> m.learn(color="red", size=2)
@@ -710,30 +1881,326 @@ class Memory(dict):
         3
         >>> m.blend("size", color="red")
         1.1548387620911693
+        >>> m.learn(color="green", size=4, position=(0.5, 2.0))
+        True
+        >>> m.learn(color="green", size=8, position=(1.5, 3.0))
+        True
+        >>> m.advance()
+        4
+        >>> m.blend(["size", "position"], color="green")
+        {'size': 5.832076303442453, 'position': array([0.95801908, 2.45801908])}
 
         """
-        weights = 0.0
-        weighted_outcomes = 0.0
-        if self._activation_history is not None:
-            chunk_weights = []
-        for chunk, activation in self._activations(kwargs):
-            if outcome_attribute not in chunk:
-                continue
-            weight = math.exp(activation / self._temperature)
-            if self._activation_history is not None:
-                chunk_weights.append((self._activation_history[-1], weight))
-            weights += weight
-            weighted_outcomes += weight * chunk[outcome_attribute]
+        names = _outcome_attributes(outcome_attribute)
+        groups = [self._activations(kwargs)]
+        results = self._blend(names, groups)
+        self._record_history(groups)
+        values = {}
+        for name, result in zip(names, results):
+            result = result[0]
+            if np.isnan(result).all():
+                values[name] = None
+            elif result.ndim:
+                values[name] = result
+            else:
+                values[name] = float(result)
+        if isinstance(outcome_attribute, str):
+            return values[outcome_attribute]
+        return values
+
+    @_reads
+    def blend_many(self, outcome_attribute, probes):
+        """Returns a NumPy array of the results of calling :meth:`blend` with *outcome_attribute* and each of *probes*.
+        Each of the *probes* is a mapping of attribute names to values, as would be passed as
+        the keyword arguments of :meth:`blend`. Where :meth:`blend` would return ``None``
+        the array contains NaN. All the probes are evaluated at the Memory's current time,
+        the base activation of each chunk is computed only once, however many of the probes
+        it matches, and the blending weights of all of them are computed together. If
+        :attr:`activation_history` is not ``None`` entries are appended for each probe in
+        turn, each with an additional ``probe`` item, the index of the probe it pertains to.
+        If the values of *outcome_attribute* are vectors the result has a row for each
+        probe, and if *outcome_attribute* is a list or tuple of attribute names the result
+        is a dict mapping each of them to such an array.
+
+        >>> m = Memory(noise=0, temperature=1)
+        >>> m.learn(color="red", size=2)
+        True
+        >>> m.learn(color="blue", size=30)
+        True
+        >>> m.advance()
+        1
+        >>> m.blend_many("size", [dict(color="red"), dict(color="green"), {}])
+        array([ 2., nan, 16.])
+        >>> m.blend_many("size", [])
+        array([], dtype=float64)
+        """
+        names = _outcome_attributes(outcome_attribute)
+        probes = [dict(p) for p in probes]
+        groups = self._activations_many(probes)
+        self._tag_probes(groups)
+        results = self._blend(names, groups)
+        self._record_history(groups)
+        if isinstance(outcome_attribute, str):
+            return results[0]
+        return dict(zip(names, results))
+
+    def _blend(self, outcome_attributes, groups):
+        # Blends each of outcome_attributes, a tuple, over each of groups, a sequence of
+        # (chunks, activations, batch) triples as returned by _activations, considering
+        # only the chunks containing all of outcome_attributes and computing all the
+        # weights together. Returns a list with a NumPy array of the results for each
+        # attribute, with a row for each group, of NaN for any group with no such chunks.
+        # Also notes the retrieval probabilities in the batches, if any, for recording in
+        # the activation_history.
+        if not groups:
+            # with no rows the shape of any vector values is taken from a chunk having them
+            return [np.empty((0,) + _outcome_array(name, [
+                        next((c[name] for c in self.values() if name in c), 0)]).shape[1:])
+                    for name in outcome_attributes]
+        activations = []
+        outcomes = [[] for name in outcome_attributes]
+        included = []
+        for chunks, a, batch in groups:
+            if len(outcome_attributes) == 1:
+                name = outcome_attributes[0]
+                indices = [i for i, c in enumerate(chunks) if name in c]
+            else:
+                indices = [i for i, c in enumerate(chunks)
+                           if all(name in c for name in outcome_attributes)]
+            for name, values in zip(outcome_attributes, outcomes):
+                values.extend(chunks[i][name] for i in indices)
+            activations.append(a[indices])
+            included.append(indices)
+        outcomes = [_outcome_array(name, values)
+                    for name, values in zip(outcome_attributes, outcomes)]
+        lengths = np.fromiter((len(i) for i in included), np.intp, len(included))
+        scaled = np.concatenate(activations) / self._temperature
+        totals = np.zeros(len(groups))
+        nonempty = np.flatnonzero(lengths)
+        if len(nonempty):
+            starts = (np.cumsum(lengths) - lengths)[nonempty]
+            # Each group's weights are scaled by the exponential of its largest scaled
+            # activation, which cancels out of the results and probabilities, so that its
+            # largest weight is one, none overflow, and the total is never zero.
+            peaks = np.zeros(len(groups))
+            peaks[nonempty] = np.maximum.reduceat(scaled, starts)
+            scaled -= np.repeat(peaks, lengths)
+        weights = np.exp(scaled)
+        if len(nonempty):
+            totals[nonempty] = np.add.reduceat(weights, starts)
+        result = []
+        for values in outcomes:
+            # vector valued outcomes have a column for each element
+            extra = (1,) * (values.ndim - 1)
+            sums = np.zeros((len(groups),) + values.shape[1:])
+            if len(nonempty):
+                sums[nonempty] = np.add.reduceat(weights.reshape((-1,) + extra) * values,
+                                                 starts, axis=0)
+            t = totals.reshape((-1,) + extra)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result.append(np.where(t != 0, sums / t, np.nan))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            probabilities = weights / np.repeat(totals, lengths)
         if self._activation_history is not None:
-            for history, w in chunk_weights:
-                try:
-                    history["retrieval_probability"] = w / weights
-                except ZeroDivisionError:
-                    history["retrieval_probability"] = None
+            ends = np.cumsum(lengths)
+            for (chunks, a, batch), indices, end, n, total in zip(groups, included, ends,
+                                                                  lengths, totals):
+                batch.blended = indices
+                batch.probability = np.full(len(chunks), np.nan)
+                if total:
+                    batch.probability[indices] = probabilities[end - n:end]
+        return result
+
+    @_reads
+    def snapshot(self, path):
+        """Writes the state of this Memory into a new directory, *path*, from which :meth:`restore` can recreate it.
+        The chunks are written as a table of NumPy arrays: their creation times,
+        importances, reference counts, and the times of their references concatenated into
+        a single array, together with their attribute values as indices into a separate
+        table of the distinct values. This Memory's parameters and current time are also
+        written, as is the state of its :attr:`rng`. The activation history, spreading
+        activation functions and similarity functions are not.
+
+        The attribute values are pickled, and so must be picklable. Creation and reference
+        times are stored as integers if they all are integers, and are then restored as
+        such, and otherwise as floating point numbers; the reference times of a columnar
+        Memory are always floating point numbers. The snapshot is only complete once its
+        ``header.json`` file has been written, which is done last. If *path* already
+        exists a :exc:`FileExistsError` is raised.
+        """
+        chunks = list(self.values())
+        n = len(chunks)
+        schemas = {}
+        values = {}
+        schema_ids = np.empty(n, np.intp)
+        cells = []
+        for i, chunk in enumerate(chunks):
+            schema_ids[i] = schemas.setdefault(chunk._schema.names, len(schemas))
+            # keyed by type as well, so that, say, 1, 1.0 and True remain distinct
+            cells.extend(values.setdefault((type(v), v), len(values)) for v in chunk._values)
+        count, length, times = self._reference_arrays(chunks)
+        arrays = dict(schema=schema_ids,
+                      cells=np.array(cells, np.intp),
+                      creation=_time_array([c._creation for c in chunks]),
+                      importance=np.fromiter((c._importance for c in chunks), float, n),
+                      spreading=np.fromiter((self._spreading.get(c._serial, np.nan)
+                                             for c in chunks), float, n),
+                      count=count,
+                      length=length,
+                      times=times)
+        os.mkdir(path)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), array)
+        with open(os.path.join(path, "values.pickle"), "wb") as f:
+            pickle.dump([v for t, v in values], f, pickle.HIGHEST_PROTOCOL)
+        header = dict(format=SNAPSHOT_FORMAT,
+                      version=SNAPSHOT_VERSION,
+                      # which may be a NumPy scalar, as set by learn_many()
+                      time=int(self._time) if isinstance(self._time, numbers.Integral)
+                           else float(self._time),
+                      chunks=n,
+                      schemas=list(schemas),
+                      random_state=self._rng.bit_generator.state,
+                      parameters=dict(noise=self.noise,
+                                      decay=self.decay,
+                                      temperature=self.temperature,
+                                      threshold=self.threshold,
+                                      mismatch=self.mismatch,
+                                      optimized_learning=self.optimized_learning,
+                                      recent_references=self.recent_references,
+                                      source_activation=self.source_activation,
+                                      max_associative_strength=self.max_associative_strength,
+                                      columnar=self.columnar,
+                                      max_chunks=self.max_chunks,
+                                      activation_floor=self.activation_floor,
+                                      compaction_interval=self.compaction_interval))
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump(header, f, indent=2)
+
+    def _reference_arrays(self, chunks):
+        # Returns the total number of references to each of chunks, the number of them
+        # whose times are retained, and those times, concatenated in the order of chunks.
+        n = len(chunks)
+        none_retained = np.zeros(n, np.intp)
+        engine = self._engine
+        if engine is not None:
+            rows = engine.rows(chunks)
+            length = engine.length[rows]
+            if self._optimized_learning:
+                return length, none_retained, np.empty(0)
+            index, _ = _ragged_index(engine.offset[rows], length)
+            count = engine.count[rows] if self._recent_references else length
+            return count, length, engine.times[index]
+        if self._optimized_learning:
+            return (np.fromiter((c._references for c in chunks), np.intp, n),
+                    none_retained, np.empty(0))
+        if self._recent_references:
+            retained = [c._references.recent for c in chunks]
+            count = np.fromiter((c._references.count for c in chunks), np.intp, n)
+        else:
+            retained = [c._references for c in chunks]
+            count = None
+        length = np.fromiter(map(len, retained), np.intp, n)
+        times = _time_array(itertools.chain.from_iterable(retained))
+        return (length if count is None else count), length, times
+
+    @classmethod
+    def restore(cls, path, mmap=True, columnar=None, concurrent=False):
+        """Returns a new Memory recreated from the snapshot written into *path* by :meth:`snapshot`.
+        If *mmap* is true, the default, the snapshot's arrays are memory mapped copy on
+        write rather than read. The reference times of a columnar Memory are then used in
+        place, so that several processes restoring the same snapshot share a single copy
+        of them until they learn or forget. If *columnar* is not None it determines
+        whether the new Memory is columnar, regardless of whether the one from which the
+        snapshot was made was. The new Memory is :attr:`concurrent` if *concurrent* is
+        true. Similarity, sji and matching functions are global, and must be set up as
+        before.
+
+        Raises a :exc:`ValueError` if *path* does not contain a complete snapshot, or one
+        written in a format version this version of PyACTUp does not support.
+        """
         try:
-            return weighted_outcomes / weights
-        except ZeroDivisionError:
-            return None
+            with open(os.path.join(path, "header.json")) as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"{path} does not contain a complete PyACTUp snapshot") from None
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} does not contain a PyACTUp snapshot")
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"The snapshot in {path} has version {header.get('version')}, "
+                             f"but only version {SNAPSHOT_VERSION} is supported")
+        parameters = header["parameters"]
+        if columnar is not None:
+            parameters["columnar"] = columnar
+        result = cls(concurrent=concurrent, **parameters)
+        result._time = header["time"]
+        state = header.get("random_state")
+        if state and state.get("bit_generator") == type(result._rng.bit_generator).__name__:
+            result._rng.bit_generator.state = state
+        def load(name):
+            file = os.path.join(path, name + ".npy")
+            try:
+                return np.load(file, mmap_mode=("c" if mmap else None))
+            except ValueError:
+                return np.load(file)    # empty arrays cannot be memory mapped
+        with open(os.path.join(path, "values.pickle"), "rb") as f:
+            values = pickle.load(f)
+        # Nothing created here can be garbage, and the many objects created would otherwise
+        # provoke repeated, fruitless, full collections.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            result._restore_chunks([_Schema(tuple(names)) for names in header["schemas"]],
+                                   values,
+                                   **{name: load(name) for name in ("schema", "cells",
+                                                                    "creation", "importance",
+                                                                    "spreading", "count",
+                                                                    "length", "times")})
+        finally:
+            if enabled:
+                gc.enable()
+        return result
+
+    def _restore_chunks(self, schemas, values, schema, cells, creation, importance,
+                        spreading, count, length, times):
+        for s in schemas:
+            self._schemas[s.names] = s
+        engine = self._engine
+        if engine is not None:
+            engine.restore(creation, importance, count, length, times)
+        offsets = (np.cumsum(length) - length).tolist()
+        cells = [values[i] for i in cells.tolist()]
+        counts = count.tolist()
+        lengths = length.tolist()
+        spreading = [None if math.isnan(x) else x for x in spreading.tolist()]
+        if engine is None and not self._optimized_learning:
+            times = times.tolist()
+        position = 0
+        for i, (s, created, weight) in enumerate(zip(schema.tolist(), creation.tolist(),
+                                                     importance.tolist())):
+            s = schemas[s]
+            k = len(s.names)
+            chunk_values = tuple(cells[position:position + k])
+            position += k
+            chunk = Chunk(self, s, chunk_values)
+            chunk._creation = created
+            chunk._importance = weight
+            if spreading[i] is not None:
+                self._spreading[chunk._serial] = spreading[i]
+            if engine is not None:
+                chunk._row = i
+                chunk._references = counts[i]
+            elif self._optimized_learning:
+                chunk._references = counts[i]
+            else:
+                retained = times[offsets[i]:offsets[i] + lengths[i]]
+                if self._recent_references:
+                    chunk._references.count = counts[i]
+                    chunk._references.recent = retained
+                else:
+                    chunk._references = retained
+            self[(s.key, s.ordered(chunk_values))] = chunk
+            self._index_chunk(chunk)
         
 @property
 def use_actr_similarity():
@@ -756,6 +2223,7 @@ def use_actr_similarity(value):
         Memory._minimum_similarity =  0
         Memory._maximum_similarity =  1
     Memory._use_actr_similarity = bool(value)
+    Memory._clamped_similarity.cache_clear()
 
 def set_similarity_function(function, *slots):
     """Assigns a similarity function to be used when comparing attribute values with the given names.
@@ -773,9 +2241,50 @@ def set_similarity_function(function, *slots):
     ...         return f(y, x)
     ...     return 1 - (y - x) / y
     >>> set_similarity_function(f, "length", "width")
+
+    The values returned are memoized, keeping up to ``SIMILARITY_CACHE_SIZE`` of the
+    most recently used ones, which is a further reason the function should be
+    stateless. Assigning a similarity function to a slot replaces any similarity matrix
+    assigned to it with :func:`set_similarity_matrix`.
     """
     for s in slots:
         Memory._similarity_functions[s] = function
+        Memory._similarity_matrices.pop(s, None)
+    Memory._clamped_similarity.cache_clear()
+
+def set_similarity_matrix(values, matrix, *slots):
+    """Assigns precomputed similarities of a finite set of values, to be used when comparing attribute values with the given names.
+    The *values* should be a sequence of distinct, :class:`Hashable` values, and *matrix*
+    a square array, with as many rows as there are *values*, of the similarities of
+    each pair of them, in the same terms as the values returned by a function passed to
+    :func:`set_similarity_function`; it should be symmetric. Similarities involving a
+    value that is not among the *values* are treated as if no similarity function had
+    been set. When matching such slots partially, the mismatch penalties of all the
+    candidate chunks are looked up in *matrix* together, rather than being computed one
+    at a time. A :exc:`ValueError` is raised if *matrix* is not of the right shape.
+    Assigning a similarity matrix to a slot replaces any similarity function assigned
+    to it.
+
+    >>> set_similarity_matrix(["small", "medium", "large"],
+    ...                       [[1.0, 0.5, 0.0],
+    ...                        [0.5, 1.0, 0.5],
+    ...                        [0.0, 0.5, 1.0]],
+    ...                       "size")
+    """
+    values = list(values)
+    index = {v: i for i, v in enumerate(values)}
+    if len(index) != len(values):
+        raise ValueError("The values of a similarity matrix must be distinct")
+    matrix = np.array(matrix, dtype=float)
+    if matrix.shape != (len(values), len(values)):
+        raise ValueError(f"The similarity matrix must be of shape {(len(values), len(values))}, not {matrix.shape}")
+    if matrix.size and (matrix.min() < Memory._minimum_similarity
+                        or matrix.max() > Memory._maximum_similarity):
+        warn(f"some similarity values are outside the allowed range, {Memory._minimum_similarity} to {Memory._maximum_similarity}, so the nearest allowed values are being used instead")
+    for s in slots:
+        Memory._similarity_matrices[s] = (index, matrix)
+        Memory._similarity_functions.pop(s, None)
+    Memory._clamped_similarity.cache_clear()
 
 
 def use_actr_sji():
@@ -784,28 +2293,43 @@ def use_actr_sji():
 def use_actr_sji(value):
     Memory._use_actr_sji = bool(value)
 
-def set_sji_function(function):
+def set_sji_function(function, sparse=False):
     """Assigns a sji function to be used when calculate sji.
     The function should take two arguments Memory obejct and macth_matrix,
-    match_matrxi is a matrix of T/F, which comapres source and chunk in DM
-    see _matching_source2chunk()
-    For example, if DM contains 3 chunks, source contains 2 slots, 
-    macth_matrix is like 
-            [[True  True]
-            [True  False]
-            [False True]]
-    and return a vector of sji, N length (N=number of memory items in DM)
+    match_matrix is a dense boolean NumPy array, which comapres source and chunk in DM,
+    with one row per source and one column per chunk, see _actr_matching_source_to_chunk().
+    A function taking only match_matrix is also accepted. A function that can be called
+    in neither way is ignored, with a warning, and the default sji used instead; any
+    exception raised by the function itself is propagated.
+    For example, if DM contains 3 chunks, source contains 2 slots,
+    macth_matrix is like
+            [[True  True  False]
+            [True  False True]]
+    and return a vector of sji, M length (M=number of sources)
     The function should be commutative; that is, if called with the same arguments
     in the reverse order, it should return the same value.
     It should also be stateless, always returning the same values if passed
     the same arguments.
     >>> def f(m, match_matrix):
-    ...     fan=np.sum(match_matrix, axis=1)+1
-    ...     sji=Memory.max_associative_strength - np.log(fan * 100)
+    ...     fan = np.sum(match_matrix, axis=1) + 1
+    ...     sji = m.max_associative_strength - np.log(fan * 100)
     ...     return sji
     >>> set_sji_function(f)
+
+    If *sparse* is true the function is instead handed the match matrix in compressed
+    sparse row form, as PyACTUp holds it, sparing the cost of a dense array of every
+    source against every chunk: a :class:`scipy.sparse.csr_matrix` if SciPy is
+    installed, and otherwise an object with the same ``shape``, ``indptr``,
+    ``indices``, ``data``, ``nnz``, ``sum()`` and ``toarray()``. The number of chunks
+    each source matches is then ``np.diff(match_matrix.indptr)``.
+
+    >>> def g(m, match_matrix):
+    ...     fan = np.diff(match_matrix.indptr) + 1
+    ...     return m.max_associative_strength - np.log(fan * 100)
+    >>> set_sji_function(g, sparse=True)
     """
     Memory._sji_function = function
+    Memory._sji_sparse = bool(sparse)
 
 
 
@@ -816,57 +2340,892 @@ def use_actr_matching_source_to_chunk(value):
     Memory._use_actr_matching_source_to_chunk = bool(value)
 
 def set_matching_source_to_chunk_function(function):
+    """Assigns a function to be used in place of the default matching of sources to chunks.
+    The function should take two arguments, the Memory object and a dict of the source
+    slots and values, or only the latter, and return a dense boolean array, as described
+    in :func:`set_sji_function`, with one row per source and one column per chunk, in the
+    order of the Memory's values(). A sparse matrix in compressed sparse row (CSR) form,
+    such as a :class:`scipy.sparse.csr_matrix`, is also accepted.
+    """
     Memory._matching_source_to_chunk_function = function
 
 
-class Chunk(dict):
+def run_agents(make_agent, agents, trials, processes=None, seed=None):
+    """Runs many independent agents, each typically with its own :class:`Memory`, over a number of trials, in parallel, yielding their results as they are produced.
+    *agents* is the number of agents, or an iterable of identifiers for them, which
+    must be picklable, and *trials* is the number of trials each is run for.
+    *make_agent* is called, in a worker process, as ``make_agent(agent, seed)`` for
+    each agent, where *seed* is an integer derived from the *seed* passed to
+    :func:`run_agents` and the agent's position among *agents*. It should return a
+    callable, which is then called with each trial number, from zero, in turn, and
+    whose return value, which must be picklable, is the result of that trial.
+
+    This is a generator, yielding ``(agent, trial, result)`` tuples. Those for any one
+    agent are yielded in trial order, but those for different agents are interleaved
+    arbitrarily. The agent's seed should typically be passed as the *seed* of any Memory
+    it creates; before an agent is made Python's global :mod:`random` module is also
+    seeded with it, for the use of the agent's own code. The results are then the same
+    however the agents are spread across processes, and between runs with the same
+    *seed*. If *seed* is None fresh entropy is used instead.
+
+    The agents are handed out to *processes* worker processes, by default one per CPU,
+    each running one agent through all its trials before taking the next. If *processes*
+    is 0 or 1 they are all run in the calling process instead, which is useful for
+    debugging. Under the ``spawn`` or ``forkserver`` start methods of
+    :mod:`multiprocessing` *make_agent* must be picklable, typically a module level
+    function. If it, or a trial, raises an exception the workers are stopped and that
+    exception is raised by :func:`run_agents`. If a worker process dies without doing
+    so, for example by being killed, the others are stopped and a :exc:`RuntimeError`
+    naming the agent it was running is raised.
+
+    >>> def make_agent(agent, seed):
+    ...     m = Memory(noise=0.25, seed=seed)
+    ...     def trial(t):
+    ...         choice = m.blend("payoff", action="safe") or 0
+    ...         m.learn(action="safe", payoff=3)
+    ...         m.advance()
+    ...         return choice
+    ...     return trial
+    >>> for agent, trial, result in run_agents(make_agent, 100, 1000):
+    ...     ...
+    """
+    if isinstance(agents, numbers.Integral):
+        agents = range(agents)
+    agents = list(agents)
+    seeds = [int(s.generate_state(1)[0])
+             for s in np.random.SeedSequence(seed).spawn(len(agents))]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(agents))
+    if processes <= 1:
+        for agent, agent_seed in zip(agents, seeds):
+            random.seed(agent_seed)
+            run = make_agent(agent, agent_seed)
+            for trial in range(trials):
+                yield agent, trial, run(trial)
+        return
+    # Each worker is handed its agents one at a time, on its own queue, so that which
+    # agent each is running is known here, even if it dies without a word.
+    pending = iter(zip(agents, seeds))
+    results = multiprocessing.Queue()
+    tasks = [multiprocessing.Queue() for i in range(processes)]
+    workers = [multiprocessing.Process(target=_run_agents_worker,
+                                       args=(make_agent, trials, i, tasks[i], results),
+                                       daemon=True)
+               for i in range(processes)]
+    running = {}                # worker number -> the agent it is running
+    def assign(i):
+        task = next(pending, None)
+        tasks[i].put(task)
+        if task is None:
+            running.pop(i, None)
+        else:
+            running[i] = task[0]
+    for i, w in enumerate(workers):
+        w.start()
+        assign(i)
+    try:
+        suspect = False
+        while running:
+            try:
+                i, message = results.get(timeout=RUNNER_POLL_INTERVAL)
+            except queue.Empty:
+                # A worker that has exited while still running an agent has died, but
+                # anything it sent before then may not have arrived yet, so it is only
+                # given up on if nothing more arrives in a further interval.
+                dead = [i for i in running if workers[i].exitcode is not None]
+                if dead and suspect:
+                    i = dead[0]
+                    raise RuntimeError(f"The worker process running agent {running[i]!r} "
+                                       f"died, with exit code {workers[i].exitcode}")
+                suspect = bool(dead)
+                continue
+            suspect = False
+            if message is None:
+                assign(i)
+            elif isinstance(message, BaseException):
+                raise message
+            else:
+                yield from message
+        for w in workers:
+            w.join()
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+
+
+def _run_agents_worker(make_agent, trials, number, tasks, results):
+    # Runs agents taken from tasks until a None is taken, putting their results onto
+    # results in batches, each as a pair of this worker's number and the batch, then a
+    # pair of the number and None, asking for another agent. An exception is put in
+    # place of the results.
+    try:
+        for agent, seed in iter(tasks.get, None):
+            random.seed(seed)
+            run = make_agent(agent, seed)
+            batch = []
+            for trial in range(trials):
+                batch.append((agent, trial, run(trial)))
+                if len(batch) >= RUNNER_BATCH_SIZE:
+                    results.put((number, batch))
+                    batch = []
+            if batch:
+                results.put((number, batch))
+            results.put((number, None))
+    except BaseException as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(f"{type(e).__name__}: {e}")
+        results.put((number, e))
+
+
+class SpreadingContext:
+    """A set of sources of spreading activation, and the spreading activations they give
+    the chunks of a :class:`Memory`, as returned by :meth:`Memory.context`.
+    While it is active, within a ``with`` statement, the Memory's retrievals and blends
+    use these spreading activations in place of those set by :meth:`Memory.spread`.
+    A context may be entered repeatedly; its spreading activations are computed the first
+    time they are needed, and again only if chunks have since been added to or removed
+    from the Memory, or the parameters or functions on which they depend have changed.
+    """
+
+    __slots__ = ["_memory", "_buffers", "_spreading", "_state"]
+
+    def __init__(self, memory, buffers):
+        self._memory = memory
+        self._buffers = buffers
+        self._spreading = None
+        self._state = None
+
+    def __repr__(self):
+        return f"<SpreadingContext {self.sources}>"
+
+    @property
+    def memory(self):
+        """The :class:`Memory` to which this context applies."""
+        return self._memory
+
+    @property
+    def sources(self):
+        """A dictionary mapping the names of the buffers that are the sources of this context's spreading activation to dictionaries of their slots' values.
+        The sources given to :meth:`Memory.context` as keyword arguments are under the
+        name None.
+        """
+        return {name: dict(conditions) for name, conditions, w in self._buffers}
+
+    def __enter__(self):
+        self._memory._context_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        contexts = self._memory._context_stack()
+        # leaving contexts in other than the reverse of the order entered is tolerated
+        for i in range(len(contexts) - 1, -1, -1):
+            if contexts[i] is self:
+                del contexts[i]
+                break
+
+    def _values(self):
+        memory = self._memory
+        state = memory._spreading_state()
+        if state != self._state:
+            self._spreading = memory._cached_spreading_activations(self._buffers)
+            self._state = state
+        return self._spreading
+
+
+class ActivationTrace:
+    """A bounded, columnar record of a Memory's activation computations.
+    It may be assigned to a Memory's :attr:`activation_history` in place of a list, and
+    then, rather than a dictionary for each chunk considered by each operation, appends
+    one row per chunk to preallocated NumPy arrays, one for each of its *fields*. At most
+    *size* rows are retained; once it is full each new row overwrites the oldest. If
+    *sample* is less than one each operation, such as a call of :meth:`Memory.retrieve`
+    or :meth:`Memory.blend`, is recorded only with that probability, drawn from a
+    :class:`numpy.random.Generator` created from *seed*; all the rows for an operation
+    are recorded or none are.
+
+    The available fields, and the default if *fields* is not supplied, are those in
+    :attr:`FIELDS`:
+
+    * ``query``, the number of the operation, counted from zero, including those not sampled
+    * ``probe``, the index of the probe within an operation, zero unless it is one of
+      :meth:`Memory.retrieve_many` or :meth:`Memory.blend_many`
+    * ``time``, the Memory's time at the operation
+    * ``chunk``, the number of the chunk, which is its name as an integer
+    * ``base_activation``, ``activation_noise``, ``spreading_activation``,
+      ``importance``, ``mismatch`` and ``activation``, as in the dictionaries otherwise
+      recorded, with spreading activation zero rather than ``None`` if none has been
+      spread, and mismatch NaN if partial matching was not used
+    * ``retrieval_probability``, NaN except for the chunks blended over
+
+    The recorded rows, oldest first, are available as a NumPy array for each field by
+    subscripting the trace with the field name, or all together from :meth:`columns`.
+    Raises a :exc:`ValueError` if *size* is not positive, *sample* is not greater than
+    zero and at most one, or any of *fields* is unknown.
+
+    >>> m = Memory()
+    >>> m.activation_history = ActivationTrace(size=10000, fields=["chunk", "activation"])
+    """
+
+    FIELDS = ("query", "probe", "time", "chunk", "base_activation", "activation_noise",
+              "spreading_activation", "importance", "mismatch", "activation",
+              "retrieval_probability")
+
+    _INTEGER_FIELDS = ("query", "probe", "chunk")
+
+    def __init__(self, size=100000, fields=None, sample=1, seed=None):
+        if size < 1:
+            raise ValueError(f"The size of an ActivationTrace, {size}, must be positive")
+        if not 0 < sample <= 1:
+            raise ValueError(f"The sample rate, {sample}, must be greater than zero and at most one")
+        fields = self.FIELDS if fields is None else tuple(fields)
+        for f in fields:
+            if f not in self.FIELDS:
+                raise ValueError(f"Unknown ActivationTrace field {f}")
+        self._size = int(size)
+        self._fields = fields
+        self._sample = sample
+        self._rng = np.random.default_rng(seed)
+        self._columns = {f: np.zeros(self._size, np.int64 if f in self._INTEGER_FIELDS
+                                     else float)
+                         for f in fields}
+        self.clear()
+
+    @property
+    def size(self):
+        """The maximum number of rows retained."""
+        return self._size
+
+    @property
+    def fields(self):
+        """The names of the fields recorded, a tuple."""
+        return self._fields
+
+    @property
+    def sample(self):
+        """The probability with which each operation is recorded."""
+        return self._sample
+
+    @property
+    def rows(self):
+        """The total number of rows recorded since this trace was created or cleared, including any since overwritten."""
+        return self._rows
+
+    @property
+    def queries(self):
+        """The total number of operations since this trace was created or cleared, whether sampled or not."""
+        return self._queries
+
+    def clear(self):
+        """Discards all the rows recorded, and restarts the numbering of operations."""
+        self._rows = 0
+        self._queries = 0
+
+    def __len__(self):
+        return min(self._rows, self._size)
+
+    def __getitem__(self, field):
+        column = self._columns[field]
+        if self._rows <= self._size:
+            return column[:self._rows].copy()
+        start = self._rows % self._size
+        return np.concatenate((column[start:], column[:start]))
+
+    def columns(self):
+        """Returns a dict mapping each of :attr:`fields` to a NumPy array of its recorded values, oldest first."""
+        return {f: self[f] for f in self._fields}
+
+    def __repr__(self):
+        return f"<ActivationTrace {len(self)}/{self._size} rows>"
+
+    def _record(self, batches):
+        query = self._queries
+        self._queries += 1
+        if self._sample < 1 and self._rng.random() >= self._sample:
+            return
+        lengths = [len(b.chunks) for b in batches]
+        n = sum(lengths)
+        if not n:
+            return
+        keep = min(n, self._size)
+        start = (self._rows + n - keep) % self._size
+        first = min(keep, self._size - start)
+        for f in self._fields:
+            if f == "query":
+                values = np.full(n, query)
+            elif f == "probe":
+                values = np.repeat([b.probe or 0 for b in batches], lengths)
+            elif f == "time":
+                values = np.repeat([b.time for b in batches], lengths)
+            else:
+                values = np.concatenate([b.column(f) for b in batches])
+            values = values[n - keep:]
+            column = self._columns[f]
+            column[start:start + first] = values[:first]
+            column[:keep - first] = values[first:]
+        self._rows += n
+
+
+class HistoryExporter:
+    """Writes a Memory's activation history to a file as it is collected.
+    It may be assigned to a Memory's :attr:`activation_history` in place of a list, and
+    then, rather than accumulating in memory, the entries that would have been appended
+    to a list are written to the file at *path*, together with the number of the
+    operation that produced them, ``query``, and the Memory's ``time`` at it. Several
+    Memory objects may share one exporter.
+
+    The *format* may be ``"jsonl"``, one JSON object per line; ``"csv"``; or
+    ``"parquet"``, which requires `pyarrow <https://arrow.apache.org/docs/python/>`_. If
+    pyarrow is not installed ``"parquet"`` falls back to ``"csv"``, with a warning, writing
+    to *path* with its extension replaced by ``.csv``. If *format* is ``None`` it is
+    chosen from the extension of *path*, defaulting to ``"jsonl"``. In the CSV and
+    Parquet formats the attributes are written as JSON strings. So that recording does
+    not cost time proportional to the numbers of references, the ``references`` written
+    are the number of references each chunk had, rather than their times.
+
+    The entries are formatted and written by a background thread, in batches of
+    *batch_size* rows. At most *max_pending* operations may be waiting to be written;
+    once that many are, the Memory operations recording history wait, so that a slow
+    disk cannot cause memory use to grow without bound. Everything recorded is written
+    by :meth:`flush` and by :meth:`close`, which should be called once the exporter is no
+    longer needed, and is called when it is used as a context manager and at exit.
+    An exception raised while writing is raised again by every later operation recording
+    history, and by :meth:`flush` and :meth:`close`, so that nothing more is accepted
+    once the file can no longer be completely written.
+
+    >>> with HistoryExporter("history.jsonl") as exporter:
+    ...     m.activation_history = exporter
+    ...     ...
+    """
+
+    FORMATS = ("jsonl", "csv", "parquet")
+
+    _COLUMNS = ("query", "time", "probe", "name", "creation_time", "attributes",
+                "references", "base_activation", "activation_noise", "spreading_activation",
+                "importance", "mismatch", "activation", "retrieval_probability")
+
+    def __init__(self, path, format=None, batch_size=10000, max_pending=1000):
+        if format is None:
+            extension = os.path.splitext(path)[1].lower().lstrip(".")
+            format = extension if extension in self.FORMATS else "jsonl"
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown history format {format}, must be one of {self.FORMATS}")
+        if format == "parquet" and pyarrow is None:
+            path = os.path.splitext(path)[0] + ".csv"
+            warn(f"pyarrow is not installed, so writing history as CSV to {path}")
+            format = "csv"
+        self._path = path
+        self._format = format
+        self._batch_size = batch_size
+        self._queue = queue.Queue(max_pending)
+        self._queries = 0
+        self._rows = 0
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        if format == "parquet":
+            self._file = None
+            self._writer = None
+        else:
+            self._file = open(path, "w", newline="")
+            if format == "csv":
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(self._COLUMNS)
+        self._thread = threading.Thread(target=self._run, name=f"HistoryExporter {path}",
+                                        daemon=True)
+        self._thread.start()
+        _open_exporters.add(self)
+
+    @property
+    def path(self):
+        """The path of the file being written."""
+        return self._path
+
+    @property
+    def format(self):
+        """The format in which the file is being written."""
+        return self._format
+
+    @property
+    def rows(self):
+        """The number of rows written to the file so far."""
+        return self._rows
+
+    def __enter__(self):
+        return self
 
-    __slots__ = ["_name", "_memory", "_creation", "_references",
-                 "_base_activation_time", "_base_activation",
-                 "_spreading_activation", "_importance"] # added new properties
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"<HistoryExporter {self._format} {self._path}>"
+
+    def _record(self, batches):
+        self._check()
+        if self._closed:
+            raise ValueError(f"{self} is closed")
+        for b in batches:
+            b.freeze()
+        with self._lock:
+            query = self._queries
+            self._queries += 1
+        self._queue.put((query, batches))
+
+    def flush(self):
+        """Waits until everything recorded so far has been written to the file."""
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._check()
+
+    def close(self):
+        """Writes everything recorded, closes the file and stops the background thread.
+        Once closed an exporter can no longer record history. Closing an exporter that
+        is already closed does nothing.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        _open_exporters.discard(self)
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        pending = []
+        flushing = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    flushing = item
+                    self._write(pending)
+                    pending = []
+                    flushing = None
+                    item.set()
+                    continue
+                query, batches = item
+                for b in batches:
+                    for record in b.records():
+                        pending.append(dict(query=query, time=b.time, **record))
+                if len(pending) >= self._batch_size:
+                    self._write(pending)
+                    pending = []
+            self._write(pending)
+        except BaseException as e:
+            self._error = e
+            if flushing is not None:
+                # only now, so that flush() raises the error
+                flushing.set()
+            # keep consuming, so that nothing waits forever on a full queue
+            for item in iter(self._queue.get, None):
+                if isinstance(item, threading.Event):
+                    item.set()
+        finally:
+            try:
+                if self._format == "parquet":
+                    if self._writer is not None:
+                        self._writer.close()
+                else:
+                    self._file.close()
+            except BaseException as e:
+                # closing flushes what is buffered, so may fail for the same reason again
+                if self._error is None:
+                    self._error = e
+
+    def _write(self, records):
+        if self._format == "jsonl":
+            for r in records:
+                r["attributes"] = dict(r["attributes"])
+                self._file.write(json.dumps(r, default=str))
+                self._file.write("\n")
+            self._file.flush()
+        else:
+            rows = []
+            for r in records:
+                r["attributes"] = json.dumps(dict(r["attributes"]), default=str)
+                rows.append([r.get(c) for c in self._COLUMNS])
+            if self._format == "csv":
+                self._writer.writerows(rows)
+                self._file.flush()
+            elif rows:
+                self._write_parquet(rows)
+        self._rows += len(records)
+
+    def _write_parquet(self, rows):
+        columns = dict(zip(self._COLUMNS, map(list, zip(*rows))))
+        if self._writer is None:
+            string = pyarrow.string()
+            real = pyarrow.float64()
+            integer = pyarrow.int64()
+            types = dict(query=integer, probe=integer, name=string, attributes=string,
+                         references=integer)
+            schema = pyarrow.schema([(c, types.get(c, real)) for c in self._COLUMNS])
+            self._writer = parquet.ParquetWriter(self._path, schema)
+        self._writer.write_table(pyarrow.Table.from_pydict(columns,
+                                                           schema=self._writer.schema))
+
+
+# The exporters not yet closed, which are closed at exit; weakly held, so that this does
+# not of itself keep them alive.
+_open_exporters = weakref.WeakSet()
+
+@atexit.register
+def _close_exporters():
+    for exporter in list(_open_exporters):
+        exporter.close()
+
+
+class _HistoryBatch:
+    """The quantities underlying the activations computed for one probe, from which the
+    activation_history entries for its chunks are made once its operation is complete.
+    For a blend the retrieval probabilities are added, with the indices of the chunks
+    blended over, for the others of which there is no retrieval probability.
+    """
+
+    __slots__ = ["chunks", "time", "base", "noise", "spreading", "importance", "mismatch",
+                 "activation", "probe", "blended", "probability", "_frozen"]
+
+    def __init__(self, chunks, time, base, noise, spreading, importance, mismatch,
+                 activation):
+        self.chunks = chunks
+        self.time = time
+        self.base = base
+        self.noise = noise
+        self.spreading = spreading
+        self.importance = importance
+        self.mismatch = mismatch
+        self.activation = activation
+        self.probe = None
+        self.blended = None
+        self.probability = None
+        self._frozen = None
+
+    def freeze(self):
+        # Captures the chunks' numbers of references and spreading activations as they
+        # are now, for use by records() after they may have changed; the references
+        # themselves are not copied, as that would cost time proportional to their number.
+        self._frozen = [(c._reference_count(), c.spreading_activation) for c in self.chunks]
+
+    def column(self, field):
+        # The values of one of ActivationTrace's per chunk fields, as a NumPy array.
+        if field == "chunk":
+            return np.fromiter((c._serial for c in self.chunks), np.int64, len(self.chunks))
+        value = dict(base_activation=self.base,
+                     activation_noise=self.noise,
+                     spreading_activation=self.spreading,
+                     importance=self.importance,
+                     mismatch=self.mismatch,
+                     activation=self.activation,
+                     retrieval_probability=self.probability)[field]
+        if value is None:
+            return np.full(len(self.chunks), np.nan)
+        return value
+
+    def records(self):
+        # The dictionaries appended to an activation_history that is a list.
+        base = self.base.tolist()
+        noise = self.noise.tolist()
+        importance = self.importance.tolist()
+        activation = self.activation.tolist()
+        mismatch = None if self.mismatch is None else self.mismatch.tolist()
+        probabilities = {}
+        if self.blended is not None:
+            for i, p in zip(self.blended, self.probability[self.blended].tolist()):
+                probabilities[i] = None if math.isnan(p) else p
+        result = []
+        for i, chunk in enumerate(self.chunks):
+            if self._frozen:
+                references, spreading = self._frozen[i]
+            else:
+                references = chunk._reference_history()
+                spreading = chunk.spreading_activation
+            history = OrderedDict(name=chunk._name,
+                                  creation_time=chunk._creation,
+                                  attributes=tuple(chunk._items()),
+                                  references=references,
+                                  base_activation=base[i],
+                                  activation_noise=noise[i],
+                                  spreading_activation=spreading,
+                                  importance=importance[i])
+            if mismatch is not None:
+                history["mismatch"] = mismatch[i]
+            history["activation"] = activation[i]
+            if self.probe is not None:
+                history["probe"] = self.probe
+            if i in probabilities:
+                history["retrieval_probability"] = probabilities[i]
+            result.append(history)
+        return result
+
+
+def _outcome_attributes(outcome_attribute):
+    # The outcome attribute, or list or tuple of them, passed to blend(), as a tuple.
+    if isinstance(outcome_attribute, (list, tuple)):
+        if not outcome_attribute:
+            raise ValueError("At least one outcome attribute must be given")
+        return tuple(outcome_attribute)
+    return (outcome_attribute,)
+
+
+def _outcome_array(attribute, values):
+    # Returns the values of attribute to be blended as a NumPy array, one dimensional if
+    # they are all real numbers, or two dimensional if they are all sequences of real
+    # numbers of the same length.
+    if all(isinstance(v, numbers.Real) for v in values):
+        return np.array(values, dtype=float)
+    for v in values:
+        if (isinstance(v, (str, bytes)) or not isinstance(v, (abc.Sequence, np.ndarray))
+                or not all(isinstance(x, numbers.Real) for x in v)):
+            raise TypeError(f"The value of {attribute}, {v}, is not a real number, or a sequence of them")
+    try:
+        result = np.array(values, dtype=float)
+    except ValueError:
+        result = None
+    if result is None or result.ndim != 2:
+        raise TypeError(f"The values of {attribute} are not all real numbers, or all sequences of them of the same length")
+    return result
+
+
+class _SparseMatchMatrix:
+    """A minimal boolean compressed sparse row matrix, used when SciPy is not installed."""
+
+    __slots__ = ["shape", "indptr", "indices"]
+
+    def __init__(self, indptr, indices, shape):
+        self.shape = shape
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.indices = np.asarray(indices, dtype=np.intp)
+
+    @property
+    def data(self):
+        return np.ones(len(self.indices), dtype=bool)
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def sum(self, axis=None):
+        if axis is None:
+            return self.nnz
+        elif axis in (1, -1):
+            return np.diff(self.indptr)
+        elif axis == 0:
+            return np.bincount(self.indices, minlength=self.shape[1])
+        raise ValueError(f"Invalid axis, {axis}")
+
+    def toarray(self):
+        result = np.zeros(self.shape, dtype=bool)
+        result[np.repeat(np.arange(self.shape[0]), np.diff(self.indptr)), self.indices] = True
+        return result
+
+    def __repr__(self):
+        return f"<_SparseMatchMatrix {self.shape[0]}x{self.shape[1]} with {self.nnz} matches>"
+
+
+def _match_matrix(indptr, indices, shape):
+    if sparse is not None:
+        return sparse.csr_matrix((np.ones(len(indices), dtype=bool),
+                                  np.asarray(indices, dtype=np.intp),
+                                  np.asarray(indptr, dtype=np.intp)),
+                                 shape=shape)
+    return _SparseMatchMatrix(indptr, indices, shape)
+
+
+def _time_array(times):
+    # The times, an iterable, as a NumPy array: of integers if they all are, so that they
+    # can be restored as they were, and otherwise of floating point numbers.
+    times = list(times)
+    if all(isinstance(t, numbers.Integral) for t in times):
+        return np.array(times, np.int64)
+    return np.array(times, float)
+
+
+def _customized_arguments(function, memory, argument):
+    # The arguments with which to call a customized sji or matching function: the Memory
+    # and argument, as documented, or argument alone; or None if function cannot be
+    # called with either. The function must be the one stored on the class, not one
+    # fetched through an instance, which would be bound to the Memory already.
+    try:
+        signature = inspect.signature(function)
+    except TypeError:
+        return None             # not callable at all, typically None
+    except ValueError:
+        return (memory, argument)   # no signature available, as for some builtins
+    for arguments in ((memory, argument), (argument,)):
+        try:
+            signature.bind(*arguments)
+        except TypeError:
+            continue
+        return arguments
+    return None
+
+
+def _as_match_matrix(matrix):
+    if hasattr(matrix, "indptr") and hasattr(matrix, "indices"):
+        return matrix
+    matrix = np.asarray(matrix, dtype=bool)
+    rows, columns = np.nonzero(matrix)
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=matrix.shape[0]))))
+    return _match_matrix(indptr, columns, matrix.shape)
+
+
+class _Schema:
+    """The attribute names of chunks, in order, shared by all those having the same ones.
+    Also holds the names sorted, which is the order used in a Memory's keys, and the
+    permutation that puts a chunk's values into that order, None if it is the identity.
+    """
+
+    __slots__ = ["names", "positions", "key", "_order"]
+
+    def __init__(self, names):
+        self.names = names
+        self.positions = {n: i for i, n in enumerate(names)}
+        order = tuple(sorted(range(len(names)), key=names.__getitem__))
+        self.key = tuple(names[i] for i in order)
+        self._order = None if order == tuple(range(len(names))) else order
+
+    def ordered(self, values):
+        if self._order is None:
+            return values
+        return tuple(values[i] for i in self._order)
+
+
+class Chunk(abc.Mapping):
+    """A learned item, presenting its attributes as a read-only mapping.
+    Rather than holding its own dictionary a chunk holds only a tuple of its values, its
+    attribute names being held by a schema shared with all the other chunks having the
+    same ones. A chunk is therefore no longer a :class:`dict`, as it once was: it
+    compares equal to a dictionary of the same attributes, and :meth:`copy` still returns
+    one, but ``isinstance(chunk, dict)`` is false, and where a real dictionary is needed,
+    for example by :func:`json.dumps`, ``dict(chunk)`` should be used.
+    """
+
+    __slots__ = ["_name", "_serial", "_row", "_memory", "_schema", "_values", "_creation",
+                 "_references", "_importance"] # added new properties
 
     _name_counter = 0;
 
-    def __init__(self, memory, content):
+    def __init__(self, memory, schema, values):
         self._name = f"{Chunk._name_counter:04d}"
+        self._serial = Chunk._name_counter
         Chunk._name_counter += 1
         self._memory = memory
-        self.update(content)
+        self._schema = schema
+        self._values = values
         self._creation = memory._time
-        self._references = 0 if memory._optimized_learning else []
-        self._base_activation_time = None
-        self._base_activation = None
-        self._spreading_activation = None
+        self._row = None
+        # With the columnar engine the reference times live in the engine's arrays, and
+        # the chunk itself only keeps count of them, as with optimized learning.
+        if memory._optimized_learning or memory._engine is not None:
+            self._references = 0
+        elif memory._recent_references:
+            self._references = _RecentReferences(memory._recent_references)
+        else:
+            self._references = []
         self._importance = 0
 
     def __repr__(self):
-        return "<Chunk {} {}>".format(self._name, dict(self))
+        return "<Chunk {} {}>".format(self._name, dict(self._items()))
 
     def __str__(self):
         return self._name
 
-    def _activation(self, for_partial=False):
-        # Does not include the mismatch penalty component, that's handled by the caller.
-        base = self._get_base_activation()
-        noise = self._memory._make_noise()
-        spreading_activation = self._spreading_activation if self._spreading_activation else 0 # m spreads to chunk(self)
-        importance = self._importance
-        result = base + spreading_activation + importance + noise 
-        if self._memory._activation_history is not None:
-            history = OrderedDict(name=self._name,
-                                  creation_time=self._creation,
-                                  attributes=tuple(self.items()),
-                                  references=(self._references
-                                              if self._memory.optimized_learning
-                                              else tuple(self._references)),
-                                  base_activation=base,
-                                  activation_noise=noise,
-                                  spreading_activation=self._spreading_activation,
-                                  importance=importance)
-            if not for_partial:
-                history["activation"] = result
-            self._memory._activation_history.append(history)
-        return result
+    def __getitem__(self, key):
+        try:
+            return self._values[self._schema.positions[key]]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self._schema.positions
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def _items(self):
+        return zip(self._schema.names, self._values)
+
+    def copy(self):
+        """Returns a new :class:`dict` of this chunk's attributes and their values."""
+        return dict(self._items())
+
+    def _add_reference(self, time):
+        memory = self._memory
+        engine = memory._engine
+        if engine is not None:
+            engine.add_reference(self._row, time)
+            self._references += 1
+        elif memory._optimized_learning:
+            self._references += 1
+            memory._base_cache.invalidate(self._serial)
+        else:
+            self._references.append(time)
+            memory._base_cache.invalidate(self._serial)
+
+    def _add_references(self, times):
+        # Adds references at each of times, a list, at once.
+        memory = self._memory
+        engine = memory._engine
+        if engine is not None:
+            engine.add_references(self._row, times)
+            self._references += len(times)
+        elif memory._optimized_learning:
+            self._references += len(times)
+        else:
+            self._references.extend(times)
+        memory._base_cache.invalidate(self._serial)
+
+    def _remove_reference(self, time):
+        # Returns False, and changes nothing, if there is no reference at time to remove.
+        engine = self._memory._engine
+        if engine is not None:
+            if not engine.remove_reference(self._row, time):
+                return False
+            self._references -= 1
+        elif self._memory._optimized_learning:
+            self._references -= 1
+        else:
+            try:
+                self._references.remove(time)
+            except ValueError:
+                return False
+        self._memory._base_cache.invalidate(self._serial)
+        return True
+
+    def _reference_count(self):
+        # The number of references, as written by a HistoryExporter.
+        if self._memory._optimized_learning or self._memory._engine is not None:
+            return self._references
+        elif self._memory._recent_references:
+            return self._references.count
+        else:
+            return len(self._references)
+
+    def _reference_history(self):
+        # The value recorded as references in activation_history.
+        if self._memory._optimized_learning:
+            return self._references
+        elif self._memory._engine is not None:
+            return self._memory._engine.references(self._row)
+        elif self._memory._recent_references:
+            return (self._references.count, tuple(sorted(self._references.recent)))
+        else:
+            return tuple(self._references)
 
     # Note that memoizing expt and ln doesn't make much difference, but it does speed
     # things up a tiny bit, most noticeably under PyPy
@@ -891,52 +3250,499 @@ class Chunk(dict):
             return math.log(arg)
 
     def _get_base_activation(self):
-        if self._base_activation_time != self._memory.time:
+        memory = self._memory
+        if memory._engine is not None:
+            return float(memory._base_activations([self])[0])
+        result = memory._base_cache.get(self._serial, memory._time)
+        if result is None:
             try:
-                if self._memory._optimized_learning:
-                    self._base_activation = (self._cached_ln(self._references)
-                                             - self._memory._ln_1_mius_d
-                                             - self._memory._decay * self._cached_ln(self._memory._time - self._creation))
+                if memory._optimized_learning:
+                    result = (self._cached_ln(self._references)
+                              - memory._ln_1_mius_d
+                              - memory._decay * self._cached_ln(memory._time - self._creation))
+                elif memory._recent_references:
+                    refs = self._references
+                    base = sum(self._cached_expt(memory._time - ref) for ref in refs.recent)
+                    if refs.count > len(refs.recent):
+                        oldest = min(refs.recent) if refs.recent else self._creation
+                        base += _approximate_tail(refs.count - len(refs.recent),
+                                                  memory._time - self._creation,
+                                                  memory._time - oldest,
+                                                  memory._decay)
+                    result = math.log(base)
                 else:
-                    base = sum(self._cached_expt(self._memory._time - ref)
+                    base = sum(self._cached_expt(memory._time - ref)
                                for ref in self._references)
-                    self._base_activation = math.log(base)
+                    result = math.log(base)
             except ValueError as e:
-                if self._memory._time <= self._creation:
+                if memory._time <= self._creation:
                     raise RuntimeError("Can't compute activation of a chunk at or before the time it was created")
                 else:
                     raise e
-            self._base_activation_time = self._memory.time
-        return self._base_activation
+            memory._base_cache.put(self._serial, memory._time, result)
+        return result
     
     @property
     def spreading_activation(self):
-        return self._spreading_activation
+        # held by the Memory, in the mapping in effect (see Memory.context())
+        return self._memory._active_spreading().get(self._serial)
 
     @spreading_activation.setter
+    @_chunk_writes
     def spreading_activation(self, value):
         """By default, spreading_activation is 0
-        Chunk's spreading_activation is added when spreading() is called"""
-        if value and self._spreading_activation:
-            self._spreading_activation+=value
+        Chunk's spreading_activation is added when spreading() is called
+        It is the value set by spread() that is changed, so it cannot be set while a
+        context is active, as a context's values are computed from its sources alone;
+        attempting to do so raises a RuntimeError."""
+        if self._memory._context_stack():
+            raise RuntimeError("A chunk's spreading_activation cannot be set while a context is active")
+        spreading = self._memory._spreading
+        current = spreading.get(self._serial)
+        if value is None:
+            spreading.pop(self._serial, None)
+        elif value and current:
+            spreading[self._serial] = current + value
         else:
-            self._spreading_activation=value
+            spreading[self._serial] = value
     
+    @property
+    def _spreading_activation(self):
+        # the name under which it was formerly an attribute of the chunk
+        return self.spreading_activation
+
     @property
     def importance(self):
         return self._importance
 
     @importance.setter
+    @_chunk_writes
     def importance(self, value):
         """By default, importance is turned off (set 0). If set None/False, it is uniformally distributed 0-2. 
         importance cannot be negative number"""
         if value is None or value is False:
-            p = random.uniform(sys.float_info.epsilon, 2 - sys.float_info.epsilon)
+            p = self._memory._rng.uniform(sys.float_info.epsilon, 2 - sys.float_info.epsilon)
             self._importance = math.log(p)
         elif value < 0:
             raise ValueError(f"The importance, {value}, must not be negative")
         else:
             self._importance = float(value)
+        if self._row is not None:
+            self._memory._engine.importance[self._row] = self._importance
+
+class _RecentReferences:
+    """The references of a chunk under the hybrid form of optimized learning.
+    Retains the times of at most limit of the most recent references, together with the
+    total count of them. Supports the append() and remove() used on the plain list of
+    times otherwise used; a reference earlier than all those retained can only be
+    removed on trust, by decrementing the count.
+    """
+
+    __slots__ = ["limit", "count", "recent"]
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.recent = []
+
+    def __bool__(self):
+        return self.count > 0
+
+    def append(self, time):
+        self.count += 1
+        if len(self.recent) < self.limit:
+            self.recent.append(time)
+        else:
+            i = min(range(self.limit), key=self.recent.__getitem__)
+            if time > self.recent[i]:
+                self.recent[i] = time
+
+    def extend(self, times):
+        self.count += len(times)
+        self.recent = heapq.nlargest(self.limit, self.recent + list(times))
+
+    def remove(self, time):
+        if time in self.recent:
+            self.recent.remove(time)
+        elif self.count <= len(self.recent) or (self.recent and time > min(self.recent)):
+            raise ValueError(f"No reference at {time}")
+        self.count -= 1
+
+
+def _approximate_tail(n, oldest_age, recent_age, decay):
+    # Petrov's approximation of the sum of age ** -decay over n references whose ages are
+    # assumed to be spread evenly between that of the chunk's creation, oldest_age, and
+    # that of the oldest reference still retained, recent_age. The arguments may be
+    # floats or NumPy arrays.
+    span = oldest_age - recent_age
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spread = (n * (np.power(oldest_age, 1 - decay) - np.power(recent_age, 1 - decay))
+                  / ((1 - decay) * span))
+    return np.where(span > 0, spread, n * np.power(oldest_age, -decay)) * 1.0
+
+
+class _ReadWriteLock:
+    """A lock that may be held by any number of threads reading, or by one writing.
+    Both are reentrant, and the thread writing may also read; but a thread that is only
+    reading may not then write, as it would wait forever for itself to finish. Threads
+    waiting to write take precedence over those starting to read, so that a stream of
+    reads cannot hold off a write indefinitely.
+    """
+
+    __slots__ = ["_condition", "_readers", "_writer", "_writes", "_waiting", "_local"]
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+        self._local = threading.local()
+
+    def acquire_read(self):
+        if self._writer == threading.get_ident():
+            return
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if not depth:
+            with self._condition:
+                while self._writer is not None or self._waiting:
+                    self._condition.wait()
+                self._readers += 1
+        local.depth = depth + 1
+
+    def release_read(self):
+        if self._writer == threading.get_ident():
+            return
+        local = self._local
+        local.depth -= 1
+        if not local.depth:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._writes += 1
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("A Memory cannot be modified by a thread while it is reading it")
+        with self._condition:
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        self._writes -= 1
+        if not self._writes:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+class _BaseActivationCache:
+    """Memoizes chunks' base activations, keyed by chunk serial number and time.
+    Only the value at the most recent time is remembered for each chunk: time never goes
+    backwards, and a chunk's entry is invalidated whenever its references change, or
+    the whole cache cleared when the decay does.
+    """
+
+    __slots__ = ["_entries"]
+
+    def __init__(self):
+        self._entries = {}
+
+    def clear(self):
+        self._entries.clear()
+
+    def get(self, serial, time):
+        entry = self._entries.get(serial)
+        return entry[1] if entry is not None and entry[0] == time else None
+
+    def put(self, serial, time, value):
+        # Called while computing activations, which may be done by several threads at
+        # once in a concurrent Memory; a chunk's entry is a single tuple, replaced as a
+        # whole, so another thread never sees a time paired with the wrong value. The
+        # other methods are only called when modifying the Memory, by a single thread.
+        self._entries[serial] = (time, value)
+
+    def invalidate(self, serial):
+        self._entries.pop(serial, None)
+
+    def bound(self, serial, time):
+        # The value memoized at a time not after time, or infinity if none is.
+        entry = self._entries.get(serial)
+        return entry[1] if entry is not None and entry[0] <= time else math.inf
+
+
+def _ragged_index(offsets, counts):
+    # Returns the indices of all the elements of the segments of a flat array starting at
+    # offsets and of lengths counts, concatenated in order, and the indices at which
+    # each segment starts within that result.
+    starts = np.cumsum(counts) - counts
+    return np.repeat(offsets - starts, counts) + np.arange(counts.sum()), starts
+
+
+class _ColumnarEngine:
+    """Stores the references of all of a Memory's chunks in NumPy arrays.
+    Each chunk is assigned a row; the reference times of the chunk in a given row occupy a
+    contiguous segment, described by offset, length and capacity, of the single flat
+    times array. When a segment fills it is moved, with twice the capacity, to the end
+    of the array, and the array is compacted once more than half of it is abandoned.
+    With optimized learning no times are stored, and length is just the count. With the
+    hybrid form of it, recent, a segment holds at most that many of the most recent times,
+    and count holds the total number of references.
+    """
+
+    _INITIAL_ROWS = 64
+    _INITIAL_TIMES = 256
+
+    def __init__(self, optimized_learning=False, recent=None):
+        self._optimized = optimized_learning
+        self._recent = recent
+        self._rows = 0
+        self._free = []
+        self.offset = np.zeros(self._INITIAL_ROWS, np.intp)
+        self.length = np.zeros(self._INITIAL_ROWS, np.intp)
+        self.capacity = np.zeros(self._INITIAL_ROWS, np.intp)
+        self.count = np.zeros(self._INITIAL_ROWS, np.intp)
+        self.creation = np.zeros(self._INITIAL_ROWS)
+        self.importance = np.zeros(self._INITIAL_ROWS)
+        # the most recently computed base activation of each row, and the time at which
+        # it was computed, NaN if there is none or it is no longer valid
+        self.cached_time = np.full(self._INITIAL_ROWS, np.nan)
+        self.cached_base = np.zeros(self._INITIAL_ROWS)
+        self.times = np.empty(0 if optimized_learning else self._INITIAL_TIMES)
+        self._end = 0
+        self._waste = 0
+
+    def _grow_rows(self):
+        n = 2 * len(self.offset)
+        for name in ("offset", "length", "capacity", "count", "creation", "importance",
+                     "cached_time", "cached_base"):
+            old = getattr(self, name)
+            new = np.full(n, np.nan) if name == "cached_time" else np.zeros(n, old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def clear_base_activations(self):
+        self.cached_time[:] = np.nan
+
+    def restore(self, creation, importance, count, length, times):
+        # Replaces the contents of this engine, which must be empty, with the references
+        # of a snapshot, assigning row i to the ith chunk in it. The times array is
+        # adopted as is, and may be memory mapped.
+        n = len(creation)
+        while len(self.offset) < n:
+            self._grow_rows()
+        self._rows = n
+        self.creation[:n] = creation
+        self.importance[:n] = importance
+        if self._optimized:
+            self.length[:n] = count
+            return
+        self.length[:n] = length
+        self.capacity[:n] = length
+        self.offset[:n] = np.cumsum(length) - length
+        self.count[:n] = count
+        # the times of a snapshot of a Memory that was not columnar may be integers
+        self.times = times if times.dtype == float else times.astype(float)
+        self._end = len(times)
+
+    def add_chunk(self, chunk):
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._rows == len(self.offset):
+                self._grow_rows()
+            row = self._rows
+            self._rows += 1
+        self.offset[row] = self._end
+        self.length[row] = 0
+        self.capacity[row] = 0
+        self.count[row] = 0
+        self.creation[row] = chunk._creation
+        self.importance[row] = chunk._importance
+        self.cached_time[row] = np.nan
+        chunk._row = row
+
+    def remove_chunk(self, chunk):
+        row = chunk._row
+        self._waste += self.capacity[row]
+        self.length[row] = 0
+        self.capacity[row] = 0
+        self._free.append(row)
+        chunk._row = None
+
+    def rows(self, chunks):
+        return np.fromiter((c._row for c in chunks), np.intp, len(chunks))
+
+    def references(self, row):
+        off = self.offset[row]
+        if self._recent:
+            return (int(self.count[row]),
+                    tuple(np.sort(self.times[off:off + self.length[row]]).tolist()))
+        return tuple(self.times[off:off + self.length[row]].tolist())
+
+    def add_reference(self, row, time):
+        n = self.length[row]
+        if self._recent:
+            self.count[row] += 1
+            self.cached_time[row] = np.nan
+            if n == self._recent:
+                # replace the oldest retained time, which joins the approximated ones
+                segment = self.times[self.offset[row]:self.offset[row] + n]
+                i = np.argmin(segment)
+                if time > segment[i]:
+                    segment[i] = time
+                return
+            if n == self.capacity[row]:
+                self._relocate(row, min(self._recent, max(4, 2 * n)))
+            self.times[self.offset[row] + n] = time
+        elif not self._optimized:
+            if n == self.capacity[row]:
+                self._relocate(row, max(4, 2 * n))
+            self.times[self.offset[row] + n] = time
+            self.cached_time[row] = np.nan
+        else:
+            self.cached_time[row] = np.nan
+        self.length[row] = n + 1
+
+    def add_references(self, row, times):
+        # Adds references at each of times, a list, at once, as add_reference would one
+        # at a time, except that any cached base activation is simply invalidated.
+        n = self.length[row]
+        k = len(times)
+        self.cached_time[row] = np.nan
+        if self._optimized:
+            self.length[row] = n + k
+            return
+        off = self.offset[row]
+        if self._recent:
+            self.count[row] += k
+            retained = np.concatenate((self.times[off:off + n], times))
+            if len(retained) > self._recent:
+                retained = np.sort(retained)[-self._recent:]
+            if len(retained) > self.capacity[row]:
+                self._relocate(row, min(self._recent, max(4, 2 * len(retained))))
+        else:
+            retained = np.asarray(times, dtype=float)
+            if n + k > self.capacity[row]:
+                self._relocate(row, max(4, 2 * (n + k)))
+        off = self.offset[row]
+        if self._recent:
+            self.times[off:off + len(retained)] = retained
+            self.length[row] = len(retained)
+        else:
+            self.times[off + n:off + n + k] = retained
+            self.length[row] = n + k
+
+    def remove_reference(self, row, time):
+        n = self.length[row]
+        if not self._optimized:
+            segment = self.times[self.offset[row]:self.offset[row] + n]
+            found = np.flatnonzero(segment == time)
+            if (self._recent and not len(found) and self.count[row] > n
+                    and not (n and time > segment.min())):
+                self.count[row] -= 1        # an approximated reference, removed on trust
+                self.cached_time[row] = np.nan
+                return True
+            if not len(found):
+                return False
+            i = found[0]
+            segment[i:n - 1] = segment[i + 1:n]
+            if self._recent:
+                # only kept in the hybrid case, as in add_reference
+                self.count[row] -= 1
+        self.length[row] = n - 1
+        self.cached_time[row] = np.nan
+        return True
+
+    def _relocate(self, row, capacity):
+        if self._end + capacity > len(self.times):
+            if self._waste > self._end // 2:
+                self._compact()
+            if self._end + capacity > len(self.times):
+                times = np.empty(max(2 * len(self.times), self._end + capacity))
+                times[:self._end] = self.times[:self._end]
+                self.times = times
+        off = self.offset[row]
+        n = self.length[row]
+        self.times[self._end:self._end + n] = self.times[off:off + n]
+        self._waste += self.capacity[row]
+        self.offset[row] = self._end
+        self.capacity[row] = capacity
+        self._end += capacity
+
+    def reclaim(self):
+        # Compacts the times array if more than half of it has been abandoned.
+        if self._waste > self._end // 2:
+            self._compact()
+
+    def _compact(self):
+        live = np.flatnonzero(self.capacity[:self._rows])
+        capacity = self.capacity[live]
+        offset = np.cumsum(capacity) - capacity
+        counts = self.length[live]
+        source, _ = _ragged_index(self.offset[live], counts)
+        destination, _ = _ragged_index(offset, counts)
+        times = np.empty(len(self.times))
+        times[destination] = self.times[source]
+        self.times = times
+        self.offset[live] = offset
+        self._end = int(capacity.sum())
+        self._waste = 0
+
+    def base_activations(self, rows, memory):
+        time = memory._time
+        if not len(rows):
+            return np.empty(0)
+        missing = rows[self.cached_time[rows] != time]
+        if len(missing):
+            # Threads reading a concurrent Memory at once may both fill in the same rows,
+            # but all at the same time, and so with the same values; the base activation
+            # is stored before the time, so a row is never seen with a stale one.
+            self.cached_base[missing] = self._compute_base_activations(missing, memory)
+            self.cached_time[missing] = time
+        return self.cached_base[rows]
+
+    def _compute_base_activations(self, rows, memory):
+        time = memory._time
+        decay = memory._decay
+        creation = self.creation[rows]
+        if np.any(creation >= time):
+            raise RuntimeError("Can't compute activation of a chunk at or before the time it was created")
+        counts = self.length[rows]
+        if self._optimized:
+            return np.log(counts) - memory._ln_1_mius_d - decay * np.log(time - creation)
+        index, starts = _ragged_index(self.offset[rows], counts)
+        ages = time - self.times[index]
+        if np.any(ages < 0) or (decay and not np.all(ages)):
+            raise ValueError("math domain error")
+        # segments may be empty in the hybrid case, which reduceat cannot cope with
+        segment = np.repeat(np.arange(len(rows)), counts)
+        sums = np.bincount(segment, weights=ages ** -decay, minlength=len(rows))
+        if self._recent:
+            oldest = creation.copy()
+            retained = np.flatnonzero(counts)
+            if len(retained):
+                oldest[retained] = np.minimum.reduceat(self.times[index], starts[retained])
+            tail = self.count[rows] - counts
+            approximated = np.flatnonzero(tail)
+            if len(approximated):
+                sums[approximated] += _approximate_tail(tail[approximated],
+                                                        (time - creation)[approximated],
+                                                        (time - oldest)[approximated],
+                                                        decay)
+        return np.log(sums)
+
 
 # Local variables:
 # fill-column: 90
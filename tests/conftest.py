@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import pyactup_v2 as pyactup
+
+
+@pytest.fixture
+def similarity_functions():
+    # Yields set_similarity_function, removing whatever it was used to set afterwards,
+    # since similarity functions are shared by all Memories.
+    attributes = []
+    def set_function(function, *names):
+        attributes.extend(names)
+        pyactup.set_similarity_function(function, *names)
+    yield set_function
+    for name in attributes:
+        pyactup.Memory._similarity_functions.pop(name, None)
+    pyactup.Memory._clamped_similarity.cache_clear()
+
+
+@pytest.fixture
+def size_similarity(similarity_functions):
+    similarity_functions(lambda x, y: 1 - abs(x - y) / 20, "size")
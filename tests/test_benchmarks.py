@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "benchmarks")
+
+
+def run(script, *arguments):
+    return subprocess.run([sys.executable, os.path.join(BENCHMARKS, script), *arguments],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=300)
+
+
+def test_bench_memory(tmp_path):
+    output = tmp_path / "results.json"
+    grid = ["--chunks", "50", "--references", "3", "--slots", "3", "--noise", "0.25",
+            "--columnar", "0", "1", "--repeat", "1", "--number", "1", "--no-footprint"]
+    result = run("bench_memory.py", *grid, "--output", str(output))
+    assert result.returncode == 0, result.stderr
+    assert output.exists()
+    json.loads(output.read_text())
+    # a generous tolerance, as only the comparison itself is being checked
+    result = run("bench_memory.py", *grid, "--compare", str(output), "--tolerance", "1000")
+    assert result.returncode == 0, result.stderr
+
+
+def test_learning_modes(tmp_path):
+    output = tmp_path / "modes.json"
+    result = run("learning_modes.py", "--chunks", "20", "--references", "5",
+                 "--recent", "1", "3", "--repeat", "1", "--json", str(output))
+    assert result.returncode == 0, result.stderr
+    assert output.exists()
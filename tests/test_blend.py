@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def build():
+    m = pyactup.Memory(noise=0, temperature=1)
+    for i in range(10):
+        m.learn(kind="a", x=i, y=i * i, xy=(i, i * i))
+        m.advance()
+    m.learn(kind="a", x=100)
+    m.learn(kind="b", x=-1, y=-1, xy=(-1, -1))
+    m.advance()
+    return m
+
+
+def test_vector_blend_is_elementwise():
+    m = build()
+    result = m.blend("xy", kind="a")
+    assert isinstance(result, np.ndarray) and result.shape == (2,)
+    # the chunk with only x is not blended over for xy, but is for x
+    assert result[1] == pytest.approx(m.blend("y", kind="a"))
+    assert result[0] != pytest.approx(m.blend("x", kind="a"))
+    assert m.blend("xy", kind="c") is None
+
+
+def test_multiple_outcomes():
+    m = build()
+    result = m.blend(["x", "y", "xy"], kind="a")
+    assert set(result) == {"x", "y", "xy"}
+    assert result["y"] == pytest.approx(m.blend("y", kind="a"))
+    assert result["xy"] == pytest.approx([result["x"], result["y"]])
+    assert result["x"] < m.blend("x", kind="a")
+    with pytest.raises(ValueError):
+        m.blend([], kind="a")
+
+
+def test_blend_type_errors():
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(v=(1, 2))
+    m.learn(v=(1, 2, 3))
+    m.learn(w="word")
+    m.learn(w=1)
+    m.advance()
+    with pytest.raises(TypeError):
+        m.blend("v")
+    with pytest.raises(TypeError):
+        m.blend("w")
+
+
+@pytest.mark.parametrize("offset", [0, 800, 1e6])
+def test_large_activations_do_not_overflow(offset):
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(x=0, importance=offset)
+    m.learn(x=1, importance=offset + 1)
+    m.learn(x=2, importance=offset + 2)
+    m.advance()
+    e = np.exp([0, 1, 2])
+    expected = (e[1] + 2 * e[2]) / e.sum()
+    with np.errstate(all="raise"):
+        assert m.blend("x") == pytest.approx(expected)
+        assert m.blend_many("x", [{}, dict(x=2)]) == pytest.approx([expected, 2])
+        chunks, probabilities = m.retrieval_probabilities()
+        assert probabilities == pytest.approx(e / e.sum())
+
+
+def test_low_temperature():
+    m = pyactup.Memory(noise=0, temperature=0.01)
+    m.learn(x=0)
+    m.advance(10)
+    m.learn(x=1)
+    m.advance()
+    with np.errstate(all="raise"):
+        assert m.blend("x") == pytest.approx(1)
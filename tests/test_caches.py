@@ -0,0 +1,51 @@
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def base_activations(m, **probe):
+    m.activation_history = []
+    m.retrieve(**probe)
+    result = {e["attributes"]: e["base_activation"] for e in m.activation_history}
+    m.activation_history = None
+    return result
+
+
+def replay(learning, query):
+    # Performs a series of steps on a new Memory, querying it after each if query is
+    # true, and returns the final base activations, which the queries must not change.
+    # Only the later steps, which change the past, can do so without advancing the time.
+    m = pyactup.Memory(noise=0, temperature=1, **learning)
+    steps = [lambda: (m.learn(color="red"), m.learn(color="blue"), m.advance()),
+             lambda: m.advance(),
+             lambda: (m.learn(color="red"), m.advance()),
+             lambda: (m.learn(color="blue"), m.learn(color="green"), m.advance()),
+             lambda: m.forget(3, color="blue"),
+             lambda: m.learn_many([dict(color="red"), dict(color="green")], times=[1, 2]),
+             lambda: setattr(m, "decay", 0.8),
+             lambda: m.forget(0, color="red")]
+    for step in steps:
+        step()
+        if query:
+            m.retrieve(color="red")
+            m.retrieve_top_k(2)
+    return base_activations(m)
+
+
+@pytest.mark.parametrize("learning", [{}, dict(optimized_learning=True), dict(recent_references=2)])
+def test_base_activation_cache_follows_learn_and_forget(learning):
+    expected = replay(learning, False)
+    assert len(expected) == 3
+    assert replay(learning, True) == pytest.approx(expected)
+
+
+def test_repeated_queries_agree():
+    m = pyactup.Memory(noise=0, temperature=1)
+    for i in range(20):
+        m.learn(color="red" if i % 3 else "blue", size=i % 5)
+        m.advance()
+    first = base_activations(m)
+    assert base_activations(m) == first
+    m.advance()
+    later = base_activations(m)
+    assert all(later[k] < v for k, v in first.items())
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def test_chunk_is_a_mapping():
+    m = pyactup.Memory()
+    m.learn(color="red", size=2)
+    m.advance()
+    chunk = m.retrieve()
+    assert chunk == dict(color="red", size=2)
+    assert chunk["size"] == 2
+    assert chunk.get("weight") is None
+    assert "color" in chunk and "weight" not in chunk
+    assert list(chunk) == ["color", "size"]
+    assert list(chunk.items()) == [("color", "red"), ("size", 2)]
+    assert len(chunk) == 2
+    assert not isinstance(chunk, dict)
+    copy = chunk.copy()
+    assert type(copy) is dict and copy == chunk
+    assert json.loads(json.dumps(dict(chunk))) == copy
+    with pytest.raises(KeyError):
+        chunk["weight"]
+    with pytest.raises(TypeError):
+        chunk["size"] = 3
+
+
+def test_attribute_order_does_not_matter():
+    m = pyactup.Memory()
+    assert m.learn(color="red", size=2)
+    assert not m.learn(size=2, color="red")
+    assert len(m) == 1
+    m.advance()
+    assert m.retrieve(size=2, color="red") is m.retrieve(color="red")
+    assert m.forget(0, size=2, color="red")
+    assert m.forget(0, color="red", size=2)
+    assert len(m) == 0
+
+
+def test_chunks_share_schemas():
+    m = pyactup.Memory()
+    for i in range(3):
+        m.learn(color="red", size=i)
+        m.learn(size=i, color="blue")
+    schemas = {id(c._schema) for c in m.values()}
+    assert len(schemas) == 2
+
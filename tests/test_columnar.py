@@ -0,0 +1,62 @@
+import random
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def build(columnar, learning, seed=0):
+    m = pyactup.Memory(noise=0.25, temperature=1, mismatch=1, seed=seed,
+                       columnar=columnar, **learning)
+    rng = random.Random(seed)
+    for t in range(300):
+        m.learn(color=rng.choice("rgb"), size=rng.randrange(10))
+        if rng.random() < 0.1:
+            m.learn(color="k", size=rng.randrange(10))
+        m.advance(rng.choice([1, 1, 2, 0.5]))
+    m.forget(0, **dict(m.retrieve_top_k(1)[0]))
+    return m
+
+
+def operations(m):
+    # The results of a series of operations, each with its activation history keyed by
+    # the chunks' attributes, as their names and the order of the entries may differ.
+    operations = [lambda: m.retrieve(color="r"),
+                  lambda: m.retrieve(partial=True, size=3),
+                  lambda: m.blend("size", color="g"),
+                  lambda: m.retrieve_top_k(3, color="b"),
+                  lambda: m.advance(),
+                  lambda: m.retrieve(color="k")]
+    for operation in operations:
+        m.activation_history = []
+        result = operation()
+        yield result, {e["attributes"]: e for e in m.activation_history}
+
+
+@pytest.mark.parametrize("learning", [{}, dict(optimized_learning=True), dict(recent_references=4)])
+def test_columnar_agrees_with_lists(learning, size_similarity):
+    for (result, history), (expected, expected_history) in zip(
+            operations(build(True, learning)),
+            operations(build(False, learning))):
+        assert result == expected
+        assert history.keys() == expected_history.keys()
+        for attributes, entry in history.items():
+            for key in ("base_activation", "activation", "activation_noise"):
+                assert entry[key] == pytest.approx(expected_history[attributes][key], rel=1e-9)
+
+
+def test_columnar_reclaims_space():
+    m = pyactup.Memory(columnar=True, noise=0, temperature=1)
+    for i in range(100):
+        for j in range(10):
+            m.learn(x=i)
+        m.advance()
+    for i in range(0, 100, 2):
+        for j in range(10):
+            assert m.forget(i, x=i)
+        assert not m.forget(i, x=i)
+    assert len(m) == 50
+    assert sorted(c["x"] for c in m.retrieve_top_k(100)) == list(range(1, 100, 2))
+    m.learn(x=0)
+    m.advance()
+    assert m.retrieve(x=0) is not None
@@ -0,0 +1,96 @@
+import json
+import pickle
+import random
+import threading
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_readers_and_writer(columnar, tmp_path):
+    m = pyactup.Memory(seed=1, concurrent=True, columnar=columnar, max_chunks=3000)
+    path = tmp_path / "history.jsonl"
+    exporter = pyactup.HistoryExporter(str(path), max_pending=4)
+    m.activation_history = exporter
+    for i in range(1000):
+        m.learn(a=i % 50, b=i % 7, c=i)
+    m.advance()
+    errors = []
+    stop = threading.Event()
+    def reader(k):
+        context = m.context(a=k)
+        try:
+            while not stop.is_set():
+                with context:
+                    assert m.retrieve(b=k % 7)["b"] == k % 7
+                    m.blend("c", b=(k + 1) % 7)
+                    assert m._context_stack() == [context]
+                m.retrieve_top_k(3, a=k)
+        except Exception as e:
+            errors.append(e)
+    def writer():
+        rng = random.Random(0)
+        try:
+            for i in range(200):
+                with m.writing():
+                    m.learn(a=rng.randrange(60), b=rng.randrange(7), c=rng.randrange(4000))
+                    m.advance()
+                if i % 50 == 0:
+                    m.spread(auto_clear=True, a=3)
+        except Exception as e:
+            errors.append(e)
+    readers = [threading.Thread(target=reader, args=(k,)) for k in range(4)]
+    for t in readers:
+        t.start()
+    w = threading.Thread(target=writer)
+    w.start()
+    w.join()
+    stop.set()
+    for t in readers:
+        t.join()
+    exporter.close()
+    assert not errors
+    assert m.time == 201
+    queries = [json.loads(line)["query"] for line in path.read_text().splitlines()]
+    assert len(queries) == exporter.rows
+    assert set(queries) == set(range(max(queries) + 1))
+    m.activation_history = None
+    restored = pickle.loads(pickle.dumps(m))
+    assert restored.concurrent and len(restored) == len(m)
+
+
+def test_chunk_setters_wait_for_writer():
+    m = pyactup.Memory(concurrent=True)
+    m.learn(color="red")
+    m.advance()
+    chunk = m.retrieve()
+    done = threading.Event()
+    def set_values():
+        chunk.importance = 1
+        chunk.spreading_activation = 0.5
+        done.set()
+    with m.writing():
+        thread = threading.Thread(target=set_values)
+        thread.start()
+        assert not done.wait(0.2)
+        assert chunk.importance == 0
+        # the thread writing may set them itself
+        chunk.importance = 2
+    thread.join()
+    assert done.is_set()
+    assert chunk.importance == 1
+    assert chunk.spreading_activation == 0.5
+
+
+def test_no_modification_while_reading(similarity_functions):
+    m = pyactup.Memory(concurrent=True, noise=0, temperature=1)
+    m.learn(color="red")
+    m.advance()
+    similarity_functions(lambda x, y: (m.learn(other=1), 1)[1], "shade")
+    m.mismatch = 1
+    m.learn(shade=1)
+    m.advance()
+    with pytest.raises(RuntimeError):
+        m.retrieve(partial=True, shade=2)
@@ -0,0 +1,196 @@
+import csv
+import gc
+import json
+import os
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def make_memory():
+    m = pyactup.Memory(noise=0, temperature=1)
+    for i in range(3):
+        m.learn(color="red", size=i)
+        m.advance()
+    m.learn(color="red", size=0)
+    m.advance()
+    return m
+
+
+def test_list_history():
+    m = make_memory()
+    m.activation_history = []
+    m.retrieve(color="red", size=0)
+    m.blend("size", color="red")
+    history = m.activation_history
+    assert len(history) == 4
+    first = history[0]
+    assert list(first) == ["name", "creation_time", "attributes", "references",
+                           "base_activation", "activation_noise", "spreading_activation",
+                           "importance", "activation"]
+    assert first["references"] == (0, 3)
+    assert first["activation"] == pytest.approx(first["base_activation"])
+    assert sum(e["retrieval_probability"] for e in history[1:]) == pytest.approx(1)
+
+
+def test_trace_agrees_with_list():
+    m = make_memory()
+    m.activation_history = []
+    m.retrieve(color="red")
+    m.blend("size", color="red")
+    m.retrieve_many([dict(size=0), dict(size=2)])
+    expected = m.activation_history
+    m.activation_history = trace = pyactup.ActivationTrace(size=100)
+    m.retrieve(color="red")
+    m.blend("size", color="red")
+    m.retrieve_many([dict(size=0), dict(size=2)])
+    assert len(trace) == trace.rows == len(expected)
+    assert trace.queries == 3
+    columns = trace.columns()
+    assert columns["query"].tolist() == [0, 0, 0, 1, 1, 1, 2, 2]
+    assert columns["probe"].tolist() == [0, 0, 0, 0, 0, 0, 0, 1]
+    assert columns["chunk"].tolist() == [int(e["name"]) for e in expected]
+    assert np.all(columns["time"] == m.time)
+    for field in ("base_activation", "activation", "importance"):
+        assert columns[field] == pytest.approx([e[field] for e in expected])
+    assert np.all(columns["spreading_activation"] == 0)
+    assert np.all(np.isnan(columns["mismatch"]))
+    probabilities = columns["retrieval_probability"]
+    assert np.isnan(probabilities[[0, 1, 2, 6, 7]]).all()
+    assert probabilities[3:6] == pytest.approx([e["retrieval_probability"]
+                                                 for e in expected[3:6]])
+
+
+def test_trace_wraps_and_samples():
+    m = make_memory()
+    m.activation_history = trace = pyactup.ActivationTrace(size=5, fields=["query", "chunk"])
+    for i in range(4):
+        m.retrieve(color="red")
+    assert trace.rows == 12 and len(trace) == 5
+    assert trace["query"].tolist() == [2, 2, 3, 3, 3]
+    with pytest.raises(KeyError):
+        trace["activation"]
+    trace.clear()
+    assert len(trace) == 0
+    m.activation_history = trace = pyactup.ActivationTrace(sample=0.5, seed=0)
+    for i in range(200):
+        m.retrieve(color="red")
+    assert trace.queries == 200
+    assert 150 < trace.rows < 450
+    assert trace.rows % 3 == 0
+    with pytest.raises(ValueError):
+        pyactup.ActivationTrace(size=0)
+    with pytest.raises(ValueError):
+        pyactup.ActivationTrace(sample=0)
+    with pytest.raises(ValueError):
+        pyactup.ActivationTrace(fields=["nonsense"])
+
+
+def test_exporter_jsonl(tmp_path):
+    m = make_memory()
+    path = tmp_path / "history.jsonl"
+    with pyactup.HistoryExporter(str(path)) as exporter:
+        m.activation_history = exporter
+        m.retrieve(color="red")
+        # references made after the query must not change what it recorded
+        m.learn(color="red", size=1)
+        m.advance()
+        m.retrieve(color="red", size=2)
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert exporter.rows == len(rows) == 4
+    assert [r["query"] for r in rows] == [0, 0, 0, 1]
+    first = {r["attributes"]["size"]: r for r in rows if r["query"] == 0}
+    assert {s: r["references"] for s, r in first.items()} == {0: 2, 1: 1, 2: 1}
+    assert all(r["time"] == 4 for r in rows if r["query"] == 0)
+    assert rows[-1]["time"] == 5
+
+
+def test_exporter_matches_list_history(tmp_path):
+    m = make_memory()
+    m.activation_history = []
+    m.retrieve(color="red")
+    expected = m.activation_history
+    path = tmp_path / "history.csv"
+    with pyactup.HistoryExporter(str(path)) as exporter:
+        m.activation_history = exporter
+        m.retrieve(color="red")
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(expected)
+    for row, entry in zip(rows, expected):
+        assert row["name"] == str(entry["name"])
+        assert int(row["references"]) == len(entry["references"])
+        assert float(row["activation"]) == entry["activation"]
+
+
+def test_exporter_closed_and_released(tmp_path):
+    exporter = pyactup.HistoryExporter(str(tmp_path / "history.jsonl"))
+    assert exporter in pyactup._open_exporters
+    exporter.close()
+    assert exporter not in pyactup._open_exporters
+    exporter.close()
+    del exporter
+    gc.collect()
+    assert not pyactup._open_exporters
+
+
+def test_exporter_formats(tmp_path):
+    with pytest.raises(ValueError):
+        pyactup.HistoryExporter(str(tmp_path / "history.jsonl"), format="xml")
+    with pyactup.HistoryExporter(str(tmp_path / "history.csv")) as exporter:
+        assert exporter.format == "csv"
+    with pyactup.HistoryExporter(str(tmp_path / "history.txt")) as exporter:
+        assert exporter.format == "jsonl"
+    if pyactup.pyarrow is None:
+        with pytest.warns(UserWarning):
+            exporter = pyactup.HistoryExporter(str(tmp_path / "history.parquet"))
+        with exporter:
+            assert exporter.format == "csv"
+            assert exporter.path == str(tmp_path / "history.csv")
+
+
+def test_exporter_flush_and_close(tmp_path):
+    m = make_memory()
+    path = tmp_path / "history.jsonl"
+    exporter = pyactup.HistoryExporter(str(path), batch_size=1000000)
+    m.activation_history = exporter
+    m.retrieve(color="red")
+    exporter.flush()
+    assert len(path.read_text().splitlines()) == 3
+    exporter.close()
+    with pytest.raises(ValueError):
+        m.retrieve(color="red")
+
+
+def test_exporter_errors_are_raised(tmp_path):
+    m = make_memory()
+    path = tmp_path / "history.csv"
+    exporter = pyactup.HistoryExporter(str(path))
+    m.activation_history = exporter
+    exporter._file.close()
+    m.retrieve(color="red")
+    with pytest.raises(ValueError):
+        exporter.flush()
+    with pytest.raises(ValueError):
+        exporter.close()
+
+
+@pytest.mark.skipif(not os.path.exists("/dev/full"), reason="needs /dev/full")
+def test_exporter_refuses_records_after_failing():
+    m = make_memory()
+    exporter = pyactup.HistoryExporter("/dev/full", format="jsonl", batch_size=1)
+    m.activation_history = exporter
+    m.retrieve(color="red")
+    with pytest.raises(OSError):
+        exporter.flush()
+    for i in range(2):
+        with pytest.raises(OSError):
+            m.retrieve(color="red")
+        with pytest.raises(OSError):
+            exporter.flush()
+    m.activation_history = None
+    with pytest.raises(OSError):
+        exporter.close()
+    exporter.close()
@@ -0,0 +1,70 @@
+import random
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def records(n=300, seed=0):
+    rng = random.Random(seed)
+    times = sorted(rng.randrange(100) for i in range(n))
+    return [dict(color=rng.choice("rgb"), size=rng.randrange(6)) for i in range(n)], times
+
+
+def state(m):
+    m.activation_history = []
+    m.retrieve()
+    return sorted((e["attributes"], e["creation_time"], e["references"], e["importance"],
+                   e["base_activation"])
+                  for e in m.activation_history)
+
+
+@pytest.mark.parametrize("learning", [{}, dict(optimized_learning=True), dict(recent_references=3)])
+@pytest.mark.parametrize("columnar", [False, True])
+def test_learn_many_equals_learn(learning, columnar):
+    rs, times = records()
+    looped = pyactup.Memory(columnar=columnar, **learning)
+    for r, t in zip(rs, times):
+        looped.advance(t - looped.time)
+        looped.learn(importance=r["size"] / 10, **r)
+    looped.advance()
+    batched = pyactup.Memory(columnar=columnar, **learning)
+    assert batched.learn_many(rs, times, [r["size"] / 10 for r in rs]) == len(looped)
+    assert batched.time == times[-1]
+    batched.advance()
+    result, expected = state(batched), state(looped)
+    assert [r[:-1] for r in result] == [e[:-1] for e in expected]
+    assert [r[-1] for r in result] == pytest.approx([e[-1] for e in expected])
+
+
+def test_structured_records():
+    rs, times = records(50)
+    array = np.array([(r["color"], r["size"]) for r in rs],
+                     dtype=[("color", "U1"), ("size", int)])
+    a = pyactup.Memory()
+    a.learn_many(array, np.array(times))
+    b = pyactup.Memory()
+    b.learn_many(rs, times)
+    a.advance()
+    b.advance()
+    assert state(a) == state(b)
+
+
+def test_learn_many_at_current_time():
+    m = pyactup.Memory()
+    m.advance(5)
+    assert m.learn_many([dict(x=1), dict(x=1), dict(x=2)]) == 2
+    assert m.time == 5
+    m.advance()
+    assert [e[2] for e in state(m)] == [(5, 5), (5,)]
+
+
+def test_learn_many_errors():
+    m = pyactup.Memory()
+    with pytest.raises(ValueError):
+        m.learn_many([dict(x=1)], times=[1, 2])
+    with pytest.raises(ValueError):
+        m.learn_many([dict(x=1)], importance=[1, 2])
+    with pytest.raises(ValueError):
+        m.learn_many([dict(x=1), {}])
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def base_activations(columnar=False, chunks=30, seed=0, **learning):
+    m = pyactup.Memory(noise=0, temperature=1, columnar=columnar, **learning)
+    rng = random.Random(seed)
+    for t in range(2000):
+        # references to each chunk are increasingly frequent, and then stop
+        for i in range(chunks):
+            if t > 100 * i and rng.random() < i / (2 * chunks):
+                m.learn(chunk=i)
+        m.advance()
+    m.activation_history = []
+    m.retrieve()
+    return np.array([e["base_activation"]
+                     for e in sorted(m.activation_history, key=lambda e: e["attributes"])])
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_hybrid_accuracy(columnar):
+    exact = base_activations(columnar)
+    errors = [np.abs(base_activations(columnar, recent_references=k) - exact).mean()
+              for k in (1, 3, 10)]
+    optimized = np.abs(base_activations(columnar, optimized_learning=True) - exact).mean()
+    assert errors[0] < optimized
+    assert errors[2] < errors[1] < errors[0]
+    assert errors[2] < 0.05
+    assert base_activations(columnar, recent_references=100000) == pytest.approx(exact)
+
+
+def test_learning_modes_are_resettable():
+    m = pyactup.Memory(recent_references=3)
+    assert m.recent_references == 3 and m.optimized_learning is False
+    m.reset(True)
+    assert m.optimized_learning is True and m.recent_references is None
+    m.reset(recent_references=2)
+    assert m.optimized_learning is False and m.recent_references == 2
+    m.reset(recent_references=False)
+    assert m.recent_references is None
+    m.reset(False)
+    assert m.optimized_learning is False
+    for k in (-1, True, 1.5):
+        with pytest.raises(ValueError):
+            m.reset(recent_references=k)
+    with pytest.raises(ValueError):
+        m.reset(True, 3)
+
+
+@pytest.mark.parametrize("value, expected", [(0, False), (1, True), (1.0, True),
+                                             (np.bool_(True), True), (2, True)])
+def test_optimized_learning_is_a_boolean(value, expected):
+    # as it always has been, whatever the type of the value given
+    assert (base_activations(chunks=5, optimized_learning=value)
+            == pytest.approx(base_activations(chunks=5, optimized_learning=expected)))
+    m = pyactup.Memory(optimized_learning=value)
+    assert m.optimized_learning is expected and m.recent_references is None
@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def build(seed=0, **parameters):
+    m = pyactup.Memory(noise=0, temperature=1, **parameters)
+    rng = random.Random(seed)
+    for t in range(200):
+        m.learn(color=rng.choice("rgbk"), size=rng.randrange(8), value=rng.randrange(100),
+                pair=(rng.random(), rng.random()))
+        m.advance()
+    return m
+
+
+PROBES = [{}, dict(color="r"), dict(color="q"), dict(size=3), dict(color="g", size=1),
+          dict(color="b", size=99)]
+
+
+def test_retrieve_many_equals_loop():
+    m = build()
+    assert m.retrieve_many(PROBES) == [m.retrieve(**p) for p in PROBES]
+    assert m.retrieve_many([]) == []
+    assert m.blend_many("value", []).shape == (0,)
+    assert m.blend_many("pair", []).shape == (0, 2)
+    empty = m.blend_many(["value", "pair"], [])
+    assert empty["value"].shape == (0,) and empty["pair"].shape == (0, 2)
+
+
+def test_retrieve_many_partial_equals_loop(size_similarity):
+    m = build(mismatch=1)
+    probes = [dict(size=s) for s in range(8)] + [dict(color="r", size=2)]
+    assert (m.retrieve_many(probes, partial=True)
+            == [m.retrieve(partial=True, **p) for p in probes])
+
+
+def test_blend_many_equals_loop():
+    m = build()
+    expected = [m.blend("value", **p) for p in PROBES]
+    result = m.blend_many("value", PROBES)
+    assert result.shape == (len(PROBES),)
+    for r, e in zip(result, expected):
+        if e is None:
+            assert np.isnan(r)
+        else:
+            assert r == pytest.approx(e)
+
+
+def test_blend_many_vectors_and_attributes():
+    m = build()
+    probes = PROBES[:2]
+    vectors = m.blend_many("pair", probes)
+    assert vectors.shape == (2, 2)
+    for row, p in zip(vectors, probes):
+        assert row == pytest.approx(m.blend("pair", **p))
+    both = m.blend_many(["value", "pair"], probes)
+    assert both["value"] == pytest.approx(m.blend_many("value", probes))
+    assert both["pair"] == pytest.approx(vectors)
+
+
+def test_many_history_is_tagged_by_probe():
+    m = build()
+    m.activation_history = []
+    m.retrieve_many(PROBES[:3])
+    probes = [e["probe"] for e in m.activation_history]
+    assert probes == sorted(probes)
+    assert set(probes) == {0, 1}
+    assert probes.count(0) == len(m)
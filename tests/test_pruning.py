@@ -0,0 +1,36 @@
+import random
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def session(pruned, columnar=False, threshold=-1.0, recent_references=None):
+    # A sequence of retrievals interleaved with learning and forgetting; keeping an
+    # activation history turns off pruning.
+    m = pyactup.Memory(seed=11, mismatch=1, threshold=threshold, columnar=columnar,
+                       recent_references=recent_references)
+    if not pruned:
+        m.activation_history = []
+    rng = random.Random(0)
+    results = []
+    for t in range(300):
+        m.learn(color=rng.choice("rgb"), size=rng.randrange(20))
+        m.advance()
+        if t % 7 == 0:
+            m.forget(m.time - 1, **dict(m.retrieve_top_k(1)[0]))
+            m.advance()
+        if t % 3 == 0:
+            m.spread(auto_clear=True, color=rng.choice("rgb"))
+        results.append(m.retrieve(color=rng.choice("rgb")))
+        results.append(m.retrieve(partial=True, size=rng.randrange(20)))
+        m.activation_history = None if pruned else []
+    return [None if c is None else dict(c) for c in results], m.rng.random()
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+@pytest.mark.parametrize("threshold", [-1.0, None])
+@pytest.mark.parametrize("recent_references", [None, 3])
+def test_pruning_changes_nothing(columnar, threshold, recent_references, size_similarity):
+    assert (session(True, columnar, threshold, recent_references)
+            == session(False, columnar, threshold, recent_references))
@@ -0,0 +1,45 @@
+import random
+
+import numpy as np
+
+import pyactup_v2 as pyactup
+
+
+def run(m, steps=50):
+    results = []
+    for t in range(steps):
+        m.learn(color=("red", "blue", "green")[t % 3], size=t % 4, importance=None)
+        m.advance()
+        results.append((m.retrieve(color="red")["size"], m.blend("size", color="blue")))
+    return results, [c.importance for c in m.values()]
+
+
+def test_same_seed_same_behaviour():
+    assert run(pyactup.Memory(seed=7)) == run(pyactup.Memory(seed=7))
+    assert run(pyactup.Memory(seed=7)) != run(pyactup.Memory(seed=8))
+
+
+def test_memories_do_not_disturb_one_another():
+    alone = run(pyactup.Memory(seed=1))
+    a = pyactup.Memory(seed=1)
+    b = pyactup.Memory(seed=2)
+    run(b, 10)
+    interleaved = run(a)
+    run(b, 10)
+    assert interleaved == alone
+
+
+def test_global_random_state_untouched():
+    random.seed(0)
+    np.random.seed(0)
+    expected = (random.random(), np.random.random())
+    random.seed(0)
+    np.random.seed(0)
+    run(pyactup.Memory(seed=1), 10)
+    assert (random.random(), np.random.random()) == expected
+
+
+def test_rng():
+    m = pyactup.Memory(seed=5)
+    assert isinstance(m.rng, np.random.Generator)
+    assert m.rng.random() == np.random.default_rng(5).random()
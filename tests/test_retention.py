@@ -0,0 +1,107 @@
+import pyactup_v2 as pyactup
+
+
+def test_compact_evicts_weakest():
+    evicted = []
+    m = pyactup.Memory(noise=0, temperature=1, on_evict=evicted.extend)
+    for size in range(5):
+        m.learn(size=size)
+        m.advance()
+    m.learn(size=4)
+    m.advance()
+    m.max_chunks = 2
+    result = m.compact()
+    assert sorted(c["size"] for c in result) == [0, 1, 2]
+    assert sorted(c["size"] for c in m.values()) == [3, 4]
+    assert result == evicted
+
+
+def test_activation_floor():
+    m = pyactup.Memory(noise=0, temperature=1, activation_floor=-0.5)
+    m.learn(size=0)
+    m.advance(100)
+    m.learn(size=1)
+    m.advance()
+    assert [c["size"] for c in m.compact()] == [0]
+    assert len(m) == 1
+
+
+def test_advance_compacts_to_low_water():
+    m = pyactup.Memory(max_chunks=100)
+    compactions = []
+    m.on_evict = compactions.append
+    for i in range(101):
+        m.learn(x=i)
+    m.advance()
+    assert len(m) == 90
+    assert len(compactions) == 1
+    for i in range(10):
+        m.learn(x=1000 + i)
+        m.advance()
+    assert len(m) == 100
+    assert len(compactions) == 1
+    m.learn(x=2000)
+    m.advance()
+    assert len(m) == 90
+    assert len(compactions) == 2
+
+
+def test_chunks_created_now_are_kept():
+    m = pyactup.Memory(max_chunks=0)
+    m.learn(x=1)
+    assert m.compact() == []
+    m.advance()
+    assert len(m) == 0
+
+
+def test_compaction_interval():
+    m = pyactup.Memory(max_chunks=1, compaction_interval=3)
+    for i in range(3):
+        m.learn(x=i)
+        m.advance()
+    assert len(m) == 1
+
+
+def test_learn_many_applies_retention():
+    m = pyactup.Memory(max_chunks=10)
+    m.learn_many([dict(x=i) for i in range(20)], times=list(range(20)))
+    assert m.time == 19
+    assert len(m) == 9
+    m.learn_many([dict(x=i) for i in range(100, 105)])
+    assert len(m) == 14
+
+
+def test_columnar_evicts_the_same_chunks():
+    survivors = []
+    for columnar in (False, True):
+        m = pyactup.Memory(noise=0, temperature=1, max_chunks=30, activation_floor=-1.5,
+                           columnar=columnar)
+        for t in range(200):
+            m.learn(x=t % 47, importance=(t % 5) / 10)
+            m.advance()
+        survivors.append(sorted(c["x"] for c in m.values()))
+        assert m.retrieve(x=survivors[-1][0]) is not None
+    assert survivors[0] == survivors[1]
+    assert len(survivors[0]) <= 30
+
+
+def test_small_caps_are_kept():
+    for cap in range(1, 12):
+        m = pyactup.Memory(noise=0, temperature=1, max_chunks=cap)
+        for i in range(cap + 1):
+            m.learn(x=i)
+        m.advance()
+        assert len(m) == (cap if cap < 10 else cap - 1)
+        assert m.retrieve() is not None
+
+
+def test_max_chunks_one_and_two():
+    for cap in (1, 2):
+        m = pyactup.Memory(noise=0, temperature=1, max_chunks=cap)
+        for i in range(5):
+            m.learn(x=i)
+            m.advance()
+            assert len(m) == min(i + 1, cap)
+        # the most recent survive
+        assert sorted(c["x"] for c in m.values()) == list(range(5 - cap, 5))
+        assert m.retrieve()["x"] == 4
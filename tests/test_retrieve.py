@@ -0,0 +1,107 @@
+import math
+import random
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def populate(m, n=200, seed=0):
+    # Learns chunks of two shapes at random times, returning the times of each's
+    # references, keyed by its attributes.
+    rng = random.Random(seed)
+    references = {}
+    for t in range(n):
+        if rng.random() < 0.7:
+            attributes = dict(color=rng.choice("rgbk"), size=rng.randrange(5),
+                              value=rng.randrange(20))
+        else:
+            attributes = dict(color=rng.choice("rgbk"), shape=rng.choice("xyz"))
+        m.learn(**attributes)
+        references.setdefault(tuple(sorted(attributes.items())), []).append(m.time)
+        m.advance()
+    return references
+
+
+def activation(m, times):
+    return math.log(sum((m.time - t) ** -m.decay for t in times))
+
+
+def matches(attributes, conditions):
+    attributes = dict(attributes)
+    return all(s in attributes and attributes[s] == v for s, v in conditions.items())
+
+
+def probes():
+    yield {}
+    for color in "rgbkq":
+        yield dict(color=color)
+        for size in range(6):
+            yield dict(color=color, size=size)
+    yield dict(shape="x")
+    yield dict(shape="y", color="r")
+    yield dict(size=2, shape="x")
+
+
+def test_retrieve_matches_brute_force():
+    m = pyactup.Memory(noise=0, temperature=1, threshold=None)
+    references = populate(m)
+    for probe in probes():
+        candidates = [(activation(m, times), attributes)
+                      for attributes, times in references.items()
+                      if matches(attributes, probe)]
+        chunk = m.retrieve(**probe)
+        if not candidates:
+            assert chunk is None
+            continue
+        expected = max(candidates)[1]
+        assert tuple(sorted(chunk.items())) == expected
+
+
+def test_blend_matches_brute_force():
+    m = pyactup.Memory(noise=0, temperature=1)
+    references = populate(m)
+    for probe in probes():
+        weights = []
+        for attributes, times in references.items():
+            if matches(attributes, probe) and "value" in dict(attributes):
+                weights.append((math.exp(activation(m, times)), dict(attributes)["value"]))
+        result = m.blend("value", **probe)
+        if not weights:
+            assert result is None
+            continue
+        total = sum(w for w, v in weights)
+        assert result == pytest.approx(sum(w * v for w, v in weights) / total)
+
+
+def test_threshold():
+    m = pyactup.Memory(noise=0, temperature=1, threshold=-1)
+    m.learn(color="red")
+    m.advance(10)
+    m.learn(color="blue")
+    m.advance()
+    assert m.retrieve(color="red") is None
+    assert m.retrieve(color="blue")["color"] == "blue"
+    assert m.retrieve()["color"] == "blue"
+
+
+def test_index_follows_learn_and_forget():
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(color="red", size=1)
+    m.advance()
+    assert m.retrieve(color="red")["size"] == 1
+    assert m.forget(0, color="red", size=1)
+    assert m.retrieve(color="red") is None
+    assert m.blend("size", color="red") is None
+    m.learn(color="red", size=2)
+    m.advance()
+    assert m.retrieve(color="red")["size"] == 2
+    assert m.retrieve(color="red", size=1) is None
+
+
+def test_missing_attributes():
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(color="red", size=1)
+    m.advance()
+    assert m.retrieve(weight=1) is None
+    assert m.retrieve(color="red", weight=1) is None
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def make_agent(agent, seed):
+    m = pyactup.Memory(seed=seed)
+    def trial(t):
+        choice = m.blend("payoff", action="safe")
+        m.learn(action="safe", payoff=agent + t)
+        m.advance()
+        return choice
+    return trial
+
+
+def make_failing_agent(agent, seed):
+    def trial(t):
+        if agent == 1 and t == 2:
+            raise ValueError(f"agent {agent} failed")
+        return t
+    return trial
+
+
+def make_dying_agent(agent, seed):
+    def trial(t):
+        if agent == 1 and t == 2:
+            os._exit(1)
+        return t
+    return trial
+
+
+def run(make, agents, trials, processes, seed=0):
+    return sorted(pyactup.run_agents(make, agents, trials, processes=processes, seed=seed),
+                  key=lambda r: r[:2])
+
+
+def test_results_do_not_depend_on_processes():
+    serial = run(make_agent, 5, 20, 1)
+    assert len(serial) == 100
+    assert run(make_agent, 5, 20, 2) == serial
+    assert run(make_agent, 5, 20, 3, seed=1) != serial
+
+
+def test_agent_identifiers():
+    results = run(make_failing_agent, ["a", "b"], 3, 2)
+    assert [r[:2] for r in results] == [("a", 0), ("a", 1), ("a", 2),
+                                        ("b", 0), ("b", 1), ("b", 2)]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_exception_is_propagated(processes):
+    with pytest.raises(ValueError, match="agent 1 failed"):
+        run(make_failing_agent, 3, 5, processes)
+
+
+def test_dead_worker_is_reported():
+    with pytest.raises(RuntimeError, match="agent 1 died"):
+        run(make_dying_agent, 3, 5, 2)
@@ -0,0 +1,105 @@
+import random
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+SIZES = list(range(10))
+
+
+@pytest.fixture(autouse=True)
+def clear_similarities():
+    yield
+    for table in (pyactup.Memory._similarity_functions, pyactup.Memory._similarity_matrices):
+        table.pop("size", None)
+    pyactup.Memory._clamped_similarity.cache_clear()
+
+
+def similarity(x, y):
+    return 1 - abs(x - y) / 10
+
+
+def mismatches(huge=False, **probe):
+    m = pyactup.Memory(noise=0, temperature=1, mismatch=2)
+    rng = random.Random(0)
+    for t in range(100):
+        m.learn(color=rng.choice("rgb"), size=rng.choice(SIZES))
+        m.advance()
+    if huge:
+        m.learn(color="r", size="huge")
+        m.advance()
+    m.activation_history = []
+    chunk = m.retrieve(partial=True, **probe)
+    history = {e["attributes"]: e["mismatch"] for e in m.activation_history}
+    m.activation_history = None
+    blended = None if huge else m.blend("size", size=3)
+    return chunk, blended, history
+
+
+def test_matrix_agrees_with_function():
+    pyactup.set_similarity_function(similarity, "size")
+    expected = mismatches(size=3, color="r")
+    pyactup.set_similarity_matrix(SIZES, [[similarity(x, y) for y in SIZES] for x in SIZES],
+                                  "size")
+    result = mismatches(size=3, color="r")
+    assert result[0] == expected[0]
+    assert result[1] == pytest.approx(expected[1])
+    assert result[2].keys() == expected[2].keys()
+    for attributes, mismatch in result[2].items():
+        assert mismatch == pytest.approx(expected[2][attributes])
+
+
+def test_values_outside_matrix():
+    pyactup.set_similarity_matrix(SIZES, np.eye(len(SIZES)), "size")
+    chunk, blended, history = mismatches(huge=True, size="huge")
+    assert chunk["size"] == "huge"
+    assert history[(("color", "r"), ("size", "huge"))] == 0
+    assert all(m == -2 for a, m in history.items() if dict(a)["size"] != "huge")
+
+
+def test_replacing_functions_clears_cache():
+    pyactup.set_similarity_function(similarity, "size")
+    first = mismatches(size=3)[2]
+    pyactup.set_similarity_function(lambda x, y: 1.0 if x == y else 0.5, "size")
+    second = mismatches(size=3)[2]
+    assert all(m in (0, -1) for m in second.values())
+    assert second != first
+
+
+def test_matrix_errors():
+    with pytest.raises(ValueError):
+        pyactup.set_similarity_matrix([1, 2], [[1, 0]], "size")
+    with pytest.raises(ValueError):
+        pyactup.set_similarity_matrix([1, 1], np.eye(2), "size")
+    with pytest.warns(UserWarning):
+        pyactup.set_similarity_matrix([1, 2], [[1, 2], [2, 1]], "size")
+
+
+def test_errors_in_functions_propagate():
+    calls = []
+    def fragile(x, y):
+        calls.append((x, y))
+        return similarity(x, y)
+    pyactup.set_similarity_function(fragile, "size")
+    m = pyactup.Memory(noise=0, temperature=1, mismatch=1)
+    m.learn(size="huge")
+    m.advance()
+    with pytest.raises(TypeError):
+        m.retrieve(partial=True, size=3)
+    assert len(calls) == 1
+
+
+def test_clamping_warns_on_both_paths():
+    def steep(x, y):
+        return 1 - abs(x - y) / 5
+    pyactup.set_similarity_function(steep, "size")
+    with pytest.warns(UserWarning, match="less than the minimum"):
+        expected = mismatches(size=0)
+    with pytest.warns(UserWarning):
+        pyactup.set_similarity_matrix(SIZES, [[steep(x, y) for y in SIZES] for x in SIZES],
+                                      "size")
+    with pytest.warns(UserWarning, match="less than the minimum"):
+        result = mismatches(size=0)
+    assert result[0] == expected[0]
+    assert result[2] == pytest.approx(expected[2])
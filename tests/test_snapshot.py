@@ -0,0 +1,131 @@
+import json
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def build(columnar=False, step=1, **learning):
+    m = pyactup.Memory(seed=3, columnar=columnar, mismatch=1, threshold=-5, **learning)
+    rng = random.Random(0)
+    for t in range(100):
+        m.learn(color=rng.choice("rgb"), size=rng.randrange(5), importance=rng.random())
+        m.advance(step)
+    m.forget(m.time - step, **dict(m.retrieve_top_k(1)[0]))
+    return m
+
+
+def behaviour(m):
+    m.activation_history = []
+    result = [m.retrieve(color="r"), m.blend("size", color="g"), m.retrieve_top_k(3)]
+    m.learn(color="k", size=9)
+    m.advance()
+    result.append(m.retrieve(color="k"))
+    history = [(e["attributes"], e["references"], e["activation"]) for e in m.activation_history]
+    m.activation_history = None
+    return result, history
+
+
+@pytest.mark.parametrize("learning", [{}, dict(optimized_learning=True), dict(recent_references=3)])
+@pytest.mark.parametrize("columnar", [False, True])
+@pytest.mark.parametrize("mmap", [False, True])
+def test_round_trip(tmp_path, learning, columnar, mmap):
+    m = build(columnar, **learning)
+    path = str(tmp_path / "snapshot")
+    m.snapshot(path)
+    restored = pyactup.Memory.restore(path, mmap=mmap)
+    assert restored.time == m.time
+    assert type(restored.time) is type(m.time)
+    assert restored.optimized_learning == m.optimized_learning
+    assert restored.recent_references == m.recent_references
+    assert restored.columnar == m.columnar
+    assert restored.mismatch == m.mismatch and restored.threshold == m.threshold
+    assert [dict(c) for c in restored.values()] == [dict(c) for c in m.values()]
+    assert ([(c._creation, c.importance) for c in restored.values()]
+            == [(c._creation, c.importance) for c in m.values()])
+    assert behaviour(restored) == behaviour(m)
+
+
+def test_restore_changing_columnar(tmp_path):
+    m = build()
+    path = str(tmp_path / "snapshot")
+    m.snapshot(path)
+    restored = pyactup.Memory.restore(path, columnar=True, concurrent=True)
+    assert restored.columnar and restored.concurrent
+    expected = behaviour(m)
+    result = behaviour(restored)
+    assert result[0] == expected[0]
+    for (a, r, x), (b, s, y) in zip(result[1], expected[1]):
+        assert a == b and r == pytest.approx(s) and x == pytest.approx(y)
+
+
+def test_time_types(tmp_path):
+    m = build(step=0.5)
+    path = str(tmp_path / "snapshot")
+    m.snapshot(path)
+    restored = pyactup.Memory.restore(path)
+    assert isinstance(restored.time, float)
+    assert all(isinstance(c._creation, float) for c in restored.values())
+    integral = build()
+    path = str(tmp_path / "integral")
+    integral.snapshot(path)
+    restored = pyactup.Memory.restore(path)
+    assert type(restored.time) is int
+    assert all(type(c._creation) is int for c in restored.values())
+
+
+def test_snapshot_errors(tmp_path):
+    m = build()
+    path = str(tmp_path / "snapshot")
+    m.snapshot(path)
+    with pytest.raises(FileExistsError):
+        m.snapshot(path)
+    with pytest.raises(ValueError):
+        pyactup.Memory.restore(str(tmp_path))
+    os.remove(os.path.join(path, "header.json"))
+    with pytest.raises(ValueError):
+        pyactup.Memory.restore(path)
+
+
+# Each run in a new process, in which chunks are numbered from the start again.
+PICKLE = """
+import pickle, sys
+sys.path.insert(0, sys.argv[2])
+import pyactup_v2 as pyactup
+m = pyactup.Memory(noise=0, temperature=1)
+for size in range(3):
+    m.learn(color="red", size=size)
+m.advance()
+with open(sys.argv[1], "wb") as f:
+    pickle.dump(m, f)
+"""
+
+UNPICKLE_AND_LEARN = """
+import json, pickle, sys
+sys.path.insert(0, sys.argv[2])
+import pyactup_v2 as pyactup
+with open(sys.argv[1], "rb") as f:
+    m = pickle.load(f)
+m.learn(color="red", size=9)
+m.advance()
+red = sorted(c["size"] for c in m._candidates(dict(color="red")))
+m.spread(size=9)
+spread = m._spreading.get(m.retrieve(size=0)._serial, 0)
+m.forget(1, color="red", size=9)
+print(json.dumps([red, spread, m.retrieve(color="red", size=0) is not None]))
+"""
+
+
+def test_pickled_memory_learns_in_new_process(tmp_path):
+    path = str(tmp_path / "memory.pickle")
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+    for script in (PICKLE, UNPICKLE_AND_LEARN):
+        result = subprocess.run([sys.executable, "-c", script, path, root],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout) == [[0, 1, 2, 9], 0, True]
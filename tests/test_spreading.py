@@ -0,0 +1,345 @@
+import math
+import threading
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def make_memory():
+    m = pyactup.Memory(noise=0, temperature=1)
+    for color, size in [("red", 1), ("red", 2), ("blue", 1), ("green", 3)]:
+        m.learn(color=color, size=size)
+    m.advance()
+    return m
+
+
+def spreading(m):
+    return {c["color"] + str(c["size"]): c.spreading_activation for c in m.values()}
+
+
+def test_spreading_cache_hits_and_invalidation():
+    m = make_memory()
+    m.spread(color="red")
+    first = spreading(m)
+    m.clear_spread()
+    m.spread(color="red")
+    assert spreading(m) == first
+    assert m.spreading_cache_info().hits >= 1
+    m.learn(color="red", size=3)
+    m.advance()
+    m.clear_spread()
+    m.spread(color="red")
+    assert spreading(m)["red1"] < first["red1"]
+    m.forget(m.time - 1, color="red", size=3)
+    m.clear_spread()
+    m.spread(color="red")
+    assert spreading(m)["red1"] == first["red1"]
+
+
+
+def test_spreading_cache_parameters_and_size():
+    m = make_memory()
+    m.spread(color="red")
+    first = spreading(m)
+    m.clear_spread()
+    m.source_activation = 2
+    m.spread(color="red")
+    assert spreading(m)["red1"] == pytest.approx(2 * first["red1"])
+    m.clear_spread()
+    m.source_activation = 1
+    m.max_associative_strength = 3
+    m.spread(color="red")
+    assert spreading(m)["red1"] > first["red1"]
+    m.spreading_cache_size = 2
+    for color in ("red", "blue", "green", "red"):
+        m.spread(auto_clear=True, color=color)
+    info = m.spreading_cache_info()
+    assert info.maxsize == 2 and info.currsize == 2
+    hits = info.hits
+    m.spread(auto_clear=True, color="green")
+    assert m.spreading_cache_info().hits == hits + 1
+    m.spreading_cache_size = 0
+    m.spread(auto_clear=True, color="green")
+    assert m.spreading_cache_info().currsize == 0
+    with pytest.raises(ValueError):
+        m.spreading_cache_size = -1
+    # unhashable values are spread without being cached
+    m.spreading_cache_size = 8
+    m.spread(auto_clear=True, color=["red"])
+    assert all(v is None for v in spreading(m).values())
+
+def test_spreading_cache_follows_instance_sji_flag():
+    def sji(match_matrix):
+        return np.full(match_matrix.shape[0], 10.0)
+    m = make_memory()
+    m.spread(color="red")
+    default = spreading(m)
+    saved = pyactup.Memory._sji_function
+    pyactup.set_sji_function(sji)
+    try:
+        m._use_actr_sji = False
+        m.clear_spread()
+        m.spread(color="red")
+        assert spreading(m)["red1"] == m.source_activation * 10.0
+        m._use_actr_sji = True
+        m.clear_spread()
+        m.spread(color="red")
+        assert spreading(m) == default
+    finally:
+        pyactup.Memory._sji_function = saved
+
+
+def test_context_and_spreading_activation_setter():
+    m = make_memory()
+    m.spread(color="blue")
+    red = next(c for c in m.values() if c["color"] == "red")
+    assert red.spreading_activation is None
+    with m.context(color="red"):
+        assert red.spreading_activation > 0
+        assert red._spreading_activation == red.spreading_activation
+        assert m.retrieve()["color"] == "red"
+        with pytest.raises(RuntimeError):
+            red.spreading_activation = 1.0
+    assert red.spreading_activation is None
+    red.spreading_activation = 1.0
+    red.spreading_activation = 0.5
+    assert red.spreading_activation == 1.5
+    red.spreading_activation = None
+    assert red.spreading_activation is None
+
+
+def test_buffers_with_weights():
+    m = make_memory()
+    m.spread_buffers({"goal": {"color": "red"}, "imaginal": {"size": 1}},
+                     weights={"goal": 2.0})
+    together = spreading(m)
+    m.clear_spread()
+    m.source_activation = 2.0
+    m.spread(color="red")
+    m.source_activation = 1.0
+    m.spread(size=1)
+    separately = spreading(m)
+    assert together.keys() == separately.keys()
+    for name in together:
+        assert together[name] == pytest.approx(separately[name])
+    with m.context_buffers({"goal": {"color": "red"}, "imaginal": {"size": 1}},
+                           {"goal": 2.0}) as context:
+        assert spreading(m) == together
+    assert set(context.sources) == {"goal", "imaginal"}
+    with pytest.raises(ValueError):
+        m.spread_buffers({"goal": {"color": "red"}}, weights={"other": 1})
+    with pytest.raises(ValueError):
+        m.spread_buffers({"goal": {"color": "red"}}, weights={"goal": -1})
+
+
+def test_slot_names_are_not_reserved():
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(sources="a", weights=1, buffers="c")
+    m.learn(sources="b", weights=2, buffers="d")
+    m.advance()
+    m.spread(sources="a", buffers="c")
+    assert [c["sources"] for c in m.values() if c.spreading_activation] == ["a"]
+    with m.context(weights=2):
+        assert m.retrieve()["weights"] == 2
+    m.clear_spread()
+    m.learn(auto_clear="x")
+    m.advance()
+    m.spread_buffers({"goal": {"auto_clear": "x"}})
+    assert [c.get("auto_clear") for c in m.values() if c.spreading_activation] == ["x"]
+
+
+def expected_spreading(m, sources, w=None):
+    # The spreading activations from sources, computed directly from their definition.
+    w = m.source_activation if w is None else w
+    result = {}
+    for c in m.values():
+        total = 0
+        for value in sources.values():
+            fan = 1 + sum(value in other.values() for other in m.values())
+            if value in c.values():
+                total += w / len(sources) * (m.max_associative_strength - math.log(fan))
+        if total:
+            result[c["color"] + str(c["size"])] = total
+    return result
+
+
+def test_spreading_follows_definition():
+    m = make_memory()
+    for sources in [dict(color="red"), dict(color="red", size=1), dict(size=3),
+                    dict(color="purple"), dict(color="blue", shape="square")]:
+        m.clear_spread()
+        m.spread(**sources)
+        assert {k: v for k, v in spreading(m).items() if v is not None} == \
+            pytest.approx(expected_spreading(m, sources))
+    m.learn(color="red", size=5)
+    m.learn(color="green", size=1)
+    m.advance()
+    m.forget(0, color="green", size=3)
+    m.clear_spread()
+    m.spread(color="red", size=1)
+    assert {k: v for k, v in spreading(m).items() if v is not None} == \
+        pytest.approx(expected_spreading(m, dict(color="red", size=1)))
+
+
+def test_spread_accumulates_and_clears():
+    m = make_memory()
+    m.spread(color="red")
+    once = spreading(m)
+    m.spread(color="red")
+    twice = spreading(m)
+    assert all(twice[k] == pytest.approx(2 * v) for k, v in once.items() if v)
+    m.spread(auto_clear=True, color="red")
+    assert spreading(m) == once
+    m.clear_spread()
+    assert all(v is None for v in spreading(m).values())
+    with pytest.raises(ValueError):
+        m.spread()
+
+
+@pytest.fixture
+def custom_functions():
+    yield
+    pyactup.use_actr_sji(True)
+    pyactup.use_actr_matching_source_to_chunk(True)
+    pyactup.set_sji_function(None)
+    pyactup.set_matching_source_to_chunk_function(None)
+
+
+def dense_matching(m, conditions):
+    return np.array([[v in c.values() for c in m.values()] for v in conditions.values()])
+
+
+def test_dense_functions_agree_with_sparse_default(custom_functions):
+    matrices = []
+    def sji(m, match_matrix):
+        matrices.append(match_matrix)
+        return m.max_associative_strength - np.log(np.sum(match_matrix, axis=1) + 1)
+    m = make_memory()
+    m.spread(color="red", size=1)
+    default = spreading(m)
+    pyactup.set_matching_source_to_chunk_function(dense_matching)
+    pyactup.use_actr_matching_source_to_chunk(False)
+    m.clear_spread()
+    m.spread(color="red", size=1)
+    assert spreading(m) == pytest.approx(default)
+    pyactup.set_sji_function(sji)
+    pyactup.use_actr_sji(False)
+    pyactup.use_actr_matching_source_to_chunk(True)
+    m.clear_spread()
+    m.spread(color="red", size=1)
+    assert spreading(m) == pytest.approx(default)
+    assert isinstance(matrices[-1], np.ndarray)
+    assert matrices[-1].shape == (2, len(m))
+    assert matrices[-1].tolist() == dense_matching(m, dict(color="red", size=1)).tolist()
+
+
+def test_customized_function_signatures(custom_functions):
+    m = make_memory()
+    m.spread(color="red")
+    default = spreading(m)
+    pyactup.set_sji_function(lambda match_matrix: np.zeros(len(match_matrix)) + 2)
+    pyactup.use_actr_sji(False)
+    m.clear_spread()
+    m.spread(color="red")
+    assert spreading(m)["red1"] == 2 * m.source_activation
+    pyactup.set_sji_function(lambda a, b, c: None)
+    m.clear_spread()
+    with pytest.warns(UserWarning):
+        m.spread(color="red")
+    assert spreading(m) == default
+    def failing(m, match_matrix):
+        raise ZeroDivisionError
+    pyactup.set_sji_function(failing)
+    m.clear_spread()
+    with pytest.raises(ZeroDivisionError):
+        m.spread(color="red")
+
+
+def test_nested_contexts():
+    m = make_memory()
+    red = m.context(color="red")
+    green = m.context(color="green")
+    assert m.retrieve(size=1)["color"] == "blue"
+    blended = m.blend("size")
+    with red:
+        assert m.retrieve(size=1)["color"] == "red"
+        with green:
+            assert m.retrieve()["color"] == "green"
+            # the green chunk is the largest
+            assert m.blend("size") > blended
+        assert m.retrieve()["color"] == "red"
+    assert m.retrieve(size=1)["color"] == "blue"
+    assert red.memory is m
+    assert red.sources == {None: {"color": "red"}}
+
+
+def test_context_follows_chunks():
+    m = make_memory()
+    context = m.context(color="red")
+    with context:
+        before = spreading(m)["red1"]
+    m.learn(color="red", size=9)
+    m.advance()
+    with context:
+        assert spreading(m)["red1"] < before
+        assert spreading(m)["red9"] == spreading(m)["red1"]
+
+
+def test_contexts_are_per_thread():
+    m = pyactup.Memory(noise=0, temperature=1, concurrent=True)
+    m.learn(color="red", size=1)
+    m.learn(color="blue", size=1)
+    m.advance()
+    seen = []
+    entered = threading.Event()
+    def other():
+        entered.wait()
+        seen.append(m._context_stack() == [])
+    thread = threading.Thread(target=other)
+    thread.start()
+    with m.context(color="red"):
+        entered.set()
+        thread.join()
+        assert m.retrieve(size=1)["color"] == "red"
+    assert seen == [True]
+
+
+def test_chunks_and_empty_buffers_as_sources():
+    m = make_memory()
+    goal = m.retrieve(color="green")
+    m.spread_buffers({"goal": goal, "retrieval": None})
+    by_chunk = spreading(m)
+    m.clear_spread()
+    m.spread(color="green", size=3)
+    assert spreading(m) == by_chunk
+    with pytest.raises(ValueError):
+        m.spread_buffers({"goal": None})
+    with pytest.raises(ValueError):
+        m.spread_buffers({"goal": "green"})
+
+
+def test_sparse_sji_function(custom_functions):
+    matrices = []
+    def sji(m, match_matrix):
+        matrices.append(match_matrix)
+        return m.max_associative_strength - np.log(np.diff(match_matrix.indptr) + 1)
+    m = make_memory()
+    m.spread(color="red", size=1)
+    default = spreading(m)
+    pyactup.set_sji_function(sji, sparse=True)
+    pyactup.use_actr_sji(False)
+    m.clear_spread()
+    m.spread(color="red", size=1)
+    assert spreading(m) == pytest.approx(default)
+    assert not isinstance(matrices[-1], np.ndarray)
+    assert (matrices[-1].toarray().tolist()
+            == dense_matching(m, dict(color="red", size=1)).tolist())
+    # the same function set densely is handed a dense array, and not the cached result
+    pyactup.set_sji_function(lambda match_matrix: matrices.append(match_matrix) or
+                             m.max_associative_strength - np.log(np.sum(match_matrix, axis=1) + 1))
+    m.clear_spread()
+    m.spread(color="red", size=1)
+    assert isinstance(matrices[-1], np.ndarray)
+    assert spreading(m) == pytest.approx(default)
@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pytest
+
+import pyactup_v2 as pyactup
+
+
+def build(seed=0, **parameters):
+    m = pyactup.Memory(seed=seed, **parameters)
+    rng = random.Random(0)
+    for t in range(300):
+        m.learn(color=rng.choice("rgb"), size=rng.randrange(30))
+        m.advance()
+    return m
+
+
+def activations(m, **probe):
+    m.activation_history = []
+    m.retrieve(**probe)
+    result = {e["name"]: e["activation"] for e in m.activation_history}
+    m.activation_history = None
+    return result
+
+
+@pytest.mark.parametrize("k", [0, 1, 3, 10, 1000])
+def test_top_k_ordering(k):
+    m = build(noise=0, temperature=1, threshold=-2)
+    expected = activations(m, color="r")
+    ranked = sorted((a, int(n)) for n, a in expected.items() if a >= m.threshold)
+    ranked.reverse()
+    chunks = m.retrieve_top_k(k, color="r")
+    assert [c._serial for c in chunks] == [n for a, n in ranked[:k]]
+
+
+def test_top_k_first_is_retrieved():
+    for seed in range(5):
+        assert (build(seed).retrieve_top_k(5, color="g")[0]
+                == build(seed).retrieve(color="g"))
+    m = build(threshold=100)
+    assert m.retrieve_top_k(3) == []
+    with pytest.raises(ValueError):
+        m.retrieve_top_k(-1)
+
+
+def test_top_k_ties_prefer_recent():
+    m = pyactup.Memory(noise=0, temperature=1)
+    m.learn(color="red", size=1)
+    m.learn(color="red", size=2)
+    m.learn(color="red", size=3)
+    m.advance()
+    assert [c["size"] for c in m.retrieve_top_k(3)] == [3, 2, 1]
+
+
+def test_retrieval_probabilities():
+    m = build(noise=0, temperature=0.5)
+    chunks, probabilities = m.retrieval_probabilities(color="b")
+    assert len(chunks) == len(probabilities)
+    assert all(c["color"] == "b" for c in chunks)
+    assert probabilities.sum() == pytest.approx(1)
+    expected = activations(m, color="b")
+    weights = np.exp(np.array([expected[c._name] for c in chunks]) / 0.5)
+    assert probabilities == pytest.approx(weights / weights.sum())
+    assert m.blend("size", color="b") == pytest.approx(
+        sum(p * c["size"] for c, p in zip(chunks, probabilities)))
+    chunks, probabilities = m.retrieval_probabilities(color="q")
+    assert chunks == [] and len(probabilities) == 0